@@ -0,0 +1,528 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2019 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+"""Headless grading of scanned exams.
+
+Runs the same detection and scoring as the interactive webcam loop,
+but over image files (e.g. the output of a copier with a document
+feeder). Results are stored in an existing session.
+
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import glob
+import os
+import sys
+import time
+
+import cv2
+
+from . import detection
+from . import exams
+from . import images
+from . import sessiondb
+from . import sources
+from . import utils
+
+
+class BatchResult:
+    """Outcome of grading a single image."""
+
+    def __init__(
+        self,
+        image_file,
+        exam_id=None,
+        exam=None,
+        message=None,
+        elapsed=0.0,
+        detection_time=0.0,
+        confident=True,
+    ):
+        self.image_file = image_file
+        self.exam_id = exam_id
+        self.exam = exam
+        self.message = message
+        self.elapsed = elapsed
+        self.detection_time = detection_time
+        self.confident = confident
+
+    @property
+    def success(self):
+        return self.exam is not None
+
+
+class DetectedImage:
+    """Detection results of an image.
+
+    Unlike `detection.ExamDetector`, these objects can be pickled,
+    and are therefore what worker processes send back.
+
+    """
+
+    def __init__(
+        self, image_file, detector=None, message=None, elapsed=0.0, profile=None
+    ):
+        self.image_file = image_file
+        self.message = message
+        self.elapsed = elapsed
+        self.profile = profile
+        if detector is not None:
+            self.success = detector.success
+            self.status = detector.status
+            self.decisions = detector.decisions
+            self.capture = detector.capture
+        else:
+            self.success = False
+            self.status = None
+            self.decisions = None
+            self.capture = None
+
+
+class BatchGrader:
+    """Grades exam images and stores them in a session."""
+
+    def __init__(
+        self,
+        session,
+        hough_threshold=None,
+        store_captures=True,
+        jobs=1,
+        profile=False,
+        min_margin=None,
+    ):
+        """Creates a new batch grader for an open `sessiondb.SessionDB`.
+
+        If `store_captures` is True, the raw and the annotated images
+        of each exam are saved into the session directory, the same
+        way the interactive grading does.
+
+        With `jobs` greater than one, detection runs in that number of
+        worker processes. Results are stored in the same order as the
+        images were given, regardless of the order in which workers
+        finish them.
+
+        If `profile` is True, the time spent in every detection stage
+        is aggregated into `self.profiler`.
+
+        With a `min_margin`, sheets with a classification margin below
+        it are detected again with the other Hough thresholds, and
+        their results are marked as not confident if none of them
+        reaches it (see `detect_image`).
+
+        """
+        self.session = session
+        self.exam_config = session.exam_config
+        self.store_captures = store_captures
+        self.hough_threshold = hough_threshold
+        self.jobs = jobs
+        self.min_margin = min_margin
+        self.options = detector_options(self.exam_config)
+        self.next_exam_id = session.next_exam_id()
+        self.profiler = detection.DetectionProfiler() if profile else None
+        self._context = None
+        # Annotated captures are drawn by OpenCV, not grabbed from the GUI:
+        self.session.capture_save_func = None
+
+    @property
+    def context(self):
+        # Created on demand: with worker processes, each worker has its own
+        if self._context is None:
+            self._context = detection.ExamDetectorContext(
+                fixed_hough_threshold=self.hough_threshold, pre_process_cache=True
+            )
+        return self._context
+
+    def grade(self, image_files):
+        """Returns an iterator of `BatchResult` objects, one per image."""
+        if self.jobs > 1:
+            detections = self._detect_in_pool(image_files)
+        else:
+            detections = (
+                detect_file(
+                    self.context,
+                    self.exam_config.dimensions,
+                    self.options,
+                    image_file,
+                    profile=self.profiler is not None,
+                    min_margin=self.min_margin,
+                )
+                for image_file in image_files
+            )
+        for detected in detections:
+            start = time.time()
+            result = self.store(detected)
+            store_time = time.time() - start
+            result.detection_time = detected.elapsed
+            result.elapsed = detected.elapsed + store_time
+            if self.profiler is not None:
+                if detected.profile is not None:
+                    self.profiler.merge(detected.profile)
+                self.profiler.record("store", store_time)
+            yield result
+
+    def store(self, detected):
+        """Scores the results of a detection and stores them in the session."""
+        image_file = detected.image_file
+        if not detected.success:
+            if detected.message is not None:
+                message = detected.message
+            else:
+                message = _failure_message(detected.status)
+            return BatchResult(image_file, message=message)
+        decisions = detected.decisions
+        if not self.options["infobits"]:
+            decisions.model = "A"
+        model = decisions.model
+        if model not in self.exam_config.solutions and not self.exam_config.survey_mode:
+            return BatchResult(
+                image_file, message="no solutions for model {}".format(model)
+            )
+        exam = exams.Exam(
+            detected.capture,
+            decisions,
+            self.exam_config.get_solutions(model),
+            self.session.student_listings,
+            self.next_exam_id,
+            self.exam_config.scores.get(model),
+            sessiondb=self.session,
+        )
+        if decisions.detected_id is None:
+            # Without a detected id, there is no reason to pick a student
+            decisions.set_student(None)
+        elif not decisions.student.is_in_database:
+            # An unknown id may have been inserted by a previous exam
+            known = self.session.student_listings.student(decisions.detected_id)
+            if known is not None:
+                decisions.set_student(known)
+        exam.reset_image()
+        exam.draw_answers()
+        self.session.store_exam(
+            exam.exam_id,
+            exam.capture,
+            exam.decisions,
+            exam.score,
+            store_captures=self.store_captures,
+        )
+        # Do not keep the images in memory once stored:
+        exam.clear_capture()
+        self.next_exam_id += 1
+        confident = self.min_margin is None or decisions.is_confident(self.min_margin)
+        return BatchResult(
+            image_file, exam_id=exam.exam_id, exam=exam, confident=confident
+        )
+
+    def _detect_in_pool(self, image_files):
+        """Detects images in worker processes and yields them in order.
+
+        At most a few images per worker are pending at any time, so
+        that memory use does not grow when storing results is slower
+        than detecting them.
+
+        """
+        max_pending = 2 * self.jobs
+        pending = collections.deque()
+        image_files = iter(image_files)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs) as pool:
+            for image_file in image_files:
+                pending.append(
+                    pool.submit(
+                        _detect_in_worker,
+                        image_file,
+                        self.exam_config.dimensions,
+                        self.options,
+                        self.hough_threshold,
+                        self.profiler is not None,
+                        self.min_margin,
+                    )
+                )
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+
+def detector_options(exam_config):
+    """Returns the detection options for the given exam configuration."""
+    options = detection.ExamDetector.get_default_options()
+    if exam_config.survey_mode:
+        options["infobits"] = False
+    if exam_config.id_num_digits and exam_config.id_num_digits > 0:
+        options["read-id"] = True
+        options["id-num-digits"] = exam_config.id_num_digits
+    options["left-to-right-numbering"] = exam_config.left_to_right_numbering
+    return options
+
+
+def detect_image(context, dimensions, options, image, min_margin=None):
+    """Detects an exam in `image`, trying every Hough threshold if needed.
+
+    Thresholds are tried starting with the one that succeeded last in
+    `context`, because consecutive scans usually share the same
+    lighting and contrast. Returns the last detector that was run.
+
+    With a `min_margin`, a successful detection whose classification
+    margins are below it does not stop the search: the rest of the
+    thresholds are tried until one of them is confident, and the
+    successful detector with the highest confidence is returned.
+    Confident sheets, which are most of them, are detected only once.
+
+    """
+    num_thresholds = len(context.hough_thresholds)
+    first_idx = context.hough_thresholds_idx
+    best = None
+    best_idx = first_idx
+    for i in range(num_thresholds):
+        context.hough_thresholds_idx = (first_idx + i) % num_thresholds
+        detector = detection.ExamDetector(dimensions, context, options, image_raw=image)
+        detector.detect_safe()
+        if not detector.success:
+            continue
+        if min_margin is None or detector.decisions.is_confident(min_margin):
+            return detector
+        if best is None or _more_confident(detector.decisions, best.decisions):
+            best = detector
+            best_idx = context.hough_thresholds_idx
+    context.hough_thresholds_idx = best_idx
+    return best if best is not None else detector
+
+
+def _more_confident(decisions, other):
+    if other.confidence is None:
+        return decisions.confidence is not None
+    return decisions.confidence is not None and decisions.confidence > other.confidence
+
+
+def detect_file(
+    context, dimensions, options, image_file, profile=False, min_margin=None
+):
+    """Loads and detects an image file. Returns a `DetectedImage` object.
+
+    If `profile` is True, the stage timings of this image are attached
+    to the result as a `detection.DetectionProfiler` object. See
+    `detect_image` for the meaning of `min_margin`.
+
+    """
+    if profile:
+        context.profiler = detection.DetectionProfiler()
+    start = time.time()
+    image = images.load_image(image_file)
+    if image is None:
+        return DetectedImage(
+            image_file, message="cannot load the image", elapsed=time.time() - start
+        )
+    detector = detect_image(context, dimensions, options, image, min_margin=min_margin)
+    return DetectedImage(
+        image_file,
+        detector=detector,
+        elapsed=time.time() - start,
+        profile=context.profiler,
+    )
+
+
+# Detection context of worker processes, loaded once per process
+_worker_context = None
+
+
+def _detect_in_worker(
+    image_file, dimensions, options, hough_threshold, profile, min_margin
+):
+    global _worker_context
+    if _worker_context is None:
+        # Parallelism comes from the processes themselves
+        cv2.setNumThreads(1)
+        _worker_context = detection.ExamDetectorContext(
+            fixed_hough_threshold=hough_threshold, pre_process_cache=True
+        )
+    detected = detect_file(
+        _worker_context,
+        dimensions,
+        options,
+        image_file,
+        profile=profile,
+        min_margin=min_margin,
+    )
+    if detected.capture is not None:
+        # Avoid sending a second copy of the image back;
+        # it is drawn again when the exam is stored.
+        detected.capture.image_drawn = None
+    return detected
+
+
+def find_images(paths):
+    """Expands directories and glob patterns into a sorted list of images."""
+    image_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            candidates = [os.path.join(path, name) for name in os.listdir(path)]
+        else:
+            candidates = glob.glob(path)
+        image_files.extend(
+            sorted(
+                c
+                for c in candidates
+                if os.path.isfile(c) and c.lower().endswith(sources.IMAGE_EXTENSIONS)
+            )
+        )
+    return image_files
+
+
+def _failure_message(status):
+    failed = [key for key, value in status.items() if not value]
+    return "detection failed ({})".format(", ".join(failed))
+
+
+def _cmd_options():
+    parser = argparse.ArgumentParser(
+        description="Grade a batch of scanned exams into an existing session."
+    )
+    parser.add_argument("session", help="session directory")
+    parser.add_argument(
+        "images",
+        nargs="+",
+        help="image files, directories or glob patterns of the scanned exams",
+    )
+    parser.add_argument(
+        "-t",
+        "--hough-threshold",
+        dest="hough_threshold",
+        type=int,
+        default=None,
+        help="use a fixed Hough threshold instead of trying several",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of worker processes (0 for one per CPU; default 1)",
+    )
+    parser.add_argument(
+        "--no-captures",
+        dest="store_captures",
+        action="store_false",
+        help="do not store the raw and annotated images in the session",
+    )
+    parser.add_argument(
+        "-m",
+        "--min-margin",
+        type=float,
+        default=detection.param_min_confidence_margin,
+        help="classification margin below which exams are listed for review; "
+        "0 to disable (default {})".format(detection.param_min_confidence_margin),
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profile_file",
+        default=None,
+        help="save detection stage timings to this file (.json or .csv)",
+    )
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="report only the summary and the failed images",
+    )
+    return parser.parse_args()
+
+
+def _open_session(session_dir):
+    try:
+        return sessiondb.SessionDB(session_dir)
+    except utils.EyegradeException as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+
+def _create_grader(session, args):
+    """Creates the grader with the settings of the command line."""
+    return BatchGrader(
+        session,
+        hough_threshold=args.hough_threshold,
+        store_captures=args.store_captures,
+        jobs=args.jobs if args.jobs > 0 else os.cpu_count(),
+        profile=args.profile_file is not None,
+        min_margin=args.min_margin if args.min_margin > 0 else None,
+    )
+
+
+def _print_result(result, quiet):
+    if not result.success:
+        print("{}: {}".format(result.image_file, result.message))
+    elif not quiet or not result.confident:
+        print(
+            "{}: exam {} ({:.3f}s, detection {:.3f}s){}".format(
+                result.image_file,
+                result.exam_id,
+                result.elapsed,
+                result.detection_time,
+                "" if result.confident else ", needs review",
+            )
+        )
+
+
+def _print_summary(image_files, failed, review, elapsed):
+    print(
+        "Graded {} of {} images in {:.2f}s ({:.2f} sheets/s)".format(
+            len(image_files) - len(failed),
+            len(image_files),
+            elapsed,
+            len(image_files) / elapsed if elapsed > 0 else 0.0,
+        )
+    )
+    if review:
+        print("Exams with low confidence, to be reviewed:")
+        for result in review:
+            print("    exam {}: {}".format(result.exam_id, result.image_file))
+    if failed:
+        print("Failed images:")
+        for result in failed:
+            print("    " + result.image_file)
+
+
+def main():
+    args = _cmd_options()
+    image_files = find_images(args.images)
+    if not image_files:
+        print("No images found", file=sys.stderr)
+        sys.exit(1)
+    session = _open_session(args.session)
+    grader = _create_grader(session, args)
+    failed = []
+    review = []
+    start = time.time()
+    try:
+        for result in grader.grade(image_files):
+            _print_result(result, args.quiet)
+            if not result.success:
+                failed.append(result)
+            elif not result.confident:
+                review.append(result)
+    finally:
+        session.save_legacy_answers()
+        session.close()
+    elapsed = time.time() - start
+    if args.profile_file is not None:
+        grader.profiler.save(args.profile_file)
+    _print_summary(image_files, failed, review, elapsed)
+    if failed:
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,7 @@
 #
 
 import cv2
+import numpy as np
 
 from . import geometry
 from . import utils
@@ -56,14 +57,175 @@ class CellGeometry:
         return (self.plu, self.pru, self.pld, self.prd)
 
 
+class CellGrid:
+    """Geometry of the answer cells of an exam, kept in arrays.
+
+    `corners` is an integer array of shape (num_questions, num_choices,
+    4, 2) with the corners (plu, pru, pld, prd) of each cell, `centers`
+    has shape (num_questions, num_choices, 2) and `diagonals` shape
+    (num_questions, num_choices). When questions have different
+    numbers of choices, arrays are sized for the largest one and
+    `choices[i]` tells how many cells question i has.
+
+    For compatibility, a grid behaves as the bi-dimensional list of
+    `CellGeometry` objects it replaces: `grid[i]` returns the list of
+    cells of question i.
+
+    """
+
+    def __init__(self, corners, choices=None, centers=None, diagonals=None):
+        self.corners = np.asarray(corners, dtype=np.int32)
+        if self.corners.ndim != 4:
+            self.corners = self.corners.reshape((len(corners), -1, 4, 2))
+        num_questions, num_choices = self.corners.shape[:2]
+        if choices is None:
+            choices = [num_choices] * num_questions
+        self.choices = np.array(choices, dtype=np.int32).reshape(num_questions)
+        plu = self.corners[:, :, 0].astype(float)
+        prd = self.corners[:, :, 3].astype(float)
+        if centers is None:
+            centers = np.rint((plu + prd) / 2)
+        self.centers = (
+            np.asarray(centers)
+            .astype(np.int32)
+            .reshape((num_questions, num_choices, 2))
+        )
+        if diagonals is None:
+            diagonals = np.sqrt(np.sum((plu - prd) ** 2, axis=2))
+        self.diagonals = np.asarray(diagonals, dtype=float).reshape(
+            (num_questions, num_choices)
+        )
+
+    @classmethod
+    def from_corner_matrixes(cls, corner_matrixes):
+        """Creates the grid of the tables with the given cell corners.
+
+        Each corner matrix has a row of points per horizontal line of
+        its table. Questions are numbered table by table.
+
+        """
+        tables = [np.array(corners, dtype=np.int32) for corners in corner_matrixes]
+        num_choices = max([table.shape[1] - 1 for table in tables], default=0)
+        corners = []
+        choices = []
+        for table in tables:
+            cells = np.stack(
+                (table[:-1, :-1], table[:-1, 1:], table[1:, :-1], table[1:, 1:]),
+                axis=2,
+            )
+            padding = num_choices - cells.shape[1]
+            if padding:
+                cells = np.pad(cells, ((0, 0), (0, padding), (0, 0), (0, 0)), "edge")
+            corners.append(cells)
+            choices.extend([table.shape[1] - 1] * cells.shape[0])
+        if corners:
+            corners = np.concatenate(corners)
+        else:
+            corners = np.zeros((0, 0, 4, 2), dtype=np.int32)
+        return cls(corners, choices=choices)
+
+    @classmethod
+    def from_cells(cls, cells):
+        """Creates the grid from a bi-dimensional list of `CellGeometry`."""
+        num_choices = max([len(row) for row in cells], default=0)
+        shape = (len(cells), num_choices)
+        corners = np.zeros(shape + (4, 2), dtype=np.int32)
+        centers = np.zeros(shape + (2,), dtype=np.int32)
+        diagonals = np.zeros(shape)
+        for i, row in enumerate(cells):
+            for j, cell in enumerate(row):
+                corners[i, j] = cell.corners()
+                centers[i, j] = cell.center
+                diagonals[i, j] = cell.diagonal
+        choices = [len(row) for row in cells]
+        return cls(corners, choices=choices, centers=centers, diagonals=diagonals)
+
+    def __len__(self):
+        return len(self.choices)
+
+    def __getitem__(self, question):
+        return [self.cell(question, choice) for choice in range(self.choices[question])]
+
+    def __iter__(self):
+        for question in range(len(self)):
+            yield self[question]
+
+    def cell(self, question, choice):
+        """Returns a `CellGeometry` object for the given cell."""
+        plu, pru, pld, prd = [
+            tuple(point) for point in self.corners[question, choice].tolist()
+        ]
+        return CellGeometry(
+            plu,
+            pru,
+            pld,
+            prd,
+            self.center(question, choice),
+            float(self.diagonals[question, choice]),
+        )
+
+    def center(self, question, choice):
+        """Returns the center of the cell as a tuple (x, y)."""
+        return tuple(self.centers[question, choice].tolist())
+
+    def mask(self):
+        """Returns a boolean array that tells which cells exist."""
+        return np.arange(self.corners.shape[1]) < self.choices[:, np.newaxis]
+
+    def take(self, questions):
+        """Returns a new grid with the given questions, in that order."""
+        questions = list(questions)
+        return CellGrid(
+            self.corners[questions],
+            choices=self.choices[questions],
+            centers=self.centers[questions],
+            diagonals=self.diagonals[questions],
+        )
+
+    def closest_cell(self, point):
+        """Returns (question, choice, distance) of the closest cell center.
+
+        Returns (None, None, inf) if the grid has no cells.
+
+        """
+        distances = np.sqrt(np.sum((self.centers - point) ** 2, axis=2))
+        distances[~self.mask()] = np.inf
+        if distances.size == 0 or np.isinf(distances.min()):
+            return None, None, float("inf")
+        question, choice = np.unravel_index(np.argmin(distances), distances.shape)
+        return int(question), int(choice), float(distances[question, choice])
+
+
 class ExamDecisions:
     def __init__(
-        self, success, answers, detected_id, id_scores, model=None, infobits=None
+        self,
+        success,
+        answers,
+        detected_id,
+        id_scores,
+        model=None,
+        infobits=None,
+        cell_margins=None,
+        id_margins=None,
     ):
+        """Creates a new ExamDecisions object.
+
+        `cell_margins`: list with the classification margins of the
+                        cells of each question, or None if unknown.
+        `id_margins`: list with the classification margin of each
+                      digit of the student id, or None if unknown.
+
+        Margins are the values of the decision function of the
+        classifiers. The smaller they are, the closer the cell or
+        digit is to be classified the other way.
+
+        """
         self.success = success
         self.answers = answers
         self.detected_id = detected_id
         self.id_scores = id_scores
+        self.cell_margins = cell_margins
+        self.id_margins = id_margins
         if model is not None:
             self.model = model
         elif infobits:
@@ -73,6 +235,29 @@ class ExamDecisions:
         self.student = None
         self.students_rank = []
 
+    @property
+    def confidence(self):
+        """Smallest margin among the cells and id digits, or None if unknown.
+
+        The exam is as reliable as its least reliable decision.
+
+        """
+        margins = []
+        if self.cell_margins:
+            margins.extend(min(m) for m in self.cell_margins if m)
+        if self.id_margins:
+            margins.append(min(self.id_margins))
+        return min(margins) if margins else None
+
+    def is_confident(self, min_margin):
+        """Tells whether every margin is at least `min_margin`.
+
+        Decisions without margins are not considered confident.
+
+        """
+        confidence = self.confidence
+        return confidence is not None and confidence >= min_margin
+
     def change_answer(self, question, answer):
         self.answers[question] = answer
 
@@ -90,9 +275,10 @@ class ExamCapture:
         """Creates a new ExamCapture object.
 
         `image`: original capture of the exam (as captured by opencv);
-        `answer_cells`: bi-dimensional list of num_questions x num_choices
-                        CellGeometry objects. Each one represents an
-                        answer cell.
+        `answer_cells`: CellGrid with the answer cells. A
+                        bi-dimensional list of num_questions x
+                        num_choices CellGeometry objects is also
+                        accepted, and converted to a CellGrid.
         `id_cells`: list of num_digits CellGeometry objects. Each one
                     represents a digit cell for the student id (from
                     left to right).
@@ -102,6 +288,8 @@ class ExamCapture:
         """
         self.image_raw = image
         self.image_drawn = None
+        if answer_cells is not None and not isinstance(answer_cells, CellGrid):
+            answer_cells = CellGrid.from_cells(answer_cells)
         self.answer_cells = answer_cells
         self.id_cells = id_cells
         self.progress = progress
@@ -119,20 +307,11 @@ class ExamCapture:
         Returns (num_question, num_choice) or None if no cell corresponds.
 
         """
-        min_dst = float("inf")
-        num_question = None
-        num_choice = None
-        closest_cell = None
-        for i, cells in enumerate(self.answer_cells):
-            for j, cell in enumerate(cells):
-                dst = geometry.distance(point, cell.center)
-                if dst < min_dst:
-                    min_dst = dst
-                    num_question = i
-                    num_choice = j + 1
-                    closest_cell = cell
-        if closest_cell is not None and min_dst <= closest_cell.diagonal / 2:
-            return (num_question, num_choice)
+        question, choice, distance = self.answer_cells.closest_cell(point)
+        if question is not None and (
+            distance <= self.answer_cells.diagonals[question, choice] / 2
+        ):
+            return (question, choice + 1)
         else:
             return (None, None)
 
@@ -180,36 +359,52 @@ class ExamCapture:
         cv2.rectangle(self.image_drawn, p0, p1, _color_blue, thickness=-1)
 
     def _draw_answers_solutions(self, score):
-        for answer, question_solutions, status, cells in zip(
-            score.answers, score.solutions, score.answer_status, self.answer_cells
+        for question, answer, question_solutions, status in zip(
+            range(len(self.answer_cells)),
+            score.answers,
+            score.solutions,
+            score.answer_status,
         ):
             if status == scoring.QuestionScores.CORRECT:
-                self._draw_cell_circle(cells[answer - 1], _color_good)
+                self._draw_cell_circle(question, answer - 1, _color_good)
             elif status == scoring.QuestionScores.INCORRECT:
-                self._draw_cell_circle(cells[answer - 1], _color_bad)
+                self._draw_cell_circle(question, answer - 1, _color_bad)
                 for solution in question_solutions:
-                    self._draw_cell_center(cells[solution - 1], _color_dot_bad)
+                    self._draw_cell_center(question, solution - 1, _color_dot_bad)
             elif status == scoring.QuestionScores.BLANK:
                 for solution in question_solutions:
-                    self._draw_cell_center(cells[solution - 1], _color_dot_blank)
+                    self._draw_cell_center(question, solution - 1, _color_dot_blank)
             elif status == scoring.QuestionScores.VOID:
-                self._draw_void_question(cells)
+                self._draw_void_question(question)
 
     def _draw_answers_no_solutions(self, score):
-        for answer, cells in zip(score.answers, self.answer_cells):
-            if answer > 0:
-                self._draw_cell_circle(cells[answer - 1], _color_blue)
-
-    def _draw_cell_circle(self, cell, color):
-        radius = int(round(cell.diagonal / 3.5))
-        cv2.circle(self.image_drawn, cell.center, radius, color, thickness=2)
-
-    def _draw_cell_center(self, cell, color):
-        cv2.circle(self.image_drawn, cell.center, 4, color, thickness=-1)
-
-    def _draw_void_question(self, cells):
+        answers = np.array(score.answers[: len(self.answer_cells)], dtype=int)
+        questions = np.flatnonzero(answers > 0)
+        choices = answers[questions] - 1
+        centers = self.answer_cells.centers[questions, choices].tolist()
+        radiuses = np.rint(self.answer_cells.diagonals[questions, choices] / 3.5)
+        for center, radius in zip(centers, radiuses.astype(int).tolist()):
+            cv2.circle(
+                self.image_drawn, tuple(center), radius, _color_blue, thickness=2
+            )
+
+    def _draw_cell_circle(self, question, choice, color):
+        radius = int(round(self.answer_cells.diagonals[question, choice] / 3.5))
+        center = self.answer_cells.center(question, choice)
+        cv2.circle(self.image_drawn, center, radius, color, thickness=2)
+
+    def _draw_cell_center(self, question, choice, color):
+        center = self.answer_cells.center(question, choice)
+        cv2.circle(self.image_drawn, center, 4, color, thickness=-1)
+
+    def _draw_void_question(self, question):
+        cells = self.answer_cells
         cv2.line(
-            self.image_drawn, cells[0].center, cells[-1].center, _color_bad, thickness=3
+            self.image_drawn,
+            cells.center(question, 0),
+            cells.center(question, cells.choices[question] - 1),
+            _color_bad,
+            thickness=3,
         )
 
 
@@ -19,6 +19,12 @@ import math
 import copy
 import sys
 import itertools
+import collections
+import csv
+import json
+import time
+import threading
+import concurrent.futures
 
 import cv2
 import numpy as np
@@ -28,6 +34,7 @@ from . import geometry as g
 from . import capture
 from . import sessiondb
 from . import images
+from . import sources
 from . import utils
 from .ocr import classifiers
 from .ocr import sample
@@ -41,8 +48,13 @@ param_collapse_lines_maxgap = 7
 param_directions_threshold = 0.4
 param_hough_thresholds = [280, 260, 240, 225, 210, 195, 180, 160, 140, 120]
 param_failures_threshold = 10
+param_sweep_workers = 4
+param_sweep_skip_frames = 4
 param_check_corners_tolerance_mul = 6
 
+# Classification margin below which a decision is not reliable
+param_min_confidence_margin = 0.2
+
 # Parameters for the infobits masks
 param_bit_mask_threshold = 0.25
 param_bit_mask_radius_multiplier = 0.333
@@ -54,6 +66,31 @@ param_id_boxes_energy_break = 0.99
 param_id_boxes_min_height = 15
 param_id_boxes_discard_distance = 20
 
+# Parameters for tracking tables across frames
+param_tracking_rho_range = 4
+param_tracking_theta_range = 0.02
+param_tracking_theta_step = 0.01
+param_tracking_samples = 100
+param_tracking_min_score = 0.5
+
+# Parameters for refining lines found in a downscaled image
+param_pyramid_theta_range = 0.01
+param_pyramid_theta_step = 0.0025
+
+# Parameters for the background frame grabber
+param_grabber_buffers = 2
+param_grabber_first_frame_timeout = 2.0
+param_grabber_retry_delay = 0.05
+param_grabber_stop_timeout = 1.0
+
+# Parameters for detecting changes between frames
+param_change_signature_size = (32, 24)
+param_change_pixel_threshold = 10
+param_change_fraction = 0.01
+
+# Number of pre-processed frames kept by the detection context
+param_pre_process_cache_size = 4
+
 # Other parameters
 param_error_log = "eyegrade-errors.log"
 param_error_image_pattern = "error-%s.png"
@@ -75,6 +112,9 @@ class ExamDetector:
         "capture-proc-ipl": None,
         "error-logging": False,
         "logging-dir": ".",
+        "show-profile": False,
+        "rectify-tables": False,
+        "detection-width": None,
     }
 
     @classmethod
@@ -84,17 +124,23 @@ class ExamDetector:
     def __init__(self, dimensions, context, options, image_raw=None):
         self.options = options
         self.context = context
+        self.timings = {}
+        self.image_search = None
+        self.search_scale = 1.0
+        self.sweep_skipped = False
+        self.threshold_changed = False
+        self._hough_threshold = None
         if image_raw is not None:
             self.image_raw = image_raw
-            self.image_proc = pre_process(self.image_raw)
+            self.image_proc = self._pre_process()
         elif not self.options["capture-from-file"]:
             self.image_raw = self.context.capture()
-            self.image_proc = pre_process(self.image_raw)
+            self.image_proc = self._pre_process()
         elif self.options["capture-raw-file"] is not None:
             self.image_raw = images.load_image(self.options["capture-raw-file"])
             if self.image_raw is None:
                 raise utils.EyegradeException("", key="load_image")
-            self.image_proc = pre_process(self.image_raw)
+            self.image_proc = self._pre_process()
         elif self.options["capture-proc-file"] is not None:
             self.image_raw = images.load_image(self.options["capture-proc-file"])
             self.image_proc = images.rgb_to_gray(self.image_raw)
@@ -121,6 +167,23 @@ class ExamDetector:
         self.decisions = None
         self.capture = None
 
+    def _pre_process(self):
+        """Pre-processes the raw image.
+
+        With the "detection-width" option, large images are also
+        pre-processed at that width, for searching the tables.
+
+        """
+        scale = self._search_scale()
+        with self._stage("pre_process"):
+            image_proc, self.image_search = self.context.pre_process(
+                self.image_raw, scale
+            )
+        if self.image_search is not None:
+            width = images.get_width(self.image_search)
+            self.search_scale = width / images.get_width(image_proc)
+        return image_proc
+
     def detect_safe(self):
         try:
             return self.detect()
@@ -129,86 +192,133 @@ class ExamDetector:
             self.status["cells"] = False
             self.status["infobits"] = False
             self.context.notify_failure()
+            self._check_threshold_change()
+            self.context.remember_axes(None)
             if self.options["error-logging"]:
                 exc_type, exc_value, exc_traceback = sys.exc_info()
                 self._write_error_trace(exc_type, exc_value, exc_traceback)
             # else... silence the exception, and try with the next capture
 
+    def worth_retrying(self):
+        """Tells whether detecting the same frame again might succeed.
+
+        It happens when the tables were found but a later step failed,
+        because the context moves to another Hough threshold after
+        some failures, when the threshold sweep was skipped, and when
+        the context moved to another Hough threshold after this
+        detection.
+
+        """
+        return not self.success and (
+            self.status["boxes"] or self.sweep_skipped or self.threshold_changed
+        )
+
     def detect(self):
+        start = time.perf_counter() if self.context.profiler is not None else None
+        self._hough_threshold = self.context.get_hough_threshold()
         answers = None
-        detected_id = None
-        id_scores = None
+        cell_margins = None
         bits = None
         answer_cells = None
         id_cells = None
         id_hlines = None
+        detected_id, id_scores, id_margins = None, None, None
         success = False
-        axes = None
-        lines = detect_lines(self.image_proc, self.context.get_hough_threshold())
-        if len(lines) >= 2:
-            self.status["lines"] = True
-            axes = detect_boxes(lines, self.dimensions)
-        if axes is None:
-            self.context.next_hough_threshold()
-        else:
-            self.status["boxes"] = True
-            axes = filter_axes(
-                axes,
-                images.get_width(self.image_raw),
-                images.get_height(self.image_raw),
-                self.options["read-id"],
-            )
-            corner_matrixes = cell_corners(
-                axes[1][1],
-                axes[0][1],
-                images.get_width(self.image_raw),
-                images.get_height(self.image_raw),
-                self.dimensions,
-            )
-            if len(corner_matrixes) > 0:
-                self.status["cells"] = True
-                answer_cells = self._answer_cells_geometry(corner_matrixes)
-                answers = self._decide_cells(answer_cells)
-                if self.options["infobits"]:
-                    bits = read_infobits(self.image_proc, corner_matrixes)
-                    if bits is not None:
-                        self.status["infobits"] = True
-                        success = True
-                    else:
-                        success = False
-                else:
-                    success = True
-                if success and self.options["read-id"]:
-                    id_hlines, id_cells = id_boxes_geometry(
-                        self.image_proc,
-                        self.options["id-num-digits"],
-                        axes[1][1],
-                        self.dimensions,
-                    )
-                    if id_hlines:
-                        self.status["id-box-hlines"] = True
-                    if not id_cells:
-                        success = False
-                    else:
-                        self.status["id-box"] = True
-                        detected_id, id_scores = self._detect_id(id_cells)
-                else:
-                    id_cells = []
+        lines, axes, corner_matrixes = self._track_tables()
+        tracked = axes is not None
+        if not tracked:
+            lines, axes, corner_matrixes = self._search_tables()
+        if axes is not None and len(corner_matrixes) > 0:
+            self.status["cells"] = True
+            answer_cells = self._answer_cells_geometry(corner_matrixes)
+            answers, cell_margins = self._decide_answers(corner_matrixes, answer_cells)
+            success, bits = self._read_infobits(corner_matrixes)
+            if success and self.options["read-id"]:
+                id_hlines, id_cells, id_result = self._read_id(axes)
+                detected_id, id_scores, id_margins = id_result
+                success = bool(id_cells)
+            else:
+                id_cells = []
+        self._notify_result(success, tracked, axes, corner_matrixes)
+        self._draw_detection(lines, axes, corner_matrixes, id_hlines, id_cells)
+        if start is not None:
+            self._record_timing("detect", time.perf_counter() - start)
+            if self.options["show-profile"]:
+                self._draw_timings()
+        self.decisions = capture.ExamDecisions(
+            success,
+            answers,
+            detected_id,
+            id_scores,
+            infobits=bits,
+            cell_margins=cell_margins,
+            id_margins=id_margins,
+        )
+        self.capture = capture.ExamCapture(
+            self.image_to_show, answer_cells, id_cells, self._compute_progress()
+        )
+        self.success = success
+        return success
+
+    def _decide_answers(self, corner_matrixes, answer_cells):
+        """Returns the answers and cell margins of the tables."""
+        with self._stage("decide_cells"):
+            if self.options["rectify-tables"]:
+                return self._decide_tables(corner_matrixes)
+            else:
+                return self._decide_cells(answer_cells)
+
+    def _read_infobits(self, corner_matrixes):
+        """Returns a tuple (success, bits).
+
+        Detection fails only when the "infobits" option is set and the
+        bits cannot be read.
+
+        """
+        if not self.options["infobits"]:
+            return True, None
+        with self._stage("read_infobits"):
+            bits = read_infobits(self.image_proc, corner_matrixes)
+        if bits is None:
+            return False, None
+        self.status["infobits"] = True
+        return True, bits
+
+    def _read_id(self, axes):
+        """Locates the id box and reads the student id in it.
+
+        Returns a tuple (id_hlines, id_cells, id_result), where
+        id_result is the tuple (detected_id, id_scores, id_margins),
+        with None values when the box is not found.
+
+        """
+        with self._stage("id_boxes_geometry"):
+            id_hlines, id_cells = self._id_boxes_geometry(axes[1][1])
+        if id_hlines:
+            self.status["id-box-hlines"] = True
+        if not id_cells:
+            return id_hlines, id_cells, (None, None, None)
+        self.status["id-box"] = True
+        with self._stage("detect_id"):
+            return id_hlines, id_cells, self._detect_id(id_cells)
+
+    def _notify_result(self, success, tracked, axes, corner_matrixes):
+        """Lets the context adapt its threshold and tracking to the result."""
         if success:
             self.context.notify_success()
         else:
             self.context.notify_failure()
-        # Draw debug information on the capture
+        self._check_threshold_change()
+        # After a failure with tracked tables, search them again from scratch
+        if success or (corner_matrixes and not tracked):
+            self.context.remember_axes(axes)
+        else:
+            self.context.remember_axes(None)
+
+    def _draw_detection(self, lines, axes, corner_matrixes, id_hlines, id_cells):
+        """Draws debug information on the capture."""
         if self.options["show-lines"]:
-            if self.status["cells"]:
-                for line in axes[0][1]:
-                    images.draw_line(self.image_to_show, line, (255, 0, 0))
-                for line in axes[1][1]:
-                    images.draw_line(self.image_to_show, line, (255, 0, 255))
-                self._draw_cell_corners(corner_matrixes)
-            elif self.status["lines"]:
-                for line in lines:
-                    images.draw_line(self.image_to_show, line, (255, 0, 0))
+            self._draw_lines(lines, axes, corner_matrixes)
             if id_hlines:
                 for line in id_hlines:
                     images.draw_line(self.image_to_show, line, (255, 255, 0))
@@ -218,26 +328,168 @@ class ExamDetector:
                         images.draw_point(self.image_to_show, corner)
         if self.options["show-status"]:
             self._draw_status_flags()
-        self.decisions = capture.ExamDecisions(
-            success, answers, detected_id, id_scores, infobits=bits
+
+    def _draw_lines(self, lines, axes, corner_matrixes):
+        if self.status["cells"]:
+            for line in axes[0][1]:
+                images.draw_line(self.image_to_show, line, (255, 0, 0))
+            for line in axes[1][1]:
+                images.draw_line(self.image_to_show, line, (255, 0, 255))
+            self._draw_cell_corners(corner_matrixes)
+        elif self.status["lines"]:
+            for line in lines:
+                images.draw_line(self.image_to_show, line, (255, 0, 0))
+
+    def _check_threshold_change(self):
+        self.threshold_changed = (
+            self.context.get_hough_threshold() != self._hough_threshold
         )
-        self.capture = capture.ExamCapture(
-            self.image_to_show, answer_cells, id_cells, self._compute_progress()
+
+    def _track_tables(self):
+        """Looks for the tables where they were in the previous frame.
+
+        Returns a tuple (lines, axes, corner_matrixes), with axes None
+        if tracking is disabled, there is nothing to track or the
+        tables are not found.
+
+        """
+        # Read once, because other detections may replace them meanwhile
+        tracked_axes = self.context.tracked_axes
+        if tracked_axes is None:
+            return [], None, []
+        with self._stage("track_axes"):
+            axes = track_axes(self.image_proc, tracked_axes, self.dimensions)
+        if axes is None:
+            return [], None, []
+        corner_matrixes = self._cell_corners(axes)
+        if not corner_matrixes:
+            return [], None, []
+        self.status["lines"] = True
+        self.status["boxes"] = True
+        return axes[1][1] + axes[0][1], axes, corner_matrixes
+
+    def _search_tables(self):
+        """Looks for the tables in the whole image with the Hough transform.
+
+        With the "detection-width" option, large images are searched
+        in a downscaled copy, and the lines found are mapped back and
+        refined on the full resolution image.
+
+        Returns a tuple (lines, axes, corner_matrixes), with axes None
+        if the tables are not found.
+
+        """
+        if self.image_search is not None:
+            image = self.image_search
+        else:
+            image = self.image_proc
+        scale = self.search_scale
+        height, width = image.shape[:2]
+        axes = None
+        corner_matrixes = []
+        hough_threshold = self.context.get_hough_threshold()
+        with self._stage("detect_lines"):
+            lines = detect_lines(image, hough_threshold)
+        if len(lines) >= 2:
+            self.status["lines"] = True
+            with self._stage("detect_boxes"):
+                axes = detect_boxes(lines, self.dimensions)
+        if axes is None:
+            self.context.next_hough_threshold()
+        else:
+            self.status["boxes"] = True
+            with self._stage("filter_axes"):
+                axes = filter_axes(axes, width, height, self.options["read-id"])
+            with self._stage("cell_corners"):
+                corner_matrixes = cell_corners(
+                    axes[1][1], axes[0][1], width, height, self.dimensions
+                )
+        if not corner_matrixes and self.context.threshold_sweep:
+            self.sweep_skipped = self.context.skip_sweep()
+            if not self.sweep_skipped:
+                with self._stage("sweep_thresholds"):
+                    found = self.context.sweep_hough_thresholds(
+                        image, self.dimensions, self.options["read-id"], hough_threshold
+                    )
+                if found is not None:
+                    self.status["lines"] = True
+                    self.status["boxes"] = True
+                    lines, axes, corner_matrixes = found
+        if scale < 1.0:
+            lines = scale_lines(lines, 1 / scale)
+            if corner_matrixes:
+                axes = [(theta, scale_lines(ax, 1 / scale)) for theta, ax in axes]
+                with self._stage("refine_axes"):
+                    refined = track_axes(
+                        self.image_proc,
+                        axes,
+                        self.dimensions,
+                        rho_range=int(math.ceil(1 / scale)) + 1,
+                        theta_range=param_pyramid_theta_range,
+                        theta_step=param_pyramid_theta_step,
+                    )
+                if refined is not None:
+                    axes = refined
+                corner_matrixes = self._cell_corners(axes)
+        return lines, axes, corner_matrixes
+
+    def _id_boxes_geometry(self, hlines):
+        """Locates the id box, in the downscaled image if there is one."""
+        if self.image_search is None:
+            return id_boxes_geometry(
+                self.image_proc, self.options["id-num-digits"], hlines, self.dimensions
+            )
+        scale = self.search_scale
+        id_hlines, id_cells = id_boxes_geometry(
+            self.image_search,
+            self.options["id-num-digits"],
+            scale_lines(hlines, scale),
+            self.dimensions,
         )
-        self.success = success
-        return success
+        if id_hlines:
+            id_hlines = scale_lines(id_hlines, 1 / scale)
+        if id_cells:
+            id_cells = [
+                capture.CellGeometry(
+                    *[g.round_point((x / scale, y / scale)) for x, y in cell.corners()],
+                    None,
+                    None
+                )
+                for cell in id_cells
+            ]
+        return id_hlines, id_cells
+
+    def _search_scale(self):
+        """Returns the scale of the image in which tables are searched."""
+        max_width = self.options["detection-width"]
+        width = images.get_width(self.image_raw)
+        if max_width is None or width <= max_width:
+            return 1.0
+        else:
+            return max_width / width
+
+    def _cell_corners(self, axes):
+        with self._stage("cell_corners"):
+            return cell_corners(
+                axes[1][1],
+                axes[0][1],
+                images.get_width(self.image_raw),
+                images.get_height(self.image_raw),
+                self.dimensions,
+            )
 
     def detect_manual(self, manual_points):
         """Called when cell corners are obtained from manual detection."""
         bits = None
         success = False
         answers = None
+        cell_margins = None
         answer_cells = None
         corner_matrixes = process_box_corners(manual_points, self.dimensions)
         if corner_matrixes != []:
             self.status["cells"] = True
             answer_cells = self._answer_cells_geometry(corner_matrixes)
-            answers = self._decide_cells(answer_cells)
+            answers, cell_margins = self._decide_cells(answer_cells)
             if self.options["infobits"]:
                 bits = read_infobits(self.image_proc, corner_matrixes)
                 if bits is not None:
@@ -249,7 +501,12 @@ class ExamDetector:
         detected_id = None
         id_scores = None
         self.decisions = capture.ExamDecisions(
-            success, answers, detected_id, id_scores, infobits=bits
+            success,
+            answers,
+            detected_id,
+            id_scores,
+            infobits=bits,
+            cell_margins=cell_margins,
         )
         self.capture = capture.ExamCapture(
             self.image_to_show, answer_cells, id_cells, 1.0
@@ -272,6 +529,21 @@ class ExamDetector:
             if axes is not None:
                 self.exam_detected = True
 
+    def _stage(self, name):
+        """Returns a context manager that times the given detection stage.
+
+        Time is only measured when the context has a profiler.
+
+        """
+        if self.context.profiler is None:
+            return _null_stage_timer
+        else:
+            return _StageTimer(self, name)
+
+    def _record_timing(self, name, elapsed):
+        self.timings[name] = elapsed
+        self.context.profiler.record(name, elapsed)
+
     def _write_error_trace(self, exc_type, exc_value, exc_traceback):
         import datetime
         import re
@@ -296,40 +568,47 @@ class ExamDetector:
             traceback.print_exception(exc_type, exc_value, exc_traceback)
 
     def _answer_cells_geometry(self, corner_matrixes):
-        cells = []
-        for corners in corner_matrixes:
-            for i in range(0, len(corners) - 1):
-                row = []
-                for j in range(0, len(corners[0]) - 1):
-                    cell = capture.CellGeometry(
-                        corners[i][j],
-                        corners[i][j + 1],
-                        corners[i + 1][j],
-                        corners[i + 1][j + 1],
-                        None,
-                        None,
-                    )
-                    row.append(cell)
-                cells.append(row)
+        cells = capture.CellGrid.from_corner_matrixes(corner_matrixes)
         if self.options["left-to-right-numbering"]:
             cells = self._set_left_to_right(cells)
         return cells
 
     def _decide_cells(self, answer_cells):
-        decisions = []
-        for row in answer_cells:
-            row_decisions = []
-            for cell in row:
-                corners = np.array([cell.plu, cell.pru, cell.pld, cell.prd])
-                samp = sample.CrossSampleFromCam(corners, self.image_proc)
-                decision = self.context.crosses_classifier.is_cross(samp)
-                row_decisions.append(decision)
-            decisions.append(decide_answer(row_decisions))
-        return decisions
+        """Returns the answers and the margins of the cells of each question."""
+        # All the cells are classified at once, with a single prediction
+        samples = [
+            sample.CrossSampleFromCam(corners, self.image_proc)
+            for corners in answer_cells.corners[answer_cells.mask()]
+        ]
+        crosses, margins = self.context.crosses_classifier.are_crosses_with_margins(
+            samples
+        )
+        return _split_decisions(crosses, margins, answer_cells.choices.tolist())
+
+    def _decide_tables(self, corner_matrixes):
+        """Same as `_decide_cells`, but rectifying each table at once."""
+        classifier = self.context.crosses_classifier
+        features = np.concatenate(
+            [
+                classifier.features_extractor.extract_table(self.image_proc, corners)
+                for corners in corner_matrixes
+            ]
+        )
+        labels, margins = classifier.predict_margins(features)
+        choices = [
+            len(corners[0]) - 1
+            for corners in corner_matrixes
+            for _ in range(len(corners) - 1)
+        ]
+        decisions, cell_margins = _split_decisions(labels == 1, margins, choices)
+        if self.options["left-to-right-numbering"]:
+            decisions = self._set_left_to_right(decisions)
+            cell_margins = self._set_left_to_right(cell_margins)
+        return decisions, cell_margins
 
     def _set_left_to_right(self, cells):
-        """Sets left to right order in cell geometry."""
-        cells_transposed = []
+        """Sets left to right order in cell geometry or decisions."""
+        order = []
         num_rows = max([questions for choices, questions in self.dimensions])
         heads = [1]
         for choices, questions in self.dimensions:
@@ -339,8 +618,11 @@ class ExamDetector:
             for column in range(0, len(self.dimensions)):
                 pos = heads[column] + row
                 if pos < heads[column + 1]:
-                    cells_transposed.append(cells[pos - 1])
-        return cells_transposed
+                    order.append(pos - 1)
+        if isinstance(cells, capture.CellGrid):
+            return cells.take(order)
+        else:
+            return [cells[i] for i in order]
 
     def _compute_progress(self):
         progress = 0
@@ -366,16 +648,20 @@ class ExamDetector:
     def _detect_id(self, id_cells):
         if id_cells is None:
             detected_id = None
+        samples = [
+            sample.DigitSampleFromCam(
+                np.array([cell.plu, cell.pru, cell.pld, cell.prd]), self.image_proc
+            )
+            for cell in id_cells
+        ]
         digits = []
         id_scores = []
-        for cell in id_cells:
-            corners = np.array([cell.plu, cell.pru, cell.pld, cell.prd])
-            samp = sample.DigitSampleFromCam(corners, self.image_proc)
-            digit, scores = self.context.ocr.classify_digit(samp)
+        results, margins = self.context.ocr.classify_digits_with_margins(samples)
+        for digit, scores in results:
             digits.append(digit)
             id_scores.append(scores)
         detected_id = "".join([str(d) if d is not None else "0" for d in digits])
-        return detected_id, id_scores
+        return detected_id, id_scores, margins.tolist()
 
     def _draw_status_flags(self):
         flags = []
@@ -395,6 +681,15 @@ class ExamDetector:
             images.draw_text(self.image_to_show, letter, color, (x, y))
             x += width
 
+    def _draw_timings(self):
+        y = 20
+        for name, elapsed in self.timings.items():
+            text = "{}: {:.1f} ms".format(name, 1000 * elapsed)
+            images.draw_text(
+                self.image_to_show, text, (0, 0, 255), (5, y), scale=0.5, thickness=1
+            )
+            y += 18
+
     def _draw_hough_threshold(self):
         pos = (images.get_width(self.image_to_show) - 77, 110)
         images.draw_text(
@@ -408,6 +703,129 @@ class ExamDetector:
                     images.draw_point(self.image_to_show, c)
 
 
+class _StageTimer:
+    """Context manager that measures the wall time of a detection stage."""
+
+    def __init__(self, detector, name):
+        self.detector = detector
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.detector._record_timing(self.name, time.perf_counter() - self.start)
+
+
+class _NullStageTimer:
+    """Context manager that does nothing, used when profiling is disabled."""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_null_stage_timer = _NullStageTimer()
+
+
+class DetectionProfiler:
+    """Aggregates the time spent in each stage of detection.
+
+    For every stage it keeps the number of runs, total, minimum and
+    maximum time, and a histogram with the bins in `bin_edges`
+    (milliseconds, the last bin being open-ended).
+
+    """
+
+    bin_edges = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+
+    def record(self, name, elapsed):
+        """Adds a run of `elapsed` seconds to the stage `name`."""
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = {
+                "count": 0,
+                "total": 0.0,
+                "min": math.inf,
+                "max": 0.0,
+                "histogram": [0] * (len(self.bin_edges) + 1),
+            }
+            self.stages[name] = stats
+        stats["count"] += 1
+        stats["total"] += elapsed
+        stats["min"] = min(stats["min"], elapsed)
+        stats["max"] = max(stats["max"], elapsed)
+        stats["histogram"][self._bin(1000 * elapsed)] += 1
+
+    def merge(self, other):
+        """Adds the statistics of another profiler to this one."""
+        for name, other_stats in other.stages.items():
+            stats = self.stages.get(name)
+            if stats is None:
+                self.stages[name] = copy.deepcopy(other_stats)
+            else:
+                stats["count"] += other_stats["count"]
+                stats["total"] += other_stats["total"]
+                stats["min"] = min(stats["min"], other_stats["min"])
+                stats["max"] = max(stats["max"], other_stats["max"])
+                stats["histogram"] = [
+                    a + b for a, b in zip(stats["histogram"], other_stats["histogram"])
+                ]
+
+    def reset(self):
+        self.stages.clear()
+
+    def summary(self):
+        """Returns a dictionary with the statistics of every stage in ms."""
+        summary = collections.OrderedDict()
+        for name, stats in self.stages.items():
+            summary[name] = {
+                "count": stats["count"],
+                "total_ms": 1000 * stats["total"],
+                "mean_ms": 1000 * stats["total"] / stats["count"],
+                "min_ms": 1000 * stats["min"],
+                "max_ms": 1000 * stats["max"],
+                "histogram": list(stats["histogram"]),
+            }
+        return summary
+
+    def save_json(self, filename):
+        data = {"bin_edges_ms": list(self.bin_edges), "stages": self.summary()}
+        with open(filename, mode="w") as f:
+            json.dump(data, f, indent=4)
+
+    def save_csv(self, filename):
+        columns = ["count", "total_ms", "mean_ms", "min_ms", "max_ms"]
+        bins = ["<{}ms".format(edge) for edge in self.bin_edges]
+        bins.append(">={}ms".format(self.bin_edges[-1]))
+        with open(filename, mode="w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["stage"] + columns + bins)
+            for name, stats in self.summary().items():
+                writer.writerow(
+                    [name] + [stats[key] for key in columns] + stats["histogram"]
+                )
+
+    def save(self, filename):
+        """Saves as CSV if the file name ends with .csv, or as JSON otherwise."""
+        if filename.lower().endswith(".csv"):
+            self.save_csv(filename)
+        else:
+            self.save_json(filename)
+
+    def _bin(self, elapsed_ms):
+        for i, edge in enumerate(self.bin_edges):
+            if elapsed_ms < edge:
+                return i
+        return len(self.bin_edges)
+
+
 class ImageTransformer:
     """ Apply transformations to the image captured by the webcam.
 
@@ -441,6 +859,142 @@ class ImageTransformer:
         return dst_image
 
 
+class FrameGrabber:
+    """Reads frames from a camera continuously in a background thread.
+
+    Frames are read into a ring of preallocated buffers. `latest()`
+    returns a copy of the newest complete frame without waiting for
+    the camera, so frames never queue up in the driver while the
+    detector is busy. Any number of threads can call `latest()`.
+
+    """
+
+    def __init__(self, camera, num_buffers=param_grabber_buffers):
+        assert num_buffers >= 2
+        self.camera = camera
+        self.num_buffers = num_buffers
+        self.frames_read = 0
+        self.timestamp = None
+        self._buffers = [None] * num_buffers
+        self._timestamps = [None] * num_buffers
+        self._latest_idx = None
+        self._last_read_ok = False
+        self._lock = threading.Lock()
+        self._first_frame = threading.Event()
+        self._first_frame_missed = False
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._first_frame_missed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the thread. It must be called before releasing the camera.
+
+        It waits for the thread at most `param_grabber_stop_timeout`
+        seconds. Returns False if the thread did not finish, because
+        the camera is stuck in a read. The thread is then abandoned
+        (it does not prevent the program from exiting), and the camera
+        should not be released.
+
+        """
+        if self._thread is None:
+            return True
+        self._stop_event.set()
+        self._thread.join(param_grabber_stop_timeout)
+        stopped = not self._thread.is_alive()
+        self._thread = None
+        return stopped
+
+    def latest(self):
+        """Returns a copy of the newest frame, or None if there is none.
+
+        It waits for the first frame after `start()` at most
+        `param_grabber_first_frame_timeout` seconds, only once: if it
+        does not arrive, later calls do not wait again. It also returns
+        None while the camera fails to deliver frames. The timestamp of
+        the frame is left in `self.timestamp`.
+
+        """
+        timeout = 0 if self._first_frame_missed else param_grabber_first_frame_timeout
+        if not self._first_frame.wait(timeout):
+            self._first_frame_missed = True
+            return None
+        # Copied under the lock: the grabber only writes into buffers
+        # other than the newest one, which cannot change meanwhile
+        with self._lock:
+            if not self._last_read_ok:
+                return None
+            self.timestamp = self._timestamps[self._latest_idx]
+            return self._buffers[self._latest_idx].copy()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            with self._lock:
+                idx = self._free_buffer()
+            success, frame = self.camera.read(self._buffers[idx])
+            with self._lock:
+                self._last_read_ok = success and frame is not None
+                if self._last_read_ok:
+                    self._buffers[idx] = frame
+                    self._timestamps[idx] = getattr(self.camera, "timestamp", None)
+                    self._latest_idx = idx
+                    self.frames_read += 1
+            if self._last_read_ok:
+                self._first_frame.set()
+            else:
+                self._stop_event.wait(param_grabber_retry_delay)
+
+    def _free_buffer(self):
+        for i in range(self.num_buffers):
+            if i != self._latest_idx:
+                return i
+
+
+class FrameChangeDetector:
+    """Tells whether a frame differs from a reference frame.
+
+    Frames are compared through their signatures: the grayscale frame
+    downscaled to `param_change_signature_size`. The frame changed if
+    more than `param_change_fraction` of the signature values differ
+    in more than `param_change_pixel_threshold` gray levels, which is
+    robust to camera noise and small changes of exposure.
+
+    """
+
+    def __init__(self):
+        self.reference = None
+
+    def set_reference(self, image):
+        self.reference = self.signature(image)
+
+    def reset(self):
+        self.reference = None
+
+    def changed(self, image):
+        """Returns True if `image` differs from the reference.
+
+        It also returns True when there is no reference.
+
+        """
+        if self.reference is None:
+            return True
+        difference = np.abs(self.signature(image) - self.reference)
+        changed_fraction = np.mean(difference > param_change_pixel_threshold)
+        return changed_fraction > param_change_fraction
+
+    @staticmethod
+    def signature(image):
+        if len(image.shape) == 3:
+            image = images.rgb_to_gray(image)
+        return cv2.resize(
+            image, param_change_signature_size, interpolation=cv2.INTER_AREA
+        ).astype(np.int16)
+
+
 class ExamDetectorContext:
     """ Class intended for persistency of data accross several
         ExamCapture objects.
@@ -452,6 +1006,12 @@ class ExamDetectorContext:
         camera_id=-1,
         fixed_hough_threshold=None,
         image_transformer=ImageTransformer(ImageTransformer.IDENTITY),
+        tracking=False,
+        threshold_sweep=False,
+        frame_grabber=False,
+        source=None,
+        crosses_backend="svm",
+        pre_process_cache=False,
     ):
         """ Creates a new camera capture context.
 
@@ -459,6 +1019,28 @@ class ExamDetectorContext:
         integer). Pass -1 (the default value) for letting this object
         choose the first available camera.
 
+        If `tracking` is True, the tables found in a frame are first
+        searched around the same place in the next frame, and the
+        Hough transform is run only when they are not found there.
+
+        If `threshold_sweep` is True, when the current Hough threshold
+        does not find the tables, the rest of thresholds are tried
+        concurrently on the same frame (see `sweep_hough_thresholds`).
+
+        If `frame_grabber` is True, the camera is read continuously by
+        a `FrameGrabber` thread and captures return its newest frame.
+
+        Frames are read from `source` (see the `sources` module), if
+        given, instead of a camera. The timestamp of the last frame
+        captured is kept in `self.frame_timestamp`.
+
+        Cells are classified with the default classifier of crosses
+        of `crosses_backend` (see `classifiers.CROSSES_BACKENDS`).
+
+        If `pre_process_cache` is True, the last frames pre-processed
+        are cached (see `pre_process`). It pays off when the same
+        frame is detected several times, as in batch grading.
+
         """
         if not fixed_hough_threshold:
             self.hough_thresholds = param_hough_thresholds
@@ -471,7 +1053,73 @@ class ExamDetectorContext:
         self.threshold_locked = False
         self.image_transformer = image_transformer
         self.ocr = classifiers.DefaultDigitClassifier()
-        self.crosses_classifier = classifiers.DefaultCrossesClassifier()
+        self.crosses_classifier = classifiers.default_crosses_classifier(
+            crosses_backend
+        )
+        self.profiler = None
+        self.tracking = tracking
+        self.tracked_axes = None
+        self.threshold_sweep = threshold_sweep
+        self.sweep_skip_frames = 0
+        self._sweep_executor = None
+        self.frame_grabber = frame_grabber
+        self.grabber = None
+        self.source = source
+        self.frame_timestamp = None
+        self.pre_process_cache = pre_process_cache
+        self._pre_process_cache = collections.OrderedDict()
+        # Several detections may share the context: the state they
+        # update (thresholds, tracked axes, caches) is kept under this lock
+        self._lock = threading.RLock()
+
+    def pre_process(self, image, scale):
+        """Returns the pre-processed versions of a raw frame.
+
+        Returns a tuple (image_proc, image_search), with image_search
+        None if `scale` is 1.0 (see `pre_process_pyramid`).
+
+        With the cache enabled, the last `param_pre_process_cache_size`
+        results are kept, keyed by the frame object, so that detecting
+        the same frame again (e.g. with another Hough threshold) does
+        not pre-process it again. Frames are not hashed: the same
+        array with other contents would get a stale result, which is
+        why live cameras, whose buffers may be reused, do not use the
+        cache. Cached images are read-only.
+
+        """
+        if not self.pre_process_cache:
+            return self._pre_process(image, scale)
+        key = (id(image), scale)
+        with self._lock:
+            entry = self._pre_process_cache.get(key)
+            # The frame is kept in the entry, so that its id is not reused
+            if entry is not None and entry[0] is image:
+                self._pre_process_cache.move_to_end(key)
+                return entry[1]
+        result = self._pre_process(image, scale)
+        for processed in result:
+            if processed is not None:
+                processed.setflags(write=False)
+        with self._lock:
+            self._pre_process_cache[key] = (image, result)
+            while len(self._pre_process_cache) > param_pre_process_cache_size:
+                self._pre_process_cache.popitem(last=False)
+        return result
+
+    @staticmethod
+    def _pre_process(image, scale):
+        if scale < 1.0:
+            return pre_process_pyramid(image, scale)
+        else:
+            return (pre_process(image), None)
+
+    def enable_profiling(self):
+        """Starts collecting detection stage timings into `self.profiler`."""
+        if self.profiler is None:
+            self.profiler = DetectionProfiler()
+
+    def disable_profiling(self):
+        self.profiler = None
 
     def open_camera(self, camera_id=None):
         """Initializes the last camera device used, or `camera_id`.
@@ -483,6 +1131,10 @@ class ExamDetectorContext:
         with other cameras.
 
         """
+        if self.source is not None:
+            self.camera = self.source
+            self._start_grabber()
+            return True
         previous_camera = self.camera_id
         if camera_id is not None:
             self.camera_id = camera_id
@@ -497,6 +1149,7 @@ class ExamDetectorContext:
                     self.camera = self._try_camera(previous_camera)
                     if self.camera is None:
                         self.camera, self.camera_id = self._try_next_camera(-1)
+        self._start_grabber()
         return self.camera is not None
 
     def current_camera_id(self):
@@ -514,11 +1167,15 @@ class ExamDetectorContext:
 
         """
 
+        if self.source is not None:
+            return False
+        self._stop_grabber()
         if self.camera is not None:
             del self.camera
         camera, camera_id = self._try_next_camera(self.camera_id)
         if camera is not None:
             self.camera, self.camera_id = camera, camera_id
+            self._start_grabber()
             return True
         else:
             return False
@@ -528,29 +1185,130 @@ class ExamDetectorContext:
         self.image_transformer = image_transfomer
 
     def lock_threshold(self):
-        self.threshold_locked = True
+        with self._lock:
+            self.threshold_locked = True
 
     def unlock_threshold(self):
-        self.threshold_locked = False
-        self.failures_in_a_row = 0
+        with self._lock:
+            self.threshold_locked = False
+            self.failures_in_a_row = 0
 
     def get_hough_threshold(self):
         return self.hough_thresholds[self.hough_thresholds_idx]
 
     def next_hough_threshold(self):
-        if not self.threshold_locked:
-            self.hough_thresholds_idx = (self.hough_thresholds_idx + 1) % len(
-                self.hough_thresholds
-            )
-            self.failures_in_a_row = 0
+        with self._lock:
+            if not self.threshold_locked:
+                self.hough_thresholds_idx = (self.hough_thresholds_idx + 1) % len(
+                    self.hough_thresholds
+                )
+                self.failures_in_a_row = 0
+
+    def sweep_hough_thresholds(self, image, dimensions, read_id, tried_threshold):
+        """Searches the tables in `image` with every other Hough threshold.
+
+        Thresholds run concurrently in a thread pool (OpenCV releases
+        the GIL). The first one that finds the tables, in the order
+        they would be tried frame after frame, becomes the current
+        threshold, and its tuple (lines, axes, corner_matrixes) is
+        returned. Returns None if no threshold finds them, or if the
+        threshold is locked.
+
+        """
+        with self._lock:
+            if self.threshold_locked:
+                return None
+            num_thresholds = len(self.hough_thresholds)
+            indices = [
+                (self.hough_thresholds_idx + i) % num_thresholds
+                for i in range(num_thresholds)
+            ]
+            thresholds = [
+                (i, self.hough_thresholds[i])
+                for i in indices
+                if self.hough_thresholds[i] != tried_threshold
+            ]
+            if self._sweep_executor is None:
+                self._sweep_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=param_sweep_workers
+                )
+            executor = self._sweep_executor
+        futures = [
+            executor.submit(search_tables, image, threshold, dimensions, read_id)
+            for _, threshold in thresholds
+        ]
+        found = None
+        for (idx, _), future in zip(thresholds, futures):
+            if found is None:
+                result = future.result()
+                if result[2]:
+                    found = result
+                    with self._lock:
+                        self.hough_thresholds_idx = idx
+                        self.failures_in_a_row = 0
+            else:
+                future.cancel()
+        if found is None:
+            with self._lock:
+                self.sweep_skip_frames = param_sweep_skip_frames
+        return found
+
+    def skip_sweep(self):
+        """Tells whether the threshold sweep should be skipped this time.
+
+        After a failed sweep, it returns True for the next
+        `param_sweep_skip_frames` calls, so that frames without an exam
+        do not keep every core busy. Detections running at the same
+        time can call it safely.
+
+        """
+        with self._lock:
+            if self.sweep_skip_frames > 0:
+                self.sweep_skip_frames -= 1
+                return True
+            return False
 
     def notify_failure(self):
-        self.failures_in_a_row += 1
-        if self.failures_in_a_row > param_failures_threshold:
-            self.next_hough_threshold()
+        with self._lock:
+            self.failures_in_a_row += 1
+            if self.failures_in_a_row > param_failures_threshold:
+                self.next_hough_threshold()
 
     def notify_success(self):
-        self.failures_in_a_row = 0
+        with self._lock:
+            self.failures_in_a_row = 0
+
+    def notify_unchanged_frame(self, detections_running=0):
+        """Counts a frame that was not detected because it did not change.
+
+        Frames are not detected again when they are the same as a
+        failed one (see `FrameChangeDetector`), but they count as a
+        failure, so that the context still moves to the next Hough
+        threshold. Returns True if the threshold changed, i.e. when
+        the frame is worth detecting again.
+
+        The reference of the change detector must be a frame whose
+        detection already failed. While `detections_running` is not
+        zero, the frame is not counted and False is returned, because
+        those detections may still succeed with the current threshold.
+
+        """
+        if detections_running:
+            return False
+        with self._lock:
+            threshold = self.get_hough_threshold()
+            self.notify_failure()
+            return self.get_hough_threshold() != threshold
+
+    def remember_axes(self, axes):
+        """Stores the axes to track in the next frame, if tracking is on.
+
+        Pass None when the tables have not been found.
+
+        """
+        if self.tracking:
+            with self._lock:
+                self.tracked_axes = axes
 
     def close_camera(self):
         """Closes the current camera.
@@ -558,9 +1316,16 @@ class ExamDetectorContext:
         The same camera will be opened again when open_camera() is called.
 
         """
-        if self.camera is not None:
+        stopped = self._stop_grabber()
+        # A camera stuck in a read by the grabber cannot be released safely
+        if self.camera is not None and stopped:
             self.camera.release()
         self.camera = None
+        with self._lock:
+            executor = self._sweep_executor
+            self._sweep_executor = None
+        if executor is not None:
+            executor.shutdown()
 
     def capture(self, clone=False, resize=None):
         """Returns a capture.
@@ -568,7 +1333,8 @@ class ExamDetectorContext:
         If `clone` is True, the image returned is a copy of the
         original.  Use this option if you plan to modify the image or
         store it for later, because the buffer of the original image
-        will be reused by OpenCV por the next capture.
+        will be reused by OpenCV por the next capture. Images from the
+        frame grabber are always copies.
 
         `resize` is a tuple (width, height). If it is not None, then
         the image is scaled to that size. Scaling implies a new copy
@@ -588,13 +1354,22 @@ class ExamDetectorContext:
         return self.image_transformer.transform(image)
 
     def dump_buffer(self, delay_suffered):
+        # The frame grabber always returns the newest frame
+        if self.grabber is not None:
+            return
         if self.camera is not None and delay_suffered > 0.1:
             frames_to_drop = min(8, int(1 + (delay_suffered - 0.1) / 0.04))
             for i in range(0, frames_to_drop):
                 self.capture_image(False)
 
     def capture_image(self, clone=False):
+        if self.grabber is not None:
+            # The grabber always returns a copy
+            image = self.grabber.latest()
+            self.frame_timestamp = self.grabber.timestamp
+            return image
         success, image = self.camera.read()
+        self.frame_timestamp = getattr(self.camera, "timestamp", None)
         if not success:
             image = None
         elif clone:
@@ -602,6 +1377,19 @@ class ExamDetectorContext:
         else:
             return image
 
+    def _start_grabber(self):
+        if self.frame_grabber and self.camera is not None and self.grabber is None:
+            self.grabber = FrameGrabber(self.camera)
+            self.grabber.start()
+
+    def _stop_grabber(self):
+        """Stops the grabber, and returns False if its thread got stuck."""
+        stopped = True
+        if self.grabber is not None:
+            stopped = self.grabber.stop()
+            self.grabber = None
+        return stopped
+
     def _try_next_camera(self, cur_camera_id):
         camera = None
         camera_id = -1
@@ -616,11 +1404,11 @@ class ExamDetectorContext:
 
     @staticmethod
     def _try_camera(camera_id):
-        cam = cv2.VideoCapture(camera_id)
-        if cam is not None:
-            success, image = cam.read()
-            if success is None or image is None:
-                cam = None
+        cam = sources.CameraSource(camera_id)
+        success, image = cam.read()
+        if not success:
+            cam.release()
+            cam = None
         return cam
 
 
@@ -664,19 +1452,45 @@ class FalseExamDetectorContext(ExamDetectorContext):
             self.next_exam_idx = 0
 
 
-def pre_process(image):
+def pre_process(image, block_size=param_adaptive_threshold_block_size):
     gray = images.rgb_to_gray(image)
     thr = cv2.adaptiveThreshold(
         gray,
         255,
         cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
         cv2.THRESH_BINARY_INV,
-        param_adaptive_threshold_block_size,
+        block_size,
         param_adaptive_threshold_offset,
     )
     return thr
 
 
+def pre_process_pyramid(image, scale):
+    """Pre-processes an image and a copy of it downscaled by `scale`.
+
+    The local means of the adaptive threshold are computed only in the
+    downscaled copy, and interpolated for the full resolution image,
+    so that the cost does not grow with the size of the block.
+
+    Returns the full resolution and the downscaled binary images.
+
+    """
+    gray = images.rgb_to_gray(image)
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    block_size = param_adaptive_threshold_block_size
+    means = cv2.GaussianBlur(
+        small, (block_size, block_size), 0, borderType=cv2.BORDER_REPLICATE
+    )
+    thresholds = cv2.subtract(means, param_adaptive_threshold_offset)
+    small_proc = cv2.compare(small, thresholds, cv2.CMP_LE)
+    thresholds = cv2.resize(
+        thresholds,
+        (images.get_width(gray), images.get_height(gray)),
+        interpolation=cv2.INTER_LINEAR,
+    )
+    return cv2.compare(gray, thresholds, cv2.CMP_LE), small_proc
+
+
 def detect_lines(image, hough_threshold):
     raw_lines = cv2.HoughLines(image, 1, 0.01, hough_threshold)
     if raw_lines is None:
@@ -688,6 +1502,28 @@ def detect_lines(image, hough_threshold):
     return sorted(lines, key=lambda x: x[1])
 
 
+def search_tables(image, hough_threshold, dimensions, read_id):
+    """Searches the answer tables in a pre-processed image.
+
+    Runs the same steps as ExamDetector, without timing them, with
+    the given Hough threshold. Returns a tuple (lines, axes,
+    corner_matrixes), with axes None if the tables are not found.
+
+    """
+    height, width = image.shape[:2]
+    lines = detect_lines(image, hough_threshold)
+    axes = detect_boxes(lines, dimensions) if len(lines) >= 2 else None
+    if axes is None:
+        return lines, None, []
+    axes = filter_axes(axes, width, height, read_id)
+    return lines, axes, cell_corners(axes[1][1], axes[0][1], width, height, dimensions)
+
+
+def scale_lines(lines, factor):
+    """Returns the lines (rho, theta) of the image scaled by `factor`."""
+    return [(rho * factor, theta) for rho, theta in lines]
+
+
 def detect_directions(lines):
     """ Group lines into axes.
 
@@ -852,6 +1688,115 @@ def collapse_lines_angles(lines, horizontal):
     return main_lines
 
 
+def track_axes(
+    image,
+    axes,
+    dimensions,
+    rho_range=param_tracking_rho_range,
+    theta_range=param_tracking_theta_range,
+    theta_step=param_tracking_theta_step,
+):
+    """Searches the axes of a previous frame again in the given image.
+
+       Every line of `axes` (as returned by filter_axes) is refined
+       within a narrow band around it, instead of running the Hough
+       transform on the whole image. The segment of each line that is
+       scored is the one that spans the answer tables. The size of the
+       band is set by the arguments passed to refine_lines().
+
+       Returns the new axes, or None if some line is not found.
+
+    """
+    vlines = axes[0][1]
+    hlines = axes[1][1]
+    h_expected = 1 + max([box[1] for box in dimensions])
+    if len(hlines) < h_expected or len(vlines) < 2:
+        return None
+    top, bottom = hlines[-h_expected], hlines[-1]
+    starts = [g.intersection(line, vlines[0]) for line in hlines] + [
+        g.intersection(top, line) for line in vlines
+    ]
+    ends = [g.intersection(line, vlines[-1]) for line in hlines] + [
+        g.intersection(bottom, line) for line in vlines
+    ]
+    lines, scores = refine_lines(
+        image, hlines + vlines, starts, ends, rho_range, theta_range, theta_step
+    )
+    # Lines above the tables (e.g. the id box) are dropped if not found
+    num_above = len(hlines) - h_expected
+    if scores[num_above:].min() < param_tracking_min_score:
+        return None
+    hlines = [
+        line
+        for line, score in zip(lines[:num_above], scores[:num_above])
+        if score >= param_tracking_min_score
+    ] + lines[num_above : num_above + h_expected]
+    vlines = lines[num_above + h_expected :]
+    return [
+        (sum([theta for _, theta in vlines]) / len(vlines), vlines),
+        (sum([theta for _, theta in hlines]) / len(hlines), hlines),
+    ]
+
+
+def refine_lines(
+    image,
+    lines,
+    starts,
+    ends,
+    rho_range=param_tracking_rho_range,
+    theta_range=param_tracking_theta_range,
+    theta_step=param_tracking_theta_step,
+):
+    """Finds the lines of a binary image that are closest to the given ones.
+
+       The candidates for each line (rho, theta) are rotated up to
+       `theta_range` radians, in steps of `theta_step`, around the
+       middle point of the segment between `starts[i]` and `ends[i]`,
+       and displaced up to `rho_range` pixels. Each candidate is
+       scored with the fraction of foreground pixels along that
+       segment, and the best one is chosen.
+
+       Returns the list of refined lines and an array with their
+       scores.
+
+    """
+    starts = np.array(starts, dtype=float)
+    ends = np.array(ends, dtype=float)
+    centers = (starts + ends) / 2
+    half_lengths = np.hypot(*(ends - starts).T) / 2
+    num_thetas = int(round(theta_range / theta_step))
+    dthetas = theta_step * np.arange(-num_thetas, num_thetas + 1)
+    offsets = np.arange(-rho_range, rho_range + 1)
+    thetas = np.array([theta for _, theta in lines])[:, np.newaxis] + dthetas
+    cos, sin = np.cos(thetas), np.sin(thetas)
+    # Axes of the sample points: line, angle, offset, position
+    steps = half_lengths[:, np.newaxis] * np.linspace(-1, 1, param_tracking_samples)
+    steps = steps[:, np.newaxis, np.newaxis, :]
+    shifts = offsets[np.newaxis, np.newaxis, :, np.newaxis]
+    cos = cos[:, :, np.newaxis, np.newaxis]
+    sin = sin[:, :, np.newaxis, np.newaxis]
+    xs = centers[:, 0, None, None, None] + shifts * cos - steps * sin
+    ys = centers[:, 1, None, None, None] + shifts * sin + steps * cos
+    xs = np.rint(xs).astype(int)
+    ys = np.rint(ys).astype(int)
+    height, width = image.shape[:2]
+    inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    values = image[np.clip(ys, 0, height - 1), np.clip(xs, 0, width - 1)]
+    scores = ((values > 0) & inside).mean(axis=3)
+    # Thick lines give the best score to several neighbouring candidates:
+    # the centroid of all of them is taken.
+    tolerance = 1 / param_tracking_samples
+    refined = []
+    best_scores = scores.max(axis=(1, 2))
+    for i, line_scores in enumerate(scores):
+        theta_idx, offset_idx = np.nonzero(line_scores >= best_scores[i] - tolerance)
+        theta = float(np.mean(thetas[i, theta_idx]))
+        offset = float(np.mean(offsets[offset_idx]))
+        rho = centers[i, 0] * math.cos(theta) + centers[i, 1] * math.sin(theta)
+        refined.append((float(rho) + offset, theta))
+    return refined, best_scores
+
+
 def cell_corners(hlines, vlines, iwidth, iheight, dimensions):
     h_expected = 1 + max([box[1] for box in dimensions])
     v_expected = len(dimensions) + sum([box[0] for box in dimensions])
@@ -865,72 +1810,61 @@ def cell_corners(hlines, vlines, iwidth, iheight, dimensions):
         return []
     elif len(hlines) > h_expected:
         hlines = hlines[-h_expected:]
+    points = g.intersections(hlines, vlines)
     corner_matrixes = []
     vini = 0
     for width, height in dimensions:
-        corners = []
-        for i in range(0, height + 1):
-            cpart = []
-            corners.append(cpart)
-            for j in range(vini, vini + width + 1):
-                c = g.intersection(hlines[i], vlines[j])
-                cpart.append(c)
-        corner_matrixes.append(corners)
+        corner_matrixes.append(points[: height + 1, vini : vini + width + 1])
         vini += 1 + width
     if check_corners(corner_matrixes, iwidth, iheight):
-        return corner_matrixes
+        return [
+            [[tuple(point) for point in row] for row in corners.tolist()]
+            for corners in corner_matrixes
+        ]
     else:
         return []
 
 
 def check_corners(corner_matrixes, width, height):
+    tables = [np.asarray(corners) for corners in corner_matrixes]
     # Check differences between horizontal lines:
-    corners = corner_matrixes[(len(corner_matrixes) - 1) // 2]
-    ypoints = [row[-1][1] for row in corners]
-    difs = []
-    difs2 = []
-    for i in range(1, len(ypoints)):
-        difs.append(ypoints[i] - ypoints[i - 1])
-    for i in range(1, len(difs)):
-        difs2.append(difs[i] - difs[i - 1])
+    ypoints = tables[(len(tables) - 1) // 2][:, -1, 1]
+    difs = np.diff(ypoints)
+    difs2 = np.diff(difs)
     max_difs2 = (
-        1 + float(max(difs) - min(difs)) / len(difs) * param_check_corners_tolerance_mul
+        1
+        + float(difs.max() - difs.min()) / len(difs) * param_check_corners_tolerance_mul
     )
-    if max(difs2) > max_difs2:
+    if difs2.max() > max_difs2:
         return False
-    if 0.5 * max(difs) > min(difs):
+    if 0.5 * difs.max() > difs.min():
         return False
     # Check that no points are negative
-    for corners in corner_matrixes:
-        for row in corners:
-            for point in row:
-                if (
-                    point[0] < 0
-                    or point[0] >= width
-                    or point[1] < 0
-                    or point[1] >= height
-                ):
-                    return False
-
-    # Check that the sequence of points is coherent
-    for corners in corner_matrixes:
-        for i in range(0, len(corners) - 1):
-            for j in range(0, len(corners[0]) - 1):
-                if (
-                    corners[i][j][1] >= corners[i + 1][j][1]
-                    or corners[i][j + 1][1] >= corners[i + 1][j + 1][1]
-                    or corners[i][j][0] >= corners[i][j + 1][0]
-                    or corners[i + 1][j][0] >= corners[i + 1][j + 1][0]
-                ):
-                    return False
+    for corners in tables:
+        if (
+            corners[:, :, 0].min() < 0
+            or corners[:, :, 0].max() >= width
+            or corners[:, :, 1].min() < 0
+            or corners[:, :, 1].max() >= height
+        ):
+            return False
+
+    # Check that the sequence of points is coherent:
+    # y grows down every column and x grows along every row
+    for corners in tables:
+        if corners.shape[0] > 1 and corners.shape[1] > 1:
+            if (np.diff(corners[:, :, 1], axis=0) <= 0).any() or (
+                np.diff(corners[:, :, 0], axis=1) <= 0
+            ).any():
+                return False
 
     # Success if control reaches here
     return True
 
 
 def read_infobits(image, corner_matrixes):
-    mask = images.new_image(images.get_width(image), images.get_height(image), 1)
-    bits = []
+    centers = []
+    dys = []
     for corners in corner_matrixes:
         for i in range(1, len(corners[0])):
             dx = g.diff_points(corners[-1][i - 1], corners[-1][i])
@@ -941,7 +1875,9 @@ def read_infobits(image, corner_matrixes):
                     corners[-1][i][1] + dx[1] / 2 + dy[1] / 2.6,
                 )
             )
-            bits.append(decide_infobit(image, mask, center, dy))
+            centers.append(center)
+            dys.append(dy)
+    bits = decide_infobits(image, centers, dys)
     # Check validity
     if min([b[0] ^ b[1] for b in bits]) is True:
         return [b[0] for b in bits]
@@ -949,30 +1885,91 @@ def read_infobits(image, corner_matrixes):
         return None
 
 
-def decide_infobit(image, mask, center_up, dy):
-    center_down = g.add_points(center_up, dy)
-    radius = int(
-        round(
-            math.sqrt(dy[0] * dy[0] + dy[1] * dy[1]) * param_bit_mask_radius_multiplier
-        )
-    )
-    if radius == 0:
-        radius = 1
-    images.zero_image(mask)
-    cv2.circle(mask, center_up, radius, (1), thickness=-1)
-    mask_pixels = cv2.countNonZero(mask)
-    masked = cv2.multiply(image, mask)
-    masked_pixels_up = cv2.countNonZero(masked)
-    images.zero_image(mask)
-    cv2.circle(mask, center_down, radius, (1), thickness=-1)
-    masked = cv2.multiply(image, mask)
-    masked_pixels_down = cv2.countNonZero(masked)
-    if mask_pixels < 1:
-        return (False, False)
-    return (
-        float(masked_pixels_up) / mask_pixels >= param_bit_mask_threshold,
-        float(masked_pixels_down) / mask_pixels >= param_bit_mask_threshold,
+def decide_infobits(image, centers_up, dys):
+    """Decides whether the circles around each infobit are marked.
+
+    For every bit, a circle at `centers_up[i]` and another one `dys[i]`
+    below it are checked. Only the pixels of those circles are read,
+    all bits at once. Returns a list of (up, down) pairs of booleans.
+
+    """
+    centers_up = np.array(centers_up, dtype=int)
+    dys = np.array(dys, dtype=int)
+    num_bits = len(centers_up)
+    radii = np.maximum(
+        np.rint(np.hypot(dys[:, 0], dys[:, 1]) * param_bit_mask_radius_multiplier), 1
+    ).astype(int)
+    # Stencils of all the radii, on a common square of offsets:
+    max_radius = radii.max()
+    size = 2 * max_radius + 1
+    unique_radii, radius_index = np.unique(radii, return_inverse=True)
+    stencils = np.zeros((len(unique_radii), size, size), dtype=bool)
+    for k, radius in enumerate(unique_radii):
+        pos = max_radius - radius
+        stencils[
+            k, pos : pos + 2 * radius + 1, pos : pos + 2 * radius + 1
+        ] = _circle_stencil(radius)
+    stencils = stencils.reshape(len(unique_radii), size * size)
+    # Only offsets inside some circle need to be read
+    used = np.flatnonzero(stencils.any(axis=0))
+    stencils = stencils[:, used][radius_index]
+    offsets_y, offsets_x = np.divmod(used, size)
+    # Rows 0 to num_bits - 1 are the upper circles, the rest the lower ones
+    centers = np.concatenate((centers_up, centers_up + dys))
+    xs = centers[:, 0, np.newaxis] + (offsets_x - max_radius)
+    ys = centers[:, 1, np.newaxis] + (offsets_y - max_radius)
+    height, width = image.shape[:2]
+    inside = (
+        np.concatenate((stencils, stencils))
+        & (xs >= 0)
+        & (xs < width)
+        & (ys >= 0)
+        & (ys < height)
     )
+    active = image[np.clip(ys, 0, height - 1), np.clip(xs, 0, width - 1)] != 0
+    counts = np.count_nonzero(active & inside, axis=1)
+    # As in the original mask-based implementation, the size of the
+    # upper circle is used for both circles
+    mask_pixels = np.count_nonzero(inside[:num_bits], axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        up = counts[:num_bits] / mask_pixels >= param_bit_mask_threshold
+        down = counts[num_bits:] / mask_pixels >= param_bit_mask_threshold
+    marked = mask_pixels >= 1
+    return [(bool(u and m), bool(d and m)) for u, d, m in zip(up, down, marked)]
+
+
+# Cache of the filled circles drawn by OpenCV, by radius
+_circle_stencils = {}
+
+
+def _circle_stencil(radius):
+    stencil = _circle_stencils.get(radius)
+    if stencil is None:
+        size = 2 * radius + 1
+        canvas = np.zeros((size, size), dtype=np.uint8)
+        cv2.circle(canvas, (radius, radius), radius, (1), thickness=-1)
+        stencil = canvas.astype(bool)
+        _circle_stencils[radius] = stencil
+    return stencil
+
+
+def _split_decisions(crosses, margins, choices):
+    """Groups the decisions and margins of the cells by question.
+
+    `crosses` and `margins` have an item per cell, and `choices` the
+    number of cells of each question. Returns the list of answers and
+    the list of margins of each question.
+
+    """
+    decisions = []
+    cell_margins = []
+    pos = 0
+    margins = margins.tolist()
+    for num_choices in choices:
+        decisions.append(decide_answer(crosses[pos : pos + num_choices]))
+        cell_margins.append(margins[pos : pos + num_choices])
+        pos += num_choices
+    return decisions, cell_margins
 
 
 def decide_answer(cell_decisions):
@@ -1098,18 +2095,13 @@ def id_boxes_adjust_points(image, p_up, p_down, line_up, line_down, x_var, iwidt
         if p[0] >= 0 and p[0] < iwidth and p[1] >= 0:
             points_down.append(p)
     pairs = [(u, v) for u in points_up for v in points_down]
-    energies = []
-    best = None
-    for u, v in pairs:
-        energy = id_boxes_match_level(image, u, v)
-        if energy > param_id_boxes_energy_break:
-            best = ((u, v), energy)
-            break
-        else:
-            energies.append((energy, u, v))
-    if best is not None:
-        return best
+    levels = id_boxes_match_levels(image, pairs)
+    above_break = np.flatnonzero(levels > param_id_boxes_energy_break)
+    if len(above_break) > 0:
+        idx = above_break[0]
+        return pairs[idx], float(levels[idx])
     else:
+        energies = [(energy, u, v) for energy, (u, v) in zip(levels.tolist(), pairs)]
         energies.sort(reverse=True)
         if len(energies) > 0:
             lim = len(energies)
@@ -1137,24 +2129,30 @@ def id_boxes_adjust_point_vertically(image, point, line, interval, iwidth):
     for i in range(interval[0], interval[1] + 1):
         lines.append((rho + i, theta))
         lines.append((rho - i, theta))
-    values = []
-    for l in lines:
-        match = 0
-        for xx in range(point[0] - 2, point[0] + 3):
-            x, y = g.line_point(l, x=xx)
-            if y >= 0 and x >= 0 and x < iwidth and image[y, x] > 0:
-                match += 1
-        p = g.line_point(l, x=point[0])
-        values.append((match, p[1], p))
-    values.sort(reverse=True)
-    best = [(m, ppp) for (m, yyy, ppp) in values if m == values[0][0]]
-    return best[len(best) // 2][1]
-
-
-def id_boxes_match_level(image, p0, p1):
-    points = [(x, y) for (x, y) in g.walk_line(p0, p1)]
-    active = len([(x, y) for (x, y) in points if image[y, x] > 0])
-    return float(active) / len(points)
+    rhos = np.array([l[0] for l in lines])[:, np.newaxis]
+    xs = np.arange(point[0] - 2, point[0] + 3)
+    ys = ((rhos - xs * math.cos(theta)) / math.sin(theta)).astype(int)
+    valid = (ys >= 0) & (xs >= 0) & (xs < iwidth)
+    active = valid & (image[np.where(valid, ys, 0), np.where(valid, xs, 0)] > 0)
+    matches = np.count_nonzero(active, axis=1)
+    # Among the best lines, the one in the middle
+    best = np.sort(ys[:, 2][matches == matches.max()])[::-1]
+    return g.round_point((point[0], best[len(best) // 2]))
+
+
+def id_boxes_match_levels(image, pairs):
+    """Returns the fraction of active pixels in the line of each pair.
+
+    `pairs` is a list of pairs of points. The pixels of all the lines
+    are read from the image at once.
+
+    """
+    if not pairs:
+        return np.zeros(0)
+    starts, ends = zip(*pairs)
+    xs, ys, lengths = g.walk_lines(starts, ends)
+    active = (image[ys, xs] > 0) & (np.arange(xs.shape[1]) < lengths[:, np.newaxis])
+    return np.count_nonzero(active, axis=1) / lengths
 
 
 # Utility functions
@@ -1206,8 +2204,7 @@ def line_bounds_one_line(image, line, iwidth, rho_var):
         lines.append((rho - i, theta))
     points_left = []
     points_right = []
-    for l in lines:
-        pl, pr = line_bounds(image, l, iwidth)
+    for pl, pr in lines_bounds(image, lines, iwidth):
         if pl is not None:
             points_left.append(pl)
             points_right.append(pr)
@@ -1215,44 +2212,59 @@ def line_bounds_one_line(image, line, iwidth, rho_var):
 
 
 def line_bounds(image, line, iwidth):
-    # points of intersection with x = 0 and x = width - 1
-    p0 = g.line_point(line, x=0)
-    if p0[1] < 0:
-        p0 = g.line_point(line, y=0)
-    p1 = g.line_point(line, x=iwidth - 1)
-    if p1[1] < 0:
-        p1 = g.line_point(line, y=0)
+    return lines_bounds(image, [line], iwidth)[0]
+
+
+def lines_bounds(image, lines, iwidth):
+    """Returns the bounds of the segment drawn along each line.
+
+    Each line is walked across the image, and its bounds are the first
+    pixel of the first run of at least 3 active pixels and the last
+    pixel of the last such run. Returns a list with a tuple (ini, end)
+    per line, which is (None, None) if the line falls outside the image
+    or there are no bounds. The pixels of all the lines are read from
+    the image at once.
+
+    """
     image_dimensions = (images.get_width(image), images.get_height(image))
-    if not g.point_is_valid(p0, image_dimensions) or not g.point_is_valid(
-        p1, image_dimensions
-    ):
-        return None, None
-    # get bounds
-    ini_found = False
-    ini = None
-    end = None
-    last = 0
-    count = 0
-    for x, y in g.walk_line(p0, p1):
-        value = 1 if image[y, x] > 0 else 0
-        if value == last:
-            count += 1
-        else:
-            last = value
-            count = 1
-        if not ini_found:
-            if last == 1:
-                if count == 1:
-                    ini = (x, y)
-                elif count == 3:
-                    ini_found = True
-        else:
-            if last == 1 and count > 2:
-                end = (x, y)
-    if ini is None or end is None:
-        ini = None
-        end = None
-    return ini, end
+    bounds = [(None, None)] * len(lines)
+    valid = []
+    starts = []
+    ends = []
+    for i, line in enumerate(lines):
+        # points of intersection with x = 0 and x = width - 1
+        p0 = g.line_point(line, x=0)
+        if p0[1] < 0:
+            p0 = g.line_point(line, y=0)
+        p1 = g.line_point(line, x=iwidth - 1)
+        if p1[1] < 0:
+            p1 = g.line_point(line, y=0)
+        if g.point_is_valid(p0, image_dimensions) and g.point_is_valid(
+            p1, image_dimensions
+        ):
+            valid.append(i)
+            starts.append(p0)
+            ends.append(p1)
+    if not valid:
+        return bounds
+    xs, ys, lengths = g.walk_lines(starts, ends)
+    positions = np.arange(xs.shape[1])
+    active = (image[ys, xs] > 0) & (positions < lengths[:, np.newaxis])
+    # Position of each pixel within its run of active pixels
+    run_starts = np.where(active, 0, positions + 1)
+    run_positions = positions - np.maximum.accumulate(run_starts, axis=1) + 1
+    in_long_run = active & (run_positions >= 3)
+    for row, i in enumerate(valid):
+        long_run_pixels = np.flatnonzero(in_long_run[row])
+        # The end is searched after the third pixel of the first long run
+        if len(long_run_pixels) > 1:
+            first = long_run_pixels[0] - 2
+            last = long_run_pixels[-1]
+            bounds[i] = (
+                (int(xs[row, first]), int(ys[row, first])),
+                (int(xs[row, last]), int(ys[row, last])),
+            )
+    return bounds
 
 
 def process_box_corners(points, dimensions):
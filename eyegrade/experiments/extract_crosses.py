@@ -103,6 +103,11 @@ def main():
         logging.info("Processing session {}".format(session_path))
         process_session(labeled_crosses, session_path)
     dump_cross_list(labeled_crosses)
+    # Also in the packed format, which loads much faster for training
+    sample.pack_samples(
+        sample.SampleLoader("crosses.txt").samples(),
+        "crosses" + sample.PACKED_EXTENSION,
+    )
 
 
 if __name__ == "__main__":
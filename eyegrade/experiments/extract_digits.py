@@ -100,6 +100,10 @@ def main():
         logging.info("Processing session {}".format(session_path))
         process_session(labeled_digits, session_path)
     dump_digit_list(labeled_digits)
+    # Also in the packed format, which loads much faster for training
+    sample.pack_samples(
+        sample.SampleLoader("digits.txt").samples(), "digits" + sample.PACKED_EXTENSION
+    )
 
 
 if __name__ == "__main__":
@@ -81,16 +81,33 @@ capture_change_period = 1.0
 capture_change_period_failure = 0.3
 after_removal_delay = 1.0
 
+# Maximum number of frames being detected at the same time in search mode
+param_search_pipeline_depth = 2
+
 
 class ImageDetectTask:
-    """Used for running image detection in another thread."""
+    """Used for running image detection in another thread.
 
-    def __init__(self, detector):
-        self.detector = detector
+    The detector is created (and therefore the image pre-processed) in
+    that thread too, so that consecutive frames can be processed in
+    parallel. `sequence_num` identifies the frame in the search loop.
+
+    """
+
+    def __init__(self, dimensions, context, options, image, sequence_num):
+        self.dimensions = dimensions
+        self.context = context
+        self.options = options
+        self.image = image
+        self.sequence_num = sequence_num
+        self.detector = None
 
     def run(self):
+        self.detector = detection.ExamDetector(
+            self.dimensions, self.context, self.options, image_raw=self.image
+        )
         self.detector.detect_safe()
-        self.detector = None
+        self.image = None
 
 
 class ImageChangeTask:
@@ -204,6 +221,16 @@ class ProgramManager:
         self.sessiondb = None
         self.detection_context = self._get_detection_context()
         self.detection_options = None
+        self.search_changes = detection.FrameChangeDetector()
+        self.removal_changes = detection.FrameChangeDetector()
+        self.search_pipeline_depth = max(
+            1, min(param_search_pipeline_depth, os.cpu_count() or 1)
+        )
+        self.search_tasks = 0
+        self.search_sequence_num = 0
+        self.search_latest_num = 0
+        self.search_shown_num = 0
+        self.search_timer_pending = False
         self.drop_next_capture = False
         self.dump_buffer = False
         self._register_listeners()
@@ -219,7 +246,12 @@ class ProgramManager:
     def _get_detection_context(self):
         false_detector_session = os.getenv("EYEGRADE_CAMERA_SESSION")
         if not false_detector_session:
-            return detection.ExamDetectorContext(camera_id=self.config["camera-dev"])
+            return detection.ExamDetectorContext(
+                camera_id=self.config["camera-dev"],
+                tracking=True,
+                threshold_sweep=True,
+                frame_grabber=True,
+            )
         else:
             return detection.FalseExamDetectorContext(false_detector_session)
 
@@ -248,6 +280,11 @@ class ProgramManager:
         self.latest_graded_exam = None
         self.latest_detector = None
         self.manual_detect_manager = None
+        self.search_changes.reset()
+        # Results of frames captured before this point are discarded
+        self.search_latest_num = self.search_sequence_num
+        self.search_shown_num = self.search_sequence_num
+        self.search_timer_pending = True
         self.interface.register_timer(50, self._next_search)
         self.detection_context.dump_buffer(1.0)
         self.next_capture = time.time() + 0.05
@@ -282,6 +319,10 @@ class ProgramManager:
     def _start_auto_change_detection(self):
         if not self.from_manual_detection:
             self.change_failures = 0
+            if self.latest_detector is not None:
+                self.removal_changes.set_reference(self.latest_detector.image_raw)
+            else:
+                self.removal_changes.reset()
             self.interface.register_timer(1000, self._next_change_detection)
 
     def _start_manual_detect_mode(self):
@@ -296,29 +337,78 @@ class ProgramManager:
         )
 
     def _next_search(self):
+        """Captures a frame and launches its detection in another thread.
+
+        Up to `self.search_pipeline_depth` frames are detected at the
+        same time: while there is room for more, the next capture is
+        scheduled right away instead of after the detection finishes.
+        Continuation of work is done at `_after_image_detection`.
+
+        """
+        self.search_timer_pending = False
         if not self.mode.in_search():
             return
         if self.dump_buffer:
             self.dump_buffer = False
             self.detection_context.dump_buffer(after_removal_delay)
-        detector = detection.ExamDetector(
-            self.exam_data.dimensions, self.detection_context, self.detection_options
+        image = self._capture()
+        # Do not process again a frame in which no exam was detected,
+        # unless it may be detected with another Hough threshold now.
+        # While other frames are being detected, it is just skipped.
+        if (
+            image is not None
+            and not self.search_changes.changed(image)
+            and not self.detection_context.notify_unchanged_frame(
+                detections_running=self.search_tasks
+            )
+        ):
+            self.interface.display_capture(image)
+            self._schedule_next_search(capture_period)
+            return
+        self.search_sequence_num += 1
+        self.search_tasks += 1
+        task = ImageDetectTask(
+            self.exam_data.dimensions,
+            self.detection_context,
+            self.detection_options,
+            image,
+            self.search_sequence_num,
         )
-        self.current_detector = detector
-        task = ImageDetectTask(detector)
-        self.interface.run_worker(task, self._after_image_detection)
-
-    def _after_image_detection(self):
-        detector = self.current_detector
-        self.current_detector = None
+        self.interface.run_worker(task, lambda: self._after_image_detection(task))
+        if self.search_tasks < self.search_pipeline_depth:
+            self._schedule_next_search(capture_period)
+
+    def _schedule_next_search(self, period):
+        if not self.search_timer_pending:
+            self.search_timer_pending = True
+            self._schedule_next_capture(period, self._next_search)
+
+    def _after_image_detection(self, task):
+        self.search_tasks -= 1
+        detector = task.detector
         if not self.mode.in_search():
             # The user switched to other mode while the image was processed
             return
-        self.latest_detector = detector
+        if task.sequence_num <= self.search_latest_num:
+            # An exam was already detected in a newer frame: discard this one
+            self._schedule_next_search(capture_period)
+            return
         if detector.status["boxes"] and self.detection_context.threshold_locked:
             self.detection_context.unlock_threshold()
         exam = self._process_capture(detector)
         if exam is None or not detector.success:
+            retry = detector.worth_retrying()
+            if retry:
+                self.search_changes.reset()
+            if task.sequence_num < self.search_shown_num:
+                # A newer frame is already displayed
+                self._schedule_next_search(capture_period)
+                return
+            if not retry and detector.image_raw is not None:
+                # Frames like this one are skipped from now on
+                self.search_changes.set_reference(detector.image_raw)
+            self.search_shown_num = task.sequence_num
+            self.latest_detector = detector
             if exam is not None:
                 exam.draw_answers()
                 exam.draw_status()
@@ -327,8 +417,14 @@ class ProgramManager:
                 detector.capture.draw_status()
             if detector.capture is not None:
                 self.interface.display_capture(detector.capture.image_drawn)
-            self._schedule_next_capture(capture_period, self._next_search)
-        elif not self.drop_next_capture:
+            self._schedule_next_search(capture_period)
+            return
+        # The newest frame with an exam wins over older ones still running,
+        # even if newer frames without an exam finished before it
+        self.search_latest_num = task.sequence_num
+        self.search_shown_num = task.sequence_num
+        self.latest_detector = detector
+        if not self.drop_next_capture:
             exam.draw_answers()
             self.exam = exam
             self._start_review_mode()
@@ -337,9 +433,12 @@ class ProgramManager:
             # available.  Used after auto exam removal detection.
             exam.draw_answers()
             self.interface.display_capture(detector.capture.image_drawn)
-            self._schedule_next_capture(after_removal_delay, self._next_search)
+            # Frames captured in the meantime still show the same exam
+            self.search_latest_num = self.search_sequence_num
+            self._schedule_next_search(after_removal_delay)
             self.drop_next_capture = False
             self.dump_buffer = True
+            self.search_changes.reset()
 
     def _next_change_detection(self):
         """Used to detect exam removal.
@@ -353,8 +452,19 @@ class ProgramManager:
         ):
             return
         self.detection_context.dump_buffer(1.0)
+        image = self._capture()
+        if image is not None and not self.removal_changes.changed(image):
+            # The scene is the same: the exam has not been removed
+            self.change_failures = 0
+            self._schedule_next_capture(
+                capture_change_period, self._next_change_detection
+            )
+            return
         detector = detection.ExamDetector(
-            self.exam_data.dimensions, self.detection_context, self.detection_options
+            self.exam_data.dimensions,
+            self.detection_context,
+            self.detection_options,
+            image_raw=image,
         )
         self.current_detector = detector
         task = ImageChangeTask(detector, self.exam.capture)
@@ -378,7 +488,7 @@ class ProgramManager:
         ):
             return
         exam_removed = False
-        if image.try_to_detect:
+        if image.exam_detected:
             period = capture_change_period
             self.change_failures = 0
         else:
@@ -393,6 +503,12 @@ class ProgramManager:
             self.drop_next_capture = True
             self._action_continue()
 
+    def _capture(self):
+        """Captures a frame from the camera, or None if reading from files."""
+        if self.detection_options["capture-from-file"]:
+            return None
+        return self.detection_context.capture()
+
     def _schedule_next_capture(self, period, function):
         """Schedules the next image capture and registers the timer.
 
@@ -800,6 +916,7 @@ class ProgramManager:
         if self.exam_data.survey_mode:
             self.detection_options["infobits"] = False
         self.detection_options["error-logging"] = self.config["error-logging"]
+        self.detection_options["detection-width"] = self.config["detection-width"]
         if exam_data.id_num_digits and exam_data.id_num_digits > 0:
             self.detection_options["read-id"] = True
             self.detection_options["id-num-digits"] = exam_data.id_num_digits
@@ -20,6 +20,8 @@ import math
 import itertools
 import statistics
 
+import numpy as np
+
 
 # Data representation:
 # - points: tuples (x, y)
@@ -184,6 +186,45 @@ def walk_line_ordered(p0, p1):
         return reversed([p for p in walk_line(p0, p1)])
 
 
+def walk_lines(starts, ends):
+    """Returns the points of several lines as walk_line would walk them.
+
+       The i-th line goes from starts[i] to ends[i]. Returns a tuple
+       (xs, ys, lengths) in which xs and ys are integer arrays with a
+       row per line, with the coordinates of its points in the same
+       order walk_line generates them, and lengths is the number of
+       points of each line. Rows shorter than the longest line are
+       padded by repeating their last point.
+
+    """
+    starts = np.array(starts, dtype=int).reshape(-1, 2)
+    ends = np.array(ends, dtype=int).reshape(-1, 2)
+    x0, y0 = starts[:, 0], starts[:, 1]
+    x1, y1 = ends[:, 0], ends[:, 1]
+    steep = np.abs(y1 - y0) > np.abs(x1 - x0)
+    a0 = np.where(steep, y0, x0)
+    b0 = np.where(steep, x0, y0)
+    a1 = np.where(steep, y1, x1)
+    b1 = np.where(steep, x1, y1)
+    swap = a0 > a1
+    a0, a1 = np.where(swap, a1, a0), np.where(swap, a0, a1)
+    b0, b1 = np.where(swap, b1, b0), np.where(swap, b0, b1)
+    deltax = (a1 - a0)[:, np.newaxis]
+    deltay = np.abs(b1 - b0)[:, np.newaxis]
+    ystep = np.where(b0 < b1, 1, -1)[:, np.newaxis]
+    lengths = deltax[:, 0] + 1
+    steps = np.minimum(np.arange(lengths.max()), deltax)
+    # Bresenham's error goes below zero for the m-th time at the
+    # smallest step for which m * deltax >= step * deltay - deltax / 2
+    increments = np.maximum(
+        0, -((deltax - 2 * steps * deltay) // np.maximum(2 * deltax, 1))
+    )
+    a = a0[:, np.newaxis] + steps
+    b = b0[:, np.newaxis] + ystep * increments
+    steep = steep[:, np.newaxis]
+    return np.where(steep, b, a), np.where(steep, a, b), lengths
+
+
 def interpolate_line(p0, p1, num_points):
     """Returns a list of num_points points in the line from p0 to p1.
 
@@ -245,6 +286,33 @@ def intersection(hline, vline):
     return round_point((x, y))
 
 
+def intersections(hlines, vlines):
+    """Returns the intersection points of every hline with every vline.
+
+       The result is an integer array of shape (len(hlines),
+       len(vlines), 2) with the same values intersection() would
+       return for each pair. Trigonometric functions are computed with
+       the math module so that results are exactly the same.
+
+    """
+    hlines = np.array(hlines, dtype=float).reshape(-1, 2)
+    vlines = np.array(vlines, dtype=float).reshape(-1, 2)
+    rho1 = hlines[:, 0, np.newaxis]
+    theta1 = hlines[:, 1, np.newaxis]
+    rho2 = vlines[:, 0]
+    theta2 = vlines[:, 1]
+    cos1 = np.array([math.cos(theta) for theta in hlines[:, 1]])[:, np.newaxis]
+    cos2 = np.array([math.cos(theta) for theta in theta2])
+    sin2 = np.array([math.sin(theta) for theta in theta2])
+    differences = theta1 - theta2
+    sin_differences = np.fromiter(
+        map(math.sin, differences.ravel()), dtype=float, count=differences.size
+    ).reshape(differences.shape)
+    y = (rho1 * cos2 - rho2 * cos1) / sin_differences
+    x = (rho2 - y * sin2) / cos2
+    return np.rint(np.stack((x, y), axis=-1)).astype(int)
+
+
 def line_point(line, x=None, y=None):
     """Returns a point in the line with the given x or y coordinate.
        Either x or y must be None. Throws division by zero exception
@@ -15,6 +15,7 @@
 # along with this program.  If not, see
 # <https://www.gnu.org/licenses/>.
 #
+import abc
 import json
 import os
 
@@ -28,47 +29,197 @@ DEFAULT_DIG_CLASS_FILE = "digit_classifier.dat.gz"
 DEFAULT_DIG_META_FILE = "digit_classifier_metadata.txt"
 DEFAULT_CROSS_CLASS_FILE = "cross_classifier.dat.gz"
 DEFAULT_CROSS_META_FILE = "cross_classifier_metadata.json"
+DEFAULT_RFF_CROSS_CLASS_FILE = "cross_classifier_rff.npz"
+DEFAULT_RFF_CROSS_META_FILE = "cross_classifier_rff_metadata.json"
 DEFAULT_DIR = "svm"
+CROSSES_BACKENDS = ("svm", "rff")
 
+utils.EyegradeException.register_error(
+    "missing_classifier",
+    short_message=(
+        "The classifier file {0} does not exist. Create it with: "
+        "python -m eyegrade.ocr.create_classifier --backend {1} crosses "
+        "<sample files>"
+    ),
+)
 
-class SVMClassifier:
-    def __init__(self, num_classes, features_extractor, load_from_file=None):
+
+class Classifier(abc.ABC):
+    """Base class of the classifiers of samples.
+
+    Subclasses implement `train_features`, `predict_margins`, `reset`
+    and `save`. Classes are labeled from 0 to num_classes - 1.
+
+    """
+
+    # Training parameters, or None for choosing them automatically
+    default_params = None
+
+    def __init__(self, num_classes, features_extractor):
         self.num_classes = num_classes
         self.features_extractor = features_extractor
-        if not load_from_file:
-            self.svm = cv2.ml.SVM_create()
-        else:
-            self.svm = cv2.ml.SVM_load(SVMClassifier.resource(load_from_file))
 
     @property
     def features_len(self):
         return self.features_extractor.features_len
 
+    @property
+    def features_key(self):
+        return preprocessing.extractor_key(self.features_extractor)
+
     def train(self, samples, params=None):
-        features = np.ndarray(shape=(len(samples), self.features_len), dtype="float32")
+        features = self.features_matrix(samples)
         labels = np.ndarray(shape=(len(samples), 1), dtype="int32")
         for i, sample in enumerate(samples):
-            features[i, :] = self.features_extractor.extract(sample)
             labels[i] = sample.label
-        self.svm.trainAuto(features, cv2.ml.ROW_SAMPLE, labels)
+        self.train_features(features, labels, params=params)
+
+    @abc.abstractmethod
+    def train_features(self, features, labels, params=None):
+        pass
 
     def classify(self, sample):
-        features = np.ndarray(shape=(1, self.features_len), dtype="float32")
-        features[0, :] = self.features_extractor.extract(sample)
-        retval, prediction = self.svm.predict(features)
-        return int(prediction[0, 0])
+        return self.classify_many([sample])[0]
+
+    def classify_many(self, samples):
+        """Classifies a sequence of samples with a single prediction.
+
+        Returns the list of labels, in the same order as the samples.
+
+        """
+        if not samples:
+            return []
+        return [int(label) for label in self.predict(self.features_matrix(samples))]
+
+    def classify_many_with_margins(self, samples):
+        """Same as `classify_many`, but also returns the margins.
 
+        Returns a tuple (labels, margins), with margins as explained
+        in `predict_margins`.
+
+        """
+        if not samples:
+            return [], np.zeros(0)
+        labels, margins = self.predict_margins(self.features_matrix(samples))
+        return [int(label) for label in labels], margins
+
+    def predict(self, features):
+        """Returns the labels for a matrix with the features of a sample per row."""
+        return self.predict_margins(features)[0]
+
+    @abc.abstractmethod
+    def predict_margins(self, features):
+        pass
+
+    def features_matrix(self, samples):
+        """Returns a matrix with the features of a sample in each row.
+
+        Features already attached to the samples by the same kind of
+        extractor (see `sample.SampleLoader.samples_with_features`)
+        are not computed again.
+
+        """
+        if samples and samples[0].features(self.features_key) is not None:
+            precomputed = [sample.features(self.features_key) for sample in samples]
+            if all(features is not None for features in precomputed):
+                return np.array(precomputed, dtype=np.float32)
+        return self.features_extractor.extract_many(samples)
+
+    @abc.abstractmethod
     def reset(self):
-        self.svm = cv2.ml.SVM_create()
+        pass
 
+    @abc.abstractmethod
     def save(self, filename):
-        self.svm.save(filename)
+        pass
 
     @staticmethod
     def resource(filename):
         return utils.resource_path(os.path.join(DEFAULT_DIR, filename))
 
 
+class SVMClassifier(Classifier):
+    def __init__(self, num_classes, features_extractor, load_from_file=None):
+        super().__init__(num_classes, features_extractor)
+        if not load_from_file:
+            self.svm = cv2.ml.SVM_create()
+        else:
+            self.svm = cv2.ml.SVM_load(Classifier.resource(load_from_file))
+        self._kernel_model = None
+
+    def train_features(self, features, labels, params=None):
+        """Trains the classifier with a matrix of features and their labels.
+
+        `params` is a dictionary with the `C` and `gamma` parameters
+        of an RBF SVM. Without it, `self.default_params` are used, and
+        if they are None too, OpenCV chooses them by cross-validation.
+
+        """
+        if params is None:
+            params = self.default_params
+        labels = np.asarray(labels, dtype=np.int32).reshape(-1, 1)
+        if params is None:
+            self.svm.trainAuto(features, cv2.ml.ROW_SAMPLE, labels)
+        else:
+            self.svm.setType(cv2.ml.SVM_C_SVC)
+            self.svm.setKernel(cv2.ml.SVM_RBF)
+            self.svm.setC(params["C"])
+            self.svm.setGamma(params["gamma"])
+            self.svm.train(features, cv2.ml.ROW_SAMPLE, labels)
+        self._kernel_model = None
+
+    def predict(self, features):
+        """Returns the labels for a matrix with the features of a sample per row.
+
+        RBF models are evaluated with one matrix product for all the
+        samples and support vectors, which is much faster than the
+        row by row prediction of OpenCV. Other models use OpenCV.
+
+        """
+        if self._kernel_model is None:
+            self._kernel_model = _RBFKernelModel.from_svm(self.svm, self.num_classes)
+        if self._kernel_model:
+            return self._kernel_model.predict(features)
+        else:
+            retval, predictions = self.svm.predict(features)
+            return predictions[:, 0].astype(int)
+
+    def predict_margins(self, features):
+        """Returns the labels and classification margins of the samples.
+
+        The margin of a sample is the value of the decision function
+        that separates its label from the other one, measured towards
+        its label. With more than two classes, it is the smallest of
+        the functions in which its label takes part. Margins close to
+        zero mean that the sample is close to a decision boundary.
+
+        They are infinite for multi-class models other than RBF ones,
+        because OpenCV does not provide their decision values.
+
+        """
+        if self._kernel_model is None:
+            self._kernel_model = _RBFKernelModel.from_svm(self.svm, self.num_classes)
+        if self._kernel_model:
+            return self._kernel_model.predict_margins(features)
+        retval, predictions = self.svm.predict(features)
+        labels = predictions[:, 0].astype(int)
+        if self.num_classes == 2:
+            retval, values = self.svm.predict(
+                features, flags=cv2.ml.STAT_MODEL_RAW_OUTPUT
+            )
+            margins = np.abs(values[:, 0]).astype(np.float64)
+        else:
+            margins = np.full(len(labels), np.inf)
+        return labels, margins
+
+    def reset(self):
+        self.svm = cv2.ml.SVM_create()
+        self._kernel_model = None
+
+    def save(self, filename):
+        self.svm.save(filename)
+
+
 class SVMDigitClassifier(SVMClassifier):
     def __init__(
         self, features_extractor, load_from_file=None, confusion_matrix_from_file=None
@@ -77,14 +228,29 @@ class SVMDigitClassifier(SVMClassifier):
         self.confusion_matrix = self._load_confusion_matrix(confusion_matrix_from_file)
 
     def classify_digit(self, sample):
-        digit = self.classify(sample)
-        weights = self.confusion_matrix[:, digit]
-        return (digit, weights)
+        return self.classify_digits([sample])[0]
+
+    def classify_digits(self, samples):
+        """Returns a (digit, weights) tuple for each sample."""
+        return [
+            (digit, self.confusion_matrix[:, digit])
+            for digit in self.classify_many(samples)
+        ]
+
+    def classify_digits_with_margins(self, samples):
+        """Same as `classify_digits`, but also returns the margins.
+
+        Returns a tuple with the list of (digit, weights) tuples and
+        the array of margins (see `SVMClassifier.predict_margins`).
+
+        """
+        digits, margins = self.classify_many_with_margins(samples)
+        return [(digit, self.confusion_matrix[:, digit]) for digit in digits], margins
 
     @staticmethod
     def _load_confusion_matrix(filename):
         if filename:
-            with open(SVMClassifier.resource(filename)) as f:
+            with open(Classifier.resource(filename)) as f:
                 metadata = json.load(f)
                 matrix = np.array(metadata["confusion_matrix"], dtype=float)
         else:
@@ -93,6 +259,8 @@ class SVMDigitClassifier(SVMClassifier):
 
 
 class DefaultDigitClassifier(SVMDigitClassifier):
+    default_params = dict(C=3.16227766, gamma=0.01)
+
     def __init__(
         self,
         load_from_file=DEFAULT_DIG_CLASS_FILE,
@@ -104,23 +272,304 @@ class DefaultDigitClassifier(SVMDigitClassifier):
             confusion_matrix_from_file=confusion_matrix_from_file,
         )
 
-    def train(self, samples, params=None):
-        super().train(samples, dict(C=3.16227766, gamma=0.01))
 
-
-class SVMCrossesClassifier(SVMClassifier):
-    def __init__(self, features_extractor, load_from_file=None):
-        super().__init__(2, features_extractor, load_from_file=load_from_file)
+class _CrossesClassifier:
+    """Methods of the classifiers of cells, labeled 1 when they have a cross."""
 
     def is_cross(self, sample):
         return self.classify(sample) == 1
 
+    def are_crosses(self, samples):
+        """Returns a list of booleans, True for the samples with a cross."""
+        return [label == 1 for label in self.classify_many(samples)]
+
+    def are_crosses_with_margins(self, samples):
+        """Same as `are_crosses`, but also returns the margins.
+
+        Returns a tuple with the list of booleans and the array of
+        margins (see `predict_margins`).
+
+        """
+        labels, margins = self.classify_many_with_margins(samples)
+        return [label == 1 for label in labels], margins
+
+
+class SVMCrossesClassifier(_CrossesClassifier, SVMClassifier):
+    def __init__(self, features_extractor, load_from_file=None):
+        super().__init__(2, features_extractor, load_from_file=load_from_file)
+
 
 class DefaultCrossesClassifier(SVMCrossesClassifier):
+    default_params = dict(C=100, gamma=0.01)
+
     def __init__(self, load_from_file=DEFAULT_CROSS_CLASS_FILE):
         super().__init__(
             preprocessing.CrossesFeatureExtractor(), load_from_file=load_from_file
         )
 
-    def train(self, samples, params=None):
-        super().train(samples, dict(C=100, gamma=0.01))
+
+class RFFClassifier(Classifier):
+    """Logistic regression on random Fourier features, in pure NumPy.
+
+    The features of the samples are mapped to `num_components` random
+    Fourier features, whose dot products approximate an RBF kernel
+    with parameter `gamma`, as in the SVMs. A linear softmax model is
+    fitted on them, with `C` as the inverse of the strength of the L2
+    regularization. The cost of predicting does not depend on the
+    number of training samples: all the samples are classified with
+    two matrix products.
+
+    The random projection is generated again from `seed` when the
+    model is loaded, so that files keep only the linear model.
+
+    Margins are divided by the median margin of the training samples,
+    so that they are in the same scale as the decision values of the
+    SVMs, whose training samples have typically margins around 1, and
+    the same confidence thresholds apply to both.
+
+    """
+
+    # A few hundred features approximate well only wide kernels,
+    # so gamma is smaller than in the SVMs
+    default_params = dict(C=100, gamma=0.001)
+
+    def __init__(
+        self,
+        num_classes,
+        features_extractor,
+        load_from_file=None,
+        num_components=256,
+        iterations=500,
+        seed=0,
+    ):
+        super().__init__(num_classes, features_extractor)
+        self.num_components = num_components
+        self.iterations = iterations
+        self.seed = seed
+        self.reset()
+        if load_from_file:
+            self._load(Classifier.resource(load_from_file))
+
+    def train_features(self, features, labels, params=None):
+        """Trains the classifier with a matrix of features and their labels.
+
+        `params` is a dictionary with the `C` and `gamma` parameters,
+        as for the SVMs. Without it, `self.default_params` are used.
+        The model is fitted by gradient descent with Nesterov momentum.
+
+        """
+        if params is None:
+            params = self.default_params
+        labels = np.asarray(labels).reshape(-1)
+        self._set_projection(features.shape[1], params["gamma"])
+        transformed = self._transform(features)
+        num_samples = len(labels)
+        targets = np.zeros((num_samples, self.num_classes), dtype=np.float32)
+        targets[np.arange(num_samples), labels] = 1
+        regularization = np.float32(1 / (params["C"] * num_samples))
+        # The step is the inverse of a bound of the Lipschitz constant
+        # of the gradient of the loss (1/2 times the squared norm of the
+        # largest row, counting the constant 1 of the intercept)
+        max_norm = np.max(np.sum(transformed * transformed, axis=1)) + 1
+        step = np.float32(1 / (max_norm / 2 + regularization))
+        weights = np.zeros((self.num_components, self.num_classes), np.float32)
+        intercept = np.zeros(self.num_classes, np.float32)
+        previous = weights, intercept
+        for t in range(self.iterations):
+            momentum = np.float32(t / (t + 3))
+            ahead_weights = weights + momentum * (weights - previous[0])
+            ahead_intercept = intercept + momentum * (intercept - previous[1])
+            scores = transformed.dot(ahead_weights) + ahead_intercept
+            errors = (_softmax(scores) - targets) / np.float32(num_samples)
+            previous = weights, intercept
+            weights = ahead_weights - step * (
+                transformed.T.dot(errors) + regularization * ahead_weights
+            )
+            intercept = ahead_intercept - step * errors.sum(axis=0)
+        self.gamma = params["gamma"]
+        self.weights = weights
+        self.intercept = intercept
+        self.margin_scale = 1.0
+        median = float(np.median(self._margins(self.scores(features))))
+        if median > 0:
+            self.margin_scale = median
+
+    def predict_margins(self, features):
+        """Returns the labels and classification margins of the samples.
+
+        The margin of a sample is the difference between the score of
+        its label and the highest score of the other labels, divided
+        by `self.margin_scale`.
+
+        """
+        scores = self.scores(features)
+        labels = np.argmax(scores, axis=1)
+        margins = self._margins(scores) / self.margin_scale
+        return labels, margins.astype(np.float64)
+
+    def scores(self, features):
+        """Returns the score of each class (columns) for each sample (rows)."""
+        return self._transform(features).dot(self.weights) + self.intercept
+
+    def reset(self):
+        self.gamma = None
+        self.margin_scale = None
+        self.projection = None
+        self.offsets = None
+        self.weights = None
+        self.intercept = None
+
+    def save(self, filename):
+        """Saves the model into a NumPy .npz file."""
+        with open(filename, "wb") as f:
+            np.savez_compressed(
+                f,
+                gamma=self.gamma,
+                margin_scale=self.margin_scale,
+                seed=self.seed,
+                weights=self.weights,
+                intercept=self.intercept,
+            )
+
+    def _load(self, filename):
+        if not os.path.exists(filename):
+            raise utils.EyegradeException(
+                "", key="missing_classifier", format_params=(filename, "rff")
+            )
+        with np.load(filename) as data:
+            self.seed = int(data["seed"])
+            self.weights = data["weights"]
+            self.intercept = data["intercept"]
+            self.num_components = self.weights.shape[0]
+            self.gamma = float(data["gamma"])
+            self.margin_scale = float(data["margin_scale"])
+        self._set_projection(self.features_len, self.gamma)
+
+    def _margins(self, scores):
+        if self.num_classes == 2:
+            return np.abs(scores[:, 1] - scores[:, 0])
+        top = np.partition(scores, -2, axis=1)
+        return top[:, -1] - top[:, -2]
+
+    def _set_projection(self, features_len, gamma):
+        random = np.random.RandomState(self.seed)
+        self.projection = random.normal(
+            scale=np.sqrt(2 * gamma), size=(features_len, self.num_components)
+        ).astype(np.float32)
+        self.offsets = random.uniform(0, 2 * np.pi, self.num_components).astype(
+            np.float32
+        )
+
+    def _transform(self, features):
+        features = np.asarray(features, dtype=np.float32)
+        transformed = np.cos(features.dot(self.projection) + self.offsets)
+        return transformed * np.float32(np.sqrt(2 / self.num_components))
+
+
+class RFFCrossesClassifier(_CrossesClassifier, RFFClassifier):
+    def __init__(self, features_extractor, load_from_file=None, **kwargs):
+        super().__init__(2, features_extractor, load_from_file=load_from_file, **kwargs)
+
+
+class DefaultRFFCrossesClassifier(RFFCrossesClassifier):
+    def __init__(self, load_from_file=DEFAULT_RFF_CROSS_CLASS_FILE, **kwargs):
+        super().__init__(
+            preprocessing.CrossesFeatureExtractor(),
+            load_from_file=load_from_file,
+            **kwargs
+        )
+
+
+def default_crosses_classifier(backend="svm"):
+    """Returns the default classifier of crosses of a backend.
+
+    `backend` is one of `CROSSES_BACKENDS`.
+
+    """
+    if backend == "svm":
+        return DefaultCrossesClassifier()
+    elif backend == "rff":
+        return DefaultRFFCrossesClassifier()
+    else:
+        raise ValueError("Unknown classifier backend: {}".format(backend))
+
+
+def _softmax(scores):
+    exp_scores = np.exp(scores - scores.max(axis=1, keepdims=True))
+    return exp_scores / exp_scores.sum(axis=1, keepdims=True)
+
+
+class _RBFKernelModel:
+    """One-vs-one decision functions of an RBF C-SVC trained by OpenCV.
+
+    Classes are assumed to be labeled from 0 to num_classes - 1, and
+    votes are counted the same way OpenCV does.
+
+    """
+
+    def __init__(self, gamma, support_vectors, decision_functions, num_classes):
+        self.gamma = gamma
+        self.support_vectors = support_vectors
+        self.sv_norms = np.sum(support_vectors * support_vectors, axis=1)
+        self.decision_functions = decision_functions
+        self.num_classes = num_classes
+
+    @classmethod
+    def from_svm(cls, svm, num_classes):
+        """Returns the model, or False if the SVM cannot be evaluated this way."""
+        if (
+            not svm.isTrained()
+            or svm.getType() != cv2.ml.SVM_C_SVC
+            or svm.getKernelType() != cv2.ml.SVM_RBF
+        ):
+            return False
+        support_vectors = svm.getSupportVectors().astype(np.float32)
+        decision_functions = []
+        for i in range(num_classes):
+            for j in range(i + 1, num_classes):
+                rho, alpha, indices = svm.getDecisionFunction(len(decision_functions))
+                decision_functions.append(
+                    (i, j, rho, alpha[0].astype(np.float64), indices[0])
+                )
+        return cls(svm.getGamma(), support_vectors, decision_functions, num_classes)
+
+    def predict(self, features):
+        return self.predict_margins(features)[0]
+
+    def predict_margins(self, features):
+        """Returns the labels and margins, as `SVMClassifier.predict_margins`."""
+        values = self.decision_values(features)
+        if self.num_classes == 2:
+            return np.where(values[:, 0] > 0, 0, 1), np.abs(values[:, 0])
+        votes = np.zeros((len(values), self.num_classes), dtype=np.int32)
+        rows = np.arange(len(values))
+        for k, (i, j, _, _, _) in enumerate(self.decision_functions):
+            votes[rows, np.where(values[:, k] > 0, i, j)] += 1
+        labels = np.argmax(votes, axis=1)
+        margins = np.full(len(values), np.inf)
+        for k, (i, j, _, _, _) in enumerate(self.decision_functions):
+            # Positive values favour class i, negative ones class j
+            margins = np.where(labels == i, np.minimum(margins, values[:, k]), margins)
+            margins = np.where(labels == j, np.minimum(margins, -values[:, k]), margins)
+        # The winner by votes may have lost some of its pairs
+        return labels, np.maximum(margins, 0)
+
+    def decision_values(self, features):
+        """Returns the value of each decision function for each sample.
+
+        The result has a row per sample and a column per pair of
+        classes, in the order of `self.decision_functions`.
+
+        """
+        features = np.asarray(features, dtype=np.float32)
+        distances = (
+            np.sum(features * features, axis=1)[:, np.newaxis]
+            + self.sv_norms
+            - 2 * features.dot(self.support_vectors.T)
+        )
+        # Kernel values are single precision, as in OpenCV
+        kernel = np.exp(np.float32(-self.gamma) * np.maximum(distances, 0))
+        values = np.empty((len(features), len(self.decision_functions)))
+        for k, (_, _, rho, alpha, indices) in enumerate(self.decision_functions):
+            values[:, k] = kernel[:, indices].dot(alpha) - rho
+        return values
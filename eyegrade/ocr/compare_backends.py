@@ -0,0 +1,163 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2018 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+"""Compares the accuracy and speed of the backends of crosses classifiers.
+
+Every backend is evaluated with the same k folds of the samples, and
+the time to classify the cells of a sheet is measured with a model
+trained with all of them.
+
+"""
+import argparse
+import collections
+import functools
+import tempfile
+import timeit
+
+import numpy as np
+
+from . import sample
+from . import classifiers
+from . import evaluation
+from . import preprocessing
+
+BACKENDS = collections.OrderedDict(
+    [
+        (
+            "svm",
+            functools.partial(
+                classifiers.DefaultCrossesClassifier, load_from_file=None
+            ),
+        ),
+        (
+            "rff",
+            functools.partial(
+                classifiers.DefaultRFFCrossesClassifier, load_from_file=None
+            ),
+        ),
+    ]
+)
+
+# Cells of a sheet of 40 questions with 4 choices
+SHEET_CELLS = 160
+
+
+def compare_backends(sample_set, k=10, jobs=1, seed=0, batch_size=SHEET_CELLS):
+    """Returns a dictionary with the results of each backend.
+
+    Results are dictionaries with the success rates of a k-fold cross
+    evaluation with the default training params of the backend, and
+    the time, in milliseconds, for predicting `batch_size` samples.
+
+    """
+    results = collections.OrderedDict()
+    with tempfile.TemporaryDirectory() as dirname:
+        shared = evaluation.SharedSamples.create(
+            dirname, BACKENDS["svm"](), sample_set.samples(), k, seed=seed
+        )
+        try:
+            features = np.array(shared.features)
+            labels = np.array(shared.labels)
+            batch = features[:batch_size]
+            for name, factory in BACKENDS.items():
+                result = next(
+                    evaluation.kfold_evaluations(factory, shared, [None], jobs=jobs)
+                )
+                classifier = factory()
+                classifier.train_features(features, labels)
+                elapsed = min(
+                    timeit.repeat(
+                        lambda: classifier.predict_margins(batch), number=10, repeat=3
+                    )
+                )
+                results[name] = {
+                    "success_rate": float(result.success_rate),
+                    "balanced_success_rate": float(result.success_rate_balanced),
+                    "predict_ms": 1000 * elapsed / 10,
+                }
+        finally:
+            shared.close()
+    return results
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compare the backends of the classifier of crosses."
+    )
+    parser.add_argument(
+        "sample_files",
+        metavar="sample file",
+        nargs="+",
+        help="index file with the samples of crosses, or packed samples",
+    )
+    parser.add_argument(
+        "-k",
+        "--folds",
+        type=int,
+        default=10,
+        help="number of folds for k-fold cross evaluation (default 10)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of worker processes for evaluating folds (default 1)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=SHEET_CELLS,
+        help="samples per prediction when measuring time (default {})".format(
+            SHEET_CELLS
+        ),
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed for the folds")
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_args()
+    extractor = preprocessing.CrossesFeatureExtractor()
+    sample_set = sample.SampleSet()
+    for filename in args.sample_files:
+        sample_set.load_from_loader(sample.open_loader(filename), extractor=extractor)
+    results = compare_backends(
+        sample_set,
+        k=args.folds,
+        jobs=args.jobs,
+        seed=args.seed,
+        batch_size=args.batch_size,
+    )
+    print(
+        "{:8} {:>10} {:>10} {:>12}".format(
+            "backend", "success", "balanced", "predict ms"
+        )
+    )
+    for name, data in results.items():
+        print(
+            "{:8} {:>10.4f} {:>10.4f} {:>12.3f}".format(
+                name,
+                data["success_rate"],
+                data["balanced_success_rate"],
+                data["predict_ms"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2019 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+"""Compares per-cell and table rectification on a set of crosses.
+
+Every sample is classified twice: with the features of the per-cell
+homography and with the ones of the bilinear table rectification
+that the detector uses with the "rectify-tables" option.
+
+"""
+import argparse
+
+import numpy as np
+
+from . import sample
+from . import classifiers
+from . import preprocessing
+
+
+def compare_rectification(classifier, samples):
+    """Returns a dictionary with the results of both methods."""
+    extractor = classifier.features_extractor
+    per_cell = classifier.features_matrix(samples)
+    rectified = np.empty_like(per_cell)
+    for i, samp in enumerate(samples):
+        # Sample corners are already the cell without margins
+        corners = samp.corners.reshape(2, 2, 2)
+        cell = preprocessing.rectify_table(samp.image, corners, extractor.dim)
+        rectified[i, :] = (cell > 64).reshape(extractor.features_len)
+    labels = np.array([samp.label for samp in samples])
+    per_cell_labels = classifier.predict(per_cell)
+    rectified_labels = classifier.predict(rectified)
+    return {
+        "num_samples": len(samples),
+        "per_cell_success_rate": float(np.mean(per_cell_labels == labels)),
+        "rectified_success_rate": float(np.mean(rectified_labels == labels)),
+        "agreement": float(np.mean(per_cell_labels == rectified_labels)),
+        "pixel_difference": float(np.mean(per_cell != rectified)),
+    }
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compare per-cell and table rectification of crosses."
+    )
+    parser.add_argument(
+        "sample_files",
+        metavar="sample file",
+        nargs="+",
+        help="index file with the samples of crosses, or packed samples",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_args()
+    sample_set = sample.SampleSet()
+    for filename in args.sample_files:
+        sample_set.load_from_loader(sample.open_loader(filename))
+    classifier = classifiers.DefaultCrossesClassifier()
+    results = compare_rectification(classifier, sample_set.samples())
+    for key, value in results.items():
+        print("{}: {}".format(key, value))
+
+
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,7 @@ import argparse
 from . import sample
 from . import classifiers
 from . import evaluation
+from . import preprocessing
 
 
 def save_metadata(filename, metadata):
@@ -64,8 +65,15 @@ def create_digit_classifier(sample_set, rounds):
     classifier.save(classifiers.DEFAULT_DIG_CLASS_FILE)
 
 
-def create_crosses_classifier(sample_set, rounds):
-    classifier = classifiers.DefaultCrossesClassifier(load_from_file=None)
+def create_crosses_classifier(sample_set, rounds, backend="svm"):
+    if backend == "rff":
+        classifier = classifiers.DefaultRFFCrossesClassifier(load_from_file=None)
+        meta_file = classifiers.DEFAULT_RFF_CROSS_META_FILE
+        class_file = classifiers.DEFAULT_RFF_CROSS_CLASS_FILE
+    else:
+        classifier = classifiers.DefaultCrossesClassifier(load_from_file=None)
+        meta_file = classifiers.DEFAULT_CROSS_META_FILE
+        class_file = classifiers.DEFAULT_CROSS_CLASS_FILE
     e = k_fold_cross_evaluation(classifier, sample_set, rounds)
     print(
         "Success rate: {} (balanced: {})".format(
@@ -81,14 +89,14 @@ def create_crosses_classifier(sample_set, rounds):
         },
         "confusion_matrix": e.confusion_matrix_r.tolist(),
     }
-    save_metadata(classifiers.DEFAULT_CROSS_META_FILE, metadata)
+    save_metadata(meta_file, metadata)
     train_with_all(classifier, sample_set)
-    classifier.save(classifiers.DEFAULT_CROSS_CLASS_FILE)
+    classifier.save(class_file)
 
 
 def _parse_args():
     parser = argparse.ArgumentParser(
-        description="Create the SVM classifier for digits or crosses."
+        description="Create the classifier for digits or crosses."
     )
     parser.add_argument(
         "classifier", help='classifier to be created ("digits" or "crosses")'
@@ -97,7 +105,7 @@ def _parse_args():
         "sample_files",
         metavar="sample file",
         nargs="+",
-        help="index file with the samples for training/evaluation",
+        help="index file with the samples for training/evaluation, or packed samples",
     )
     parser.add_argument(
         "--rounds",
@@ -105,22 +113,43 @@ def _parse_args():
         default=10,
         help="number of rounds for k-fold cross evaluation (default 100)",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--backend",
+        choices=classifiers.CROSSES_BACKENDS,
+        default="svm",
+        help="backend of the classifier of crosses (default svm)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        help="do not keep the features of the samples in .npy files",
+    )
+    args = parser.parse_args()
+    if args.classifier == "digits" and args.backend != "svm":
+        parser.error("digits can only be classified with the svm backend")
+    return args
 
 
 def main():
     args = _parse_args()
 
-    # Load the sample set:
+    # Load the sample set, with the features of the default classifiers:
+    extractor = None
+    if args.cache:
+        if args.classifier == "digits":
+            extractor = preprocessing.FeatureExtractor()
+        else:
+            extractor = preprocessing.CrossesFeatureExtractor()
     sample_set = sample.SampleSet()
     for filename in args.sample_files:
-        sample_set.load_from_loader(sample.SampleLoader(filename))
+        sample_set.load_from_loader(sample.open_loader(filename), extractor=extractor)
 
     # Perform a k-fold cross-evaluation and create the classifier:
     if args.classifier == "digits":
         create_digit_classifier(sample_set, args.rounds)
     else:
-        create_crosses_classifier(sample_set, args.rounds)
+        create_crosses_classifier(sample_set, args.rounds, backend=args.backend)
 
 
 if __name__ == "__main__":
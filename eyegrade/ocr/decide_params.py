@@ -16,34 +16,168 @@
 # <https://www.gnu.org/licenses/>.
 #
 import argparse
+import csv
+import functools
 import math
+import os
+import sys
+import tempfile
 
 import numpy as np
 
 from . import sample
 from . import classifiers
 from . import evaluation
+from .. import utils
 
+LOG_FIELDS = ("C", "gamma", "success_rate", "success_rate_balanced", "folds")
 
-def decide_params(classifier, sample_set, c_values, gamma_values, threshold=None, k=10):
+# Settings of a search, which a resumed one must share
+LOG_SETTINGS = ("k", "seed", "classifier", "samples")
+
+utils.EyegradeException.register_error(
+    "incompatible_log",
+    short_message=(
+        "The log file {0} was created with a different {1}. "
+        "Use another log file, or remove it for starting a new search."
+    ),
+)
+
+
+def decide_params(
+    classifier_factory,
+    sample_set,
+    c_values,
+    gamma_values,
+    threshold=None,
+    k=10,
+    jobs=1,
+    log_file=None,
+    seed=0,
+):
+    """Evaluates a classifier for every pair of C and gamma values.
+
+    `classifier_factory` creates untrained classifiers, and must be
+    picklable when `jobs` is greater than one. The folds of every
+    pair are evaluated in that number of worker processes, which
+    share the features of the samples through memory-mapped files.
+    A classifier can be passed instead of the factory, as in older
+    versions, and it is then reset and trained again for every fold,
+    without worker processes.
+
+    Each result is appended to the CSV file `log_file`, if given, as
+    soon as it is known. Pairs already in that file are not evaluated
+    again, so that an interrupted search can be resumed. The file
+    also records `k`, `seed`, the kind of classifier and a hash of
+    the samples, and a search with other ones cannot resume from it.
+
+    Returns the list of (success_rate, success_rate_balanced, C, gamma)
+    tuples, in the order of the grid, and the matrix of success rates.
+
+    """
+    if isinstance(classifier_factory, classifiers.Classifier):
+        if jobs > 1:
+            raise ValueError("Worker processes need a classifier factory")
+        classifier_factory = functools.partial(_reset, classifier_factory)
+    grid = [(c, gamma) for c in c_values for gamma in gamma_values]
+    with tempfile.TemporaryDirectory() as dirname:
+        classifier = classifier_factory()
+        shared = evaluation.SharedSamples.create(
+            dirname, classifier, sample_set.samples(), k, seed=seed
+        )
+        try:
+            settings = _log_settings(classifier, shared, k, seed)
+            done = read_log(log_file, settings) if log_file is not None else {}
+            params_list = [
+                dict(C=c, gamma=gamma) for c, gamma in grid if (c, gamma) not in done
+            ]
+            for result in evaluation.kfold_evaluations(
+                classifier_factory, shared, params_list, jobs=jobs, threshold=threshold,
+            ):
+                c, gamma = result.params["C"], result.params["gamma"]
+                done[(c, gamma)] = (result.success_rate, result.success_rate_balanced)
+                print(
+                    "C: {}, gamma: {}, folds: {}: {}".format(
+                        c, gamma, result.num_folds, done[(c, gamma)]
+                    )
+                )
+                if log_file is not None:
+                    _append_to_log(log_file, result, settings)
+        finally:
+            shared.close()
     results = []
     rmat = np.zeros(shape=(len(c_values), len(gamma_values)), dtype="float32")
-    partitions = sample_set.partition(k)
     for i, c in enumerate(c_values):
         for j, gamma in enumerate(gamma_values):
-            params = dict(C=c, gamma=gamma)
-            print("C: {}, gamma: {}".format(c, gamma))
-            e = evaluation.KFoldCrossEvaluation(
-                classifier, partitions, training_params=params, threshold=threshold
-            )
-            result = (e.success_rate, e.success_rate_balanced, c, gamma)
-            results.append(result)
-            rmat[i, j] = e.success_rate
-            print(result)
-            print(rmat)
+            success_rate, success_rate_balanced = done[(c, gamma)]
+            results.append((success_rate, success_rate_balanced, c, gamma))
+            rmat[i, j] = success_rate
     return results, rmat
 
 
+def _reset(classifier):
+    classifier.reset()
+    return classifier
+
+
+def _log_settings(classifier, shared, k, seed):
+    return {
+        "k": str(k),
+        "seed": str(seed),
+        "classifier": "{}:{}".format(
+            type(classifier).__name__, classifier.features_key
+        ),
+        "samples": shared.fingerprint(),
+    }
+
+
+def read_log(log_file, settings=None):
+    """Returns the results in a log, as {(C, gamma): (rate, balanced rate)}.
+
+    With `settings`, raises EyegradeException if the log was written
+    by a search with other ones (see `decide_params`).
+
+    """
+    done = {}
+    if os.path.exists(log_file):
+        with open(log_file, newline="") as f:
+            for row in csv.DictReader(f):
+                if settings is not None:
+                    _check_settings(log_file, row, settings)
+                done[(float(row["C"]), float(row["gamma"]))] = (
+                    float(row["success_rate"]),
+                    float(row["success_rate_balanced"]),
+                )
+    return done
+
+
+def _check_settings(log_file, row, settings):
+    for name in LOG_SETTINGS:
+        if row.get(name) != settings[name]:
+            raise utils.EyegradeException(
+                "", key="incompatible_log", format_params=(log_file, name)
+            )
+
+
+def _append_to_log(log_file, result, settings):
+    new_file = not os.path.exists(log_file)
+    with open(log_file, "a", newline="") as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(LOG_FIELDS + LOG_SETTINGS)
+        # repr() keeps all the digits, so that resumed searches find them
+        writer.writerow(
+            (
+                repr(result.params["C"]),
+                repr(result.params["gamma"]),
+                repr(result.success_rate),
+                repr(result.success_rate_balanced),
+                result.num_folds,
+            )
+            + tuple(settings[name] for name in LOG_SETTINGS)
+        )
+
+
 def _parse_args():
     parser = argparse.ArgumentParser(description="Look for the best SVM parameters.")
     parser.add_argument(
@@ -53,7 +187,7 @@ def _parse_args():
         "sample_files",
         metavar="sample file",
         nargs="+",
-        help="index file with the samples for training/evaluation",
+        help="index file with the samples for training/evaluation, or packed samples",
     )
     parser.add_argument(
         "--rounds",
@@ -61,27 +195,65 @@ def _parse_args():
         default=10,
         help="number of rounds for k-fold cross evaluation (default 10)",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of worker processes (0 for one per CPU; default 1)",
+    )
+    parser.add_argument(
+        "--log",
+        dest="log_file",
+        default=None,
+        help="CSV file to save results into, and to resume the search from",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed of folds")
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        help="do not keep the features of the samples in .npy files",
+    )
     return parser.parse_args()
 
 
 def main():
     args = _parse_args()
-    sample_set = sample.SampleSet()
-    for filename in args.sample_files:
-        sample_set.load_from_loader(sample.SampleLoader(filename))
     if args.classifier == "digits":
-        classifier = classifiers.DefaultDigitClassifier(
-            load_from_file=None, confusion_matrix_from_file=None
+        classifier_factory = functools.partial(
+            classifiers.DefaultDigitClassifier,
+            load_from_file=None,
+            confusion_matrix_from_file=None,
         )
         threshold = 0.9
     else:
-        classifier = classifiers.DefaultCrossesClassifier(load_from_file=None)
+        classifier_factory = functools.partial(
+            classifiers.DefaultCrossesClassifier, load_from_file=None
+        )
         threshold = 0.99
+    # Features are computed once for all the folds and grid points
+    extractor = classifier_factory().features_extractor if args.cache else None
+    sample_set = sample.SampleSet()
+    for filename in args.sample_files:
+        sample_set.load_from_loader(sample.open_loader(filename), extractor=extractor)
     c_values = [math.pow(10, i) for i in np.linspace(0, 4, 9)]
     gamma_values = [math.pow(10, i) for i in np.linspace(-3, -1, 5)]
-    r = decide_params(
-        classifier, sample_set, c_values, gamma_values, threshold=threshold
-    )
+    try:
+        r = decide_params(
+            classifier_factory,
+            sample_set,
+            c_values,
+            gamma_values,
+            threshold=threshold,
+            k=args.rounds,
+            jobs=args.jobs if args.jobs > 0 else os.cpu_count(),
+            log_file=args.log_file,
+            seed=args.seed,
+        )
+    except utils.EyegradeException as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
     print(r)
 
 
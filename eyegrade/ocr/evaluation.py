@@ -15,10 +15,20 @@
 # along with this program.  If not, see
 # <https://www.gnu.org/licenses/>.
 #
+import concurrent.futures
+import hashlib
+import os
+
 import numpy as np
 
 from . import sample
 
+# Samples whose features are computed at once when sharing them
+_FEATURES_CHUNK = 1000
+
+# Arrays memory-mapped by this process, by file name
+_mapped_arrays = {}
+
 
 class Evaluation:
     def __init__(self, classifier, samples):
@@ -41,8 +51,11 @@ class Evaluation:
         num_classes = self.classifier.num_classes
         self.results = np.zeros(len(self.samples), dtype=bool)
         self.confusion_matrix = np.zeros(shape=(num_classes, num_classes), dtype="int")
-        for i, samp in enumerate(self.samples):
-            detected = self.classifier.classify(samp)
+        # All the samples are classified at once, with a single prediction
+        samples = list(self.samples)
+        for i, (samp, detected) in enumerate(
+            zip(samples, self.classifier.classify_many(samples))
+        ):
             self.confusion_matrix[samp.label, detected] += 1
             self.results[i] = samp.check_label(detected)
         self.success_rate = sum(self.results) / len(self.results)
@@ -82,3 +95,197 @@ class KFoldCrossEvaluation(Evaluation):
             print("Round {}: {}".format(i, self.success_rate))
             if self.threshold is not None and self.success_rate < self.threshold:
                 break
+
+
+class KFoldResult(Evaluation):
+    """Aggregated result of the folds evaluated for some training params."""
+
+    def __init__(self, params, confusion_matrix, num_folds):
+        self.params = params
+        self.confusion_matrix = confusion_matrix
+        self.num_folds = num_folds
+        total = confusion_matrix.sum()
+        self.success_rate = confusion_matrix.diagonal().sum() / total if total else 0.0
+
+
+class SharedSamples:
+    """Features, labels and folds of a sample set, shared by processes.
+
+    They are saved as .npy files into a directory, and each process
+    memory-maps them instead of receiving a copy. Only the name of
+    the directory is sent to worker processes.
+
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    @classmethod
+    def create(cls, dirname, classifier, samples, k, seed=0):
+        """Saves the samples into `dirname`, partitioned into `k` folds.
+
+        Features are computed with `classifier.features_matrix`, so
+        that features already attached to the samples are reused. The
+        same `seed` gives the same folds for the same samples.
+
+        """
+        shared = cls(dirname)
+        features = np.lib.format.open_memmap(
+            shared._path("features"),
+            mode="w+",
+            dtype=np.float32,
+            shape=(len(samples), classifier.features_len),
+        )
+        for pos in range(0, len(samples), _FEATURES_CHUNK):
+            chunk = samples[pos : pos + _FEATURES_CHUNK]
+            features[pos : pos + len(chunk)] = classifier.features_matrix(chunk)
+        features.flush()
+        del features
+        labels = np.array([samp.label for samp in samples], dtype=np.int32)
+        np.save(shared._path("labels"), labels)
+        positions = np.random.RandomState(seed).permutation(len(samples))
+        np.save(shared._path("folds"), (positions % k).astype(np.int32))
+        return shared
+
+    @property
+    def features(self):
+        return self._load("features")
+
+    @property
+    def labels(self):
+        return self._load("labels")
+
+    @property
+    def folds(self):
+        return self._load("folds")
+
+    @property
+    def num_folds(self):
+        return int(self.folds.max()) + 1 if len(self.folds) else 0
+
+    def fingerprint(self):
+        """Returns a hash of the features and labels of the samples."""
+        digest = hashlib.sha1()
+        for name in ("features", "labels"):
+            digest.update(memoryview(self._load(name)))
+        return digest.hexdigest()
+
+    def close(self):
+        """Unmaps the files in this process, before removing them."""
+        for name in ("features", "labels", "folds"):
+            _mapped_arrays.pop(self._path(name), None)
+
+    def _load(self, name):
+        filename = self._path(name)
+        if filename not in _mapped_arrays:
+            _mapped_arrays[filename] = np.load(filename, mmap_mode="r")
+        return _mapped_arrays[filename]
+
+    def _path(self, name):
+        return os.path.join(self.dirname, name + ".npy")
+
+
+def evaluate_fold(classifier_factory, shared, fold, params=None):
+    """Trains with all the folds but `fold`, and evaluates with it.
+
+    `classifier_factory` is called to create an untrained classifier
+    (it must be picklable for running in worker processes). Returns
+    the confusion matrix of the evaluation.
+
+    """
+    classifier = classifier_factory()
+    features = shared.features
+    labels = shared.labels
+    folds = shared.folds
+    training = folds != fold
+    classifier.train_features(features[training], labels[training], params=params)
+    evaluation = np.flatnonzero(folds == fold)
+    detected = classifier.predict(features[evaluation])
+    num_classes = classifier.num_classes
+    confusion_matrix = np.zeros(shape=(num_classes, num_classes), dtype="int")
+    np.add.at(confusion_matrix, (labels[evaluation], detected), 1)
+    return confusion_matrix
+
+
+def kfold_evaluations(classifier_factory, shared, params_list, jobs=1, threshold=None):
+    """Runs a k-fold cross evaluation for each of the training params.
+
+    Every fold of every params is a separate task, and with `jobs`
+    greater than one they run in that number of worker processes.
+    Yields a `KFoldResult` for each params as soon as all its folds
+    finish, so results may not come in the order of `params_list`.
+
+    With a `threshold`, the remaining folds of some params are not
+    evaluated once the success rate of the ones finished falls below
+    it, and the result covers only the folds evaluated. Folds are
+    aggregated in their order also in worker processes, so that the
+    result is the same regardless of `jobs`.
+
+    """
+    if jobs > 1:
+        yield from _kfold_evaluations_in_pool(
+            classifier_factory, shared, params_list, jobs, threshold
+        )
+        return
+    for params in params_list:
+        result = None
+        for fold in range(shared.num_folds):
+            confusion_matrix = evaluate_fold(classifier_factory, shared, fold, params)
+            result = _add_fold(result, params, confusion_matrix)
+            if threshold is not None and result.success_rate < threshold:
+                break
+        yield result
+
+
+def _kfold_evaluations_in_pool(
+    classifier_factory, shared, params_list, jobs, threshold
+):
+    num_folds = shared.num_folds
+    results = [None] * len(params_list)
+    pending = [set() for _ in params_list]
+    # Confusion matrices of finished folds not aggregated yet, by fold
+    finished = [{} for _ in params_list]
+    next_folds = [0] * len(params_list)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {}
+        for idx, params in enumerate(params_list):
+            for fold in range(num_folds):
+                future = pool.submit(
+                    evaluate_fold, classifier_factory, shared, fold, params
+                )
+                futures[future] = idx, fold
+                pending[idx].add(future)
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                idx, fold = futures[future]
+                if future not in pending[idx]:
+                    # Cancelled, or still running when its params finished
+                    continue
+                pending[idx].remove(future)
+                finished[idx][fold] = future.result()
+                params = params_list[idx]
+                done = False
+                while next_folds[idx] in finished[idx] and not done:
+                    confusion_matrix = finished[idx].pop(next_folds[idx])
+                    results[idx] = _add_fold(results[idx], params, confusion_matrix)
+                    next_folds[idx] += 1
+                    done = next_folds[idx] == num_folds or (
+                        threshold is not None and results[idx].success_rate < threshold
+                    )
+                if done:
+                    for other in pending[idx]:
+                        other.cancel()
+                    pending[idx].clear()
+                    yield results[idx]
+        finally:
+            # Do not wait for the tasks of an interrupted search
+            for future in futures:
+                future.cancel()
+
+
+def _add_fold(result, params, confusion_matrix):
+    if result is None:
+        return KFoldResult(params, confusion_matrix, 1)
+    return KFoldResult(
+        params, result.confusion_matrix + confusion_matrix, result.num_folds + 1
+    )
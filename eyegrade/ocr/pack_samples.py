@@ -0,0 +1,52 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2018 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+import argparse
+
+from . import sample
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description="Convert samples between the tab-separated and packed formats."
+    )
+    parser.add_argument(
+        "input",
+        help="samples file; packed if it ends with {}".format(sample.PACKED_EXTENSION),
+    )
+    parser.add_argument(
+        "output",
+        help="samples file to create; images of unpacked samples are saved "
+        "into its directory",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_args()
+    if args.input.endswith(sample.PACKED_EXTENSION):
+        sample.unpack_samples(args.input, args.output)
+    else:
+        if not args.output.endswith(sample.PACKED_EXTENSION):
+            raise SystemExit(
+                "Packed files must end with {}".format(sample.PACKED_EXTENSION)
+            )
+        sample.pack_samples(sample.SampleLoader(args.input).samples(), args.output)
+
+
+if __name__ == "__main__":
+    main()
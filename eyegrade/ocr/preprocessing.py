@@ -35,6 +35,22 @@ class FeatureExtractor:
     def extract(self, sample):
         image = self._reshape(sample)
         image = deskew(image, self.dim)
+        return self._features(image)
+
+    def extract_many(self, samples):
+        """Returns a matrix with the features of a sample in each row.
+
+        It is the same as calling `extract` for each sample, but the
+        samples are deskewed all at once (see `deskew_many`).
+
+        """
+        features = np.empty((len(samples), self.features_len), dtype=np.float32)
+        images = deskew_many([self._reshape(sample) for sample in samples], self.dim)
+        for i, image in enumerate(images):
+            features[i, :] = self._features(image)
+        return features
+
+    def _features(self, image):
         image = clear_boundbox(image)
         image = cv2.resize(image, (self.dim, self.dim))
         image_matrix = np.array(image, np.float32) / 255.0
@@ -79,6 +95,26 @@ class CrossesFeatureExtractor(FeatureExtractor):
         feature_vector = image_matrix.reshape(self.features_len)
         return feature_vector
 
+    def extract_many(self, samples):
+        """Returns a matrix with the features of a sample in each row."""
+        return _extract_each(self, samples)
+
+    def extract_table(self, image, corners):
+        """Returns the features of all the cells of an answer table.
+
+        `corners` is the matrix of corners of the table, as computed by
+        the detector. The table is rectified at once instead of cell by
+        cell, with the same margins as `sample.CrossSampleFromCam`.
+        Rows of the result follow the order of the cells in the table.
+
+        """
+        cells = rectify_table(image, corners, self.dim, margin=0.1)
+        num_rows, num_columns = cells.shape[:2]
+        binary = cells > 64
+        return binary.reshape(num_rows * num_columns, self.features_len).astype(
+            np.float32
+        )
+
 
 class OpenCVExampleExtractor:
     def __init__(self, dim=20, threshold=False):
@@ -99,6 +135,10 @@ class OpenCVExampleExtractor:
         feature_vector = self._preprocess_hog(image)
         return feature_vector
 
+    def extract_many(self, samples):
+        """Returns a matrix with the features of a sample in each row."""
+        return _extract_each(self, samples)
+
     def _preprocess_hog(self, image):
         gx = cv2.Sobel(image, cv2.CV_32F, 1, 0)
         gy = cv2.Sobel(image, cv2.CV_32F, 0, 1)
@@ -120,6 +160,57 @@ class OpenCVExampleExtractor:
         return np.float32(hist)
 
 
+def extractor_key(extractor):
+    """Returns a string that identifies a feature extractor and its parameters.
+
+    Two extractors with the same key compute the same features.
+
+    """
+    params = sorted(
+        (name, value)
+        for name, value in vars(extractor).items()
+        if not name.startswith("_") and isinstance(value, (bool, int, float, str))
+    )
+    return "-".join(
+        [type(extractor).__name__]
+        + ["{}{}".format(name.replace("_", ""), value) for name, value in params]
+    )
+
+
+def _extract_each(extractor, samples):
+    features = np.empty((len(samples), extractor.features_len), dtype=np.float32)
+    for i, sample in enumerate(samples):
+        features[i, :] = extractor.extract(sample)
+    return features
+
+
+def rectify_table(image, corners, dim, margin=0.0):
+    """Projects all the cells of a table into a grid of dim x dim squares.
+
+    `corners` is a (rows + 1) x (columns + 1) matrix of points. Each
+    cell is mapped with bilinear interpolation of its four corners,
+    leaving out the given `margin` (a fraction of the cell size) at
+    each side. Returns a rows x columns x dim x dim view of the
+    rectified image, so that `result[i, j]` is the image of a cell.
+
+    """
+    corners = np.asarray(corners, dtype=np.float32)
+    num_rows = corners.shape[0] - 1
+    num_columns = corners.shape[1] - 1
+    steps = margin + (1 - 2 * margin) * np.arange(dim, dtype=np.float32) / (dim - 1)
+    # Interpolate first along the vertical lines of the table
+    # and then between each pair of them:
+    top = corners[:-1, np.newaxis]
+    bottom = corners[1:, np.newaxis]
+    vertical = top + steps[:, np.newaxis, np.newaxis] * (bottom - top)
+    left = vertical[:, :, :-1, np.newaxis]
+    right = vertical[:, :, 1:, np.newaxis]
+    maps = left + steps[:, np.newaxis] * (right - left)
+    maps = maps.reshape(num_rows * dim, num_columns * dim, 2)
+    grid = cv2.remap(image, maps, None, cv2.INTER_LINEAR)
+    return grid.reshape(num_rows, dim, num_columns, dim).swapaxes(1, 2)
+
+
 def deskew(image, dim):
     """Deskew an image.
 
@@ -127,11 +218,54 @@ def deskew(image, dim):
     The image must be a cv2 image.
 
     """
-    affine_flags = cv2.WARP_INVERSE_MAP | cv2.INTER_LINEAR
     m = cv2.moments(image)
-    if abs(m["mu02"]) < 1e-2:
+    return _deskew_with_moments(image, dim, m["mu11"], m["mu02"])
+
+
+def deskew_many(images, dim):
+    """Deskew a sequence of images at once.
+
+    The result is the same as calling `deskew` for each image, but
+    the moments of all of them are computed together. Images may have
+    different sizes. Returns a list with the deskewed images.
+
+    """
+    if not images:
+        return []
+    height = max(image.shape[0] for image in images)
+    width = max(image.shape[1] for image in images)
+    # Padding with zeros does not change the moments
+    stack = np.zeros((len(images), height, width))
+    for i, image in enumerate(images):
+        stack[i, : image.shape[0], : image.shape[1]] = image
+    ys = np.arange(height, dtype=np.float64)
+    xs = np.arange(width, dtype=np.float64)
+    rows = stack.sum(axis=2)
+    # Raw moments are integers, exact in double precision for images
+    # of this size, as in OpenCV for 8-bit images. Central moments
+    # are then computed from them the same way OpenCV does.
+    m00 = rows.sum(axis=1)
+    m01 = rows.dot(ys)
+    m02 = rows.dot(ys * ys)
+    m10 = stack.sum(axis=1).dot(xs)
+    m11 = stack.dot(xs).dot(ys)
+    non_empty = np.abs(m00) > np.finfo(np.float64).eps
+    inv_m00 = np.zeros(len(images))
+    inv_m00[non_empty] = 1.0 / m00[non_empty]
+    cy = m01 * inv_m00
+    mu11 = m11 - m10 * cy
+    mu02 = m02 - m01 * cy
+    return [
+        _deskew_with_moments(image, dim, image_mu11, image_mu02)
+        for image, image_mu11, image_mu02 in zip(images, mu11.tolist(), mu02.tolist())
+    ]
+
+
+def _deskew_with_moments(image, dim, mu11, mu02):
+    affine_flags = cv2.WARP_INVERSE_MAP | cv2.INTER_LINEAR
+    if abs(mu02) < 1e-2:
         return image.copy()
-    skew = m["mu11"] / m["mu02"]
+    skew = mu11 / mu02
     M = np.float32([[1, skew, -0.5 * dim * skew], [0, 1, 0]])
     image = cv2.warpAffine(image, M, (dim, dim), flags=affine_flags)
     return image
@@ -144,27 +278,33 @@ def clear_boundbox(image):
     The image must be a cv2 image.
 
     """
-    top = 0
-    bot = image.shape[0]
-    right = image.shape[1]
-    left = 0
-    it = 0
-    for index, row in enumerate(image):
-        if not np.all(row == 0) and it == 0:
-            if index == image.shape[0] or not np.all(image[index + 1] == 0):
-                top = index
-                it = 1
-        elif np.all(row == 0) and it == 1:
-            bot = index
-            break
-    it = 0
-    for index, col in enumerate(image.T):
-        if (not np.all(col == 0)) and it == 0:
-            if index + 2 >= image.shape[1] or not np.all(image.T[index + 2] == 0):
-                left = index
-                it = 1
-        elif np.all(col == 0) and it == 1:
-            right = index
-            break
+    top, bot = _boundbox_range(np.any(image, axis=1), 1, False)
+    left, right = _boundbox_range(np.any(image, axis=0), 2, True)
     cleared_image = image[top:bot, left:right]
     return cleared_image
+
+
+def _boundbox_range(non_blank, gap, open_end):
+    """Returns the range of non-blank lines of an image along an axis.
+
+    The range starts at the first non-blank line that has another
+    non-blank line `gap` lines after it (lines closer than `gap` to
+    the end also qualify if `open_end` is True), and ends just before
+    the next blank line. Stray lines of noise are skipped this way.
+    Without such a starting line, the whole axis is returned.
+
+    """
+    length = len(non_blank)
+    tail = max(length - gap, 0)
+    starts = non_blank[:tail] & non_blank[gap:]
+    ini = int(np.argmax(starts)) if tail else 0
+    if not tail or not starts[ini]:
+        if not open_end or not non_blank[tail:].any():
+            return 0, length
+        ini = tail + int(np.argmax(non_blank[tail:]))
+    # argmin returns the first blank line, if any
+    rest = non_blank[ini + 1 :]
+    end = int(np.argmin(rest)) if len(rest) else 0
+    if len(rest) == 0 or rest[end]:
+        return ini, length
+    return ini, ini + 1 + end
@@ -17,13 +17,22 @@
 #
 import os
 import collections
+import json
 import random
 
 import cv2
 import numpy as np
 
+from . import preprocessing
 from .. import geometry as g
 
+# Samples whose features are computed at once when building a cache
+_FEATURES_CHUNK = 1000
+
+# Extension of the files of packed samples (see `pack_samples`)
+# Distinct from the ".npy" feature caches (see `samples_with_features`)
+PACKED_EXTENSION = ".samples.npy"
+
 
 class Sample:
     def __init__(self, corners, image=None, image_filename=None, label=None):
@@ -36,6 +45,7 @@ class Sample:
         self.label = label
         self._image = image
         self._features = None
+        self._features_key = None
 
     @property
     def image(self):
@@ -48,6 +58,19 @@ class Sample:
     def check_label(self, label):
         return self.label == label
 
+    def set_features(self, features, key):
+        """Attaches precomputed features, from the extractor named `key`."""
+        self._features = features
+        self._features_key = key
+
+    def features(self, key):
+        """Returns the precomputed features for the given extractor, if any.
+
+        `key` identifies the extractor, as `preprocessing.extractor_key`.
+
+        """
+        return self._features if self._features_key == key else None
+
     def crop(self):
         min_x = min(self.corners[:, 0])
         max_x = max(self.corners[:, 0])
@@ -90,8 +113,18 @@ class SampleSet:
     def distribution(self):
         return [(label, len(self.samples_dict[label])) for label in self.samples_dict]
 
-    def load_from_loader(self, loader):
-        self.load_from_samples(loader.iterate_samples())
+    def load_from_loader(self, loader, extractor=None):
+        """Loads the samples of a `SampleLoader`.
+
+        With an `extractor`, their features are loaded or computed
+        at once (see `SampleLoader.samples_with_features`), so that
+        classifiers using the same extractor do not compute them again.
+
+        """
+        if extractor is None:
+            self.load_from_samples(loader.iterate_samples())
+        else:
+            self.load_from_samples(loader.samples_with_features(extractor))
 
     def load_from_samples(self, samples):
         for sample in samples:
@@ -134,13 +167,14 @@ class SampleSet:
         for i in range(total_samples % num_groups):
             partition_lens[i] += 1
         partitions = []
-        samples = set(self.samples())
+        samples = self.samples()
+        random.shuffle(samples)
+        pos = 0
         for partition_len in partition_lens:
-            partition = random.sample(samples, partition_len)
-            samples -= set(partition)
             sample_set = SampleSet()
-            sample_set.load_from_samples(partition)
+            sample_set.load_from_samples(samples[pos : pos + partition_len])
             partitions.append(sample_set)
+            pos += partition_len
         return partitions
 
     def oversample(self):
@@ -190,6 +224,74 @@ class SampleLoader:
     def samples(self):
         return [sample for sample in self.iterate_samples()]
 
+    def samples_with_features(self, extractor):
+        """Returns the samples, with their features already attached.
+
+        Features are saved into a .npy file next to the samples file,
+        named after the extractor and its parameters, and the size,
+        modification time and number of samples of the samples file
+        into a .json file next to it. When both files exist and the
+        samples file has not changed since, the features are
+        memory-mapped instead of computed again, and each sample gets
+        a view of its row. Remove the files to compute them again,
+        e.g. after changing the images of the samples.
+
+        """
+        samples = self.samples()
+        key = preprocessing.extractor_key(extractor)
+        filename = self.features_filename(key)
+        features = self._load_features(filename, len(samples), extractor.features_len)
+        if features is None:
+            features = self._compute_features(filename, samples, extractor)
+        for sample, row in zip(samples, features):
+            sample.set_features(row, key)
+        return samples
+
+    def features_filename(self, key):
+        return "{}.{}.npy".format(self.filename, key)
+
+    def _source_info(self, num_samples):
+        stat = os.stat(self.filename)
+        return {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "num_samples": num_samples,
+        }
+
+    def _load_features(self, filename, num_samples, features_len):
+        try:
+            with open(filename + ".json") as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if info != self._source_info(num_samples) or not os.path.exists(filename):
+            return None
+        features = np.load(filename, mmap_mode="r")
+        if features.shape != (num_samples, features_len):
+            return None
+        return features
+
+    def _compute_features(self, filename, samples, extractor):
+        # Written to a temporary file first, so that an interrupted
+        # computation does not leave a truncated cache behind
+        tmp_filename = filename + ".tmp.npy"
+        features = np.lib.format.open_memmap(
+            tmp_filename,
+            mode="w+",
+            dtype=np.float32,
+            shape=(len(samples), extractor.features_len),
+        )
+        for pos in range(0, len(samples), _FEATURES_CHUNK):
+            chunk = samples[pos : pos + _FEATURES_CHUNK]
+            features[pos : pos + len(chunk)] = extractor.extract_many(chunk)
+        features.flush()
+        del features
+        os.replace(tmp_filename, filename)
+        # Written last: a cache without it is never taken
+        with open(filename + ".json", "w") as f:
+            json.dump(self._source_info(len(samples)), f)
+        return np.load(filename, mmap_mode="r")
+
     def iterate_samples(self):
         with open(self.filename, mode="r") as f:
             for line in f:
@@ -214,6 +316,102 @@ class SampleLoader:
         return Sample(corners, image_filename=image_path, label=label)
 
 
+class PackedSampleLoader(SampleLoader):
+    """Loads the samples of a file created by `pack_samples`.
+
+    The file is memory-mapped, and the image of each sample is a view
+    of its record, so loading does not read any image file.
+
+    """
+
+    def iterate_samples(self):
+        records = np.load(self.filename, mmap_mode="r")
+        images = records["image"]
+        corners = np.array(records["corners"])
+        sizes = records["size"].tolist()
+        labels = records["label"].tolist()
+        for i, (height, width) in enumerate(sizes):
+            yield Sample(corners[i], image=images[i, :height, :width], label=labels[i])
+
+
+def open_loader(filename):
+    """Returns the loader for a samples file, packed or tab-separated."""
+    if filename.endswith(PACKED_EXTENSION):
+        return PackedSampleLoader(filename)
+    else:
+        return SampleLoader(filename)
+
+
+def pack_samples(samples, filename):
+    """Saves labelled samples into a single, memory-mappable file.
+
+    The file contains a NumPy structured array with a record per
+    sample: its label, the corners of its cell, and its image cropped
+    to those corners. Images are padded with zeros to the size of the
+    largest one, which is stored with each record.
+
+    Records are written one by one into the memory-mapped file, and
+    images loaded from files are not kept in memory afterwards, so
+    that large sets can be packed.
+
+    """
+    # The size of the crops is known from the corners, without images
+    height = max((_crop_size(samp.corners)[0] for samp in samples), default=0)
+    width = max((_crop_size(samp.corners)[1] for samp in samples), default=0)
+    dtype = np.dtype(
+        [
+            ("label", np.int32),
+            ("corners", np.int32, (4, 2)),
+            ("size", np.int32, (2,)),
+            ("image", np.uint8, (height, width)),
+        ]
+    )
+    records = np.lib.format.open_memmap(
+        filename, mode="w+", dtype=dtype, shape=(len(samples),)
+    )
+    for record, original in zip(records, samples):
+        loaded = original._image is not None
+        samp = original.crop()
+        image = samp.image
+        record["label"] = original.label
+        record["corners"] = samp.corners
+        record["size"] = image.shape
+        record["image"][: image.shape[0], : image.shape[1]] = image
+        if not loaded:
+            original._image = None
+    records.flush()
+
+
+def _crop_size(corners):
+    """Returns the (height, width) of `Sample.crop` for these corners.
+
+    The crop can be smaller, if the corners fall outside the image.
+
+    """
+    corners = corners.astype(int)
+    return (
+        corners[:, 1].max() - corners[:, 1].min() + 1,
+        corners[:, 0].max() - corners[:, 0].min() + 1,
+    )
+
+
+def unpack_samples(filename, samples_filename):
+    """Saves packed samples as image files and a tab-separated samples file.
+
+    Images are saved into the directory of `samples_filename`, with
+    the same naming as the sample extraction scripts.
+
+    """
+    dirname = os.path.dirname(samples_filename)
+    with open(samples_filename, mode="w") as f:
+        for i, samp in enumerate(PackedSampleLoader(filename).iterate_samples()):
+            image_file = "sample-{}-{}.png".format(samp.label, i)
+            cv2.imwrite(os.path.join(dirname, image_file), samp.image)
+            data = [image_file, str(samp.label)]
+            data.extend(str(n) for n in samp.corners.reshape(8).tolist())
+            print("\t".join(data), file=f)
+
+
 def adjust_cell_corners(image, corners):
     plu = adjust_cell_corner(image, corners[0, :], corners[3, :])
     prd = adjust_cell_corner(image, corners[3, :], corners[0, :])
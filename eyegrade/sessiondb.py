@@ -18,6 +18,8 @@
 import sqlite3
 import os
 
+import numpy as np
+
 from . import utils
 from . import scoring
 from . import exams
@@ -527,24 +529,30 @@ class SessionDB:
         return capture.ExamCapture(image, answer_cells, id_cells)
 
     def _read_answer_cells(self, exam_id):
-        all_cells = []
-        question_cells = []
-        last_question_num = None
         cursor = self.conn.cursor()
-        for row in cursor.execute(
-            "SELECT * FROM AnswerCells WHERE exam_id=? " "ORDER BY question, choice",
+        cursor.execute(
+            "SELECT question, choice, center_x, center_y, diagonal, "
+            "lux, luy, rux, ruy, ldx, ldy, rdx, rdy "
+            "FROM AnswerCells WHERE exam_id=? ORDER BY question, choice",
             (exam_id,),
-        ):
-            cell = _create_cell_from_row(row, is_id_cell=False)
-            if last_question_num is None:
-                last_question_num = row["question"]
-            elif last_question_num != row["question"]:
-                all_cells.append(question_cells)
-                last_question_num = row["question"]
-                question_cells = []
-            question_cells.append(cell)
-        all_cells.append(question_cells)
-        return all_cells
+        )
+        # Corners are NULL in sessions created by old versions
+        rows = np.array(cursor.fetchall(), dtype=float).reshape((-1, 13))
+        rows = np.nan_to_num(rows)
+        indices = rows[:, :2].astype(int)
+        shape = tuple(indices.max(axis=0) + 1) if len(rows) else (0, 0)
+        corners = np.zeros(shape + (4, 2), dtype=np.int32)
+        centers = np.zeros(shape + (2,), dtype=np.int32)
+        diagonals = np.zeros(shape)
+        questions, choices = indices[:, 0], indices[:, 1]
+        corners[questions, choices] = rows[:, 5:].reshape((-1, 4, 2))
+        centers[questions, choices] = rows[:, 2:4]
+        diagonals[questions, choices] = rows[:, 4]
+        num_choices = np.zeros(shape[0], dtype=int)
+        np.maximum.at(num_choices, questions, choices + 1)
+        return capture.CellGrid(
+            corners, choices=num_choices, centers=centers, diagonals=diagonals
+        )
 
     def _read_id_cells(self, exam_id):
         cells = []
@@ -828,26 +836,22 @@ class SessionDB:
                 self.conn.commit()
 
     def _store_answer_cells(self, exam_id, answer_cells, commit=True):
-        data = []
-        for i, question_cells in enumerate(answer_cells):
-            for j, cell in enumerate(question_cells):
-                item = (
-                    exam_id,
-                    i,
-                    j,
-                    cell.center[0],
-                    cell.center[1],
-                    cell.diagonal,
-                    cell.plu[0],
-                    cell.plu[1],
-                    cell.pru[0],
-                    cell.pru[1],
-                    cell.pld[0],
-                    cell.pld[1],
-                    cell.prd[0],
-                    cell.prd[1],
-                )
-                data.append(item)
+        if not isinstance(answer_cells, capture.CellGrid):
+            answer_cells = capture.CellGrid.from_cells(answer_cells)
+        mask = answer_cells.mask()
+        questions, choices = np.nonzero(mask)
+        columns = [
+            questions,
+            choices,
+            answer_cells.centers[mask],
+            answer_cells.corners[mask].reshape((-1, 8)),
+        ]
+        data = [
+            (exam_id, question, choice, x, y, diagonal, *corners)
+            for (question, choice, x, y, *corners), diagonal in zip(
+                np.column_stack(columns).tolist(), answer_cells.diagonals[mask].tolist()
+            )
+        ]
         if data:
             cursor = self.conn.cursor()
             cursor.executemany(
@@ -953,6 +957,8 @@ class ExamDecisionsFromDB(capture.ExamDecisions):
         self.model = model
         self.detected_id = None
         self.id_scores = None
+        self.cell_margins = None
+        self.id_margins = None
         self.students_rank = students_rank
 
 
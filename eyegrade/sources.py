@@ -0,0 +1,198 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2019 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+"""Sources of frames for the exam detector: cameras, videos and images.
+
+Every source behaves like `cv2.VideoCapture`: `read()` returns a
+tuple (success, frame), and `release()` frees its resources. In
+addition, `timestamp` holds the time of the last frame read, in
+seconds. For live cameras it is the wall-clock time; for recorded
+sources it is the time since the start of the recording, so that a
+replay does not depend on how fast frames are processed.
+
+"""
+
+import abc
+import glob
+import os
+import time
+
+import cv2
+
+from . import images
+from . import utils
+
+VIDEO_EXTENSIONS = (".mp4", ".mkv", ".avi", ".mov", ".webm")
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp")
+
+utils.EyegradeException.register_error(
+    "open_video", short_message="The video file cannot be opened: {0}",
+)
+
+
+class FrameSource(abc.ABC):
+    """Base class of the frame sources.
+
+    Subclasses implement `_read(image)`, which returns the next frame
+    (optionally reusing the `image` buffer) and its timestamp, or
+    (None, None) at the end of the source. Files that cannot be read
+    are skipped, and their names are kept in `unreadable`.
+
+    """
+
+    def __init__(self):
+        self.timestamp = None
+        self.frames_read = 0
+        self.unreadable = []
+
+    def read(self, image=None):
+        frame, timestamp = self._read(image)
+        if frame is None:
+            return False, None
+        self.timestamp = timestamp
+        self.frames_read += 1
+        return True, frame
+
+    def release(self):
+        pass
+
+    @abc.abstractmethod
+    def _read(self, image):
+        pass
+
+
+class CameraSource(FrameSource):
+    """Frames from a live camera."""
+
+    def __init__(self, camera_id):
+        super().__init__()
+        self.camera_id = camera_id
+        self.camera = cv2.VideoCapture(camera_id)
+
+    def release(self):
+        self.camera.release()
+
+    def _read(self, image):
+        success, frame = self.camera.read(image)
+        if not success or frame is None:
+            return None, None
+        return frame, time.time()
+
+
+class VideoFileSource(FrameSource):
+    """Frames from a video file, timestamped with their position in it."""
+
+    def __init__(self, filename):
+        super().__init__()
+        self.filename = filename
+        self.video = cv2.VideoCapture(filename)
+        if not self.video.isOpened():
+            raise utils.EyegradeException(
+                "", key="open_video", format_params=(filename,)
+            )
+
+    def release(self):
+        self.video.release()
+
+    def _read(self, image):
+        success, frame = self.video.read(image)
+        if not success or frame is None:
+            return None, None
+        return frame, self.video.get(cv2.CAP_PROP_POS_MSEC) / 1000
+
+
+class ImageSequenceSource(FrameSource):
+    """Frames loaded from a sequence of image files.
+
+    Images are loaded when read. They are timestamped as if they had
+    been captured at `fps` frames per second.
+
+    """
+
+    def __init__(self, filenames, fps=25.0):
+        super().__init__()
+        self.filenames = list(filenames)
+        self.fps = fps
+        self.next_idx = 0
+
+    def _read(self, image):
+        while self.next_idx < len(self.filenames):
+            idx = self.next_idx
+            self.next_idx += 1
+            frame = images.load_image(self.filenames[idx])
+            if frame is not None:
+                return frame, idx / self.fps
+            self.unreadable.append(self.filenames[idx])
+        return None, None
+
+
+class MemorySource(FrameSource):
+    """Frames kept in memory, for replaying them without any I/O."""
+
+    def __init__(self, frames, timestamps=None, fps=25.0):
+        super().__init__()
+        self.frames = list(frames)
+        if timestamps is None:
+            timestamps = [i / fps for i in range(len(self.frames))]
+        self.timestamps = list(timestamps)
+        self.next_idx = 0
+
+    @classmethod
+    def preload(cls, source, max_frames=None):
+        """Reads the frames of another source into a new `MemorySource`."""
+        frames = []
+        timestamps = []
+        while max_frames is None or len(frames) < max_frames:
+            success, frame = source.read()
+            if not success:
+                break
+            frames.append(frame)
+            timestamps.append(source.timestamp)
+        source.release()
+        memory = cls(frames, timestamps=timestamps)
+        memory.unreadable = list(source.unreadable)
+        return memory
+
+    def rewind(self):
+        self.next_idx = 0
+
+    def _read(self, image):
+        if self.next_idx >= len(self.frames):
+            return None, None
+        idx = self.next_idx
+        self.next_idx += 1
+        # Copied because detection draws on the frames it receives
+        return self.frames[idx].copy(), self.timestamps[idx]
+
+
+def open_source(spec, fps=25.0):
+    """Returns the frame source described by `spec`.
+
+    `spec` can be a camera number, a video file, a directory of
+    images or a glob pattern of image files.
+
+    """
+    if isinstance(spec, int) or spec.isdigit():
+        return CameraSource(int(spec))
+    if os.path.isdir(spec):
+        candidates = [os.path.join(spec, name) for name in os.listdir(spec)]
+    elif spec.lower().endswith(VIDEO_EXTENSIONS):
+        return VideoFileSource(spec)
+    else:
+        candidates = glob.glob(spec)
+    filenames = sorted(c for c in candidates if c.lower().endswith(IMAGE_EXTENSIONS))
+    return ImageSequenceSource(filenames, fps=fps)
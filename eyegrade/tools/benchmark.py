@@ -0,0 +1,374 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2019 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+"""Latency and accuracy benchmark of exam detection.
+
+Detects synthetic sheets of several scenarios (clean, rotated,
+blurred, etc.) and reports latency percentiles and accuracy for each
+of them. Results can be saved and compared with a previous run in
+order to catch performance regressions.
+
+"""
+
+import argparse
+import collections
+import json
+import sys
+import time
+
+import numpy as np
+
+from .. import batch
+from .. import detection
+from .. import utils
+from ..ocr import classifiers
+from . import synthetic
+
+SCENARIOS = collections.OrderedDict(
+    [
+        ("clean", synthetic.SheetDistortion()),
+        ("rotated", synthetic.SheetDistortion(rotation=6.0)),
+        ("perspective", synthetic.SheetDistortion(perspective=0.03)),
+        ("blurred", synthetic.SheetDistortion(blur=0.9)),
+        ("noisy", synthetic.SheetDistortion(noise=8.0)),
+        ("lighting", synthetic.SheetDistortion(lighting=0.5)),
+        (
+            "combined",
+            synthetic.SheetDistortion(
+                rotation=4.0, perspective=0.02, blur=0.8, noise=4.0, lighting=0.3
+            ),
+        ),
+    ]
+)
+
+PERCENTILES = (50, 90, 99)
+
+
+class _SampleProfiler(detection.DetectionProfiler):
+    """Profiler that also keeps every sample, for computing percentiles."""
+
+    def __init__(self):
+        super().__init__()
+        self.samples = collections.defaultdict(list)
+
+    def record(self, name, elapsed):
+        super().record(name, elapsed)
+        self.samples[name].append(elapsed)
+
+
+class ScenarioResult:
+    """Latencies and accuracy measured for a scenario."""
+
+    def __init__(self, name):
+        self.name = name
+        self.num_sheets = 0
+        self.detected = 0
+        self.answers_total = 0
+        self.answers_correct = 0
+        self.models_correct = 0
+        self.ids_total = 0
+        self.ids_correct = 0
+        self.sheet_latencies = []
+        self.stage_latencies = {}
+
+    def add(self, sheet, detector, elapsed):
+        self.num_sheets += 1
+        self.sheet_latencies.append(elapsed)
+        if not detector.success:
+            return
+        decisions = detector.decisions
+        self.detected += 1
+        self.answers_total += len(sheet.answers)
+        self.answers_correct += sum(
+            1 for a, b in zip(sheet.answers, decisions.answers) if a == b
+        )
+        if decisions.model == sheet.model:
+            self.models_correct += 1
+        if sheet.student_id is not None:
+            self.ids_total += 1
+            if decisions.detected_id == sheet.student_id:
+                self.ids_correct += 1
+
+    def summary(self):
+        """Returns a dictionary with the results. Latencies are in ms."""
+        data = collections.OrderedDict()
+        data["sheets"] = self.num_sheets
+        data["detection_rate"] = _ratio(self.detected, self.num_sheets)
+        data["answer_accuracy"] = _ratio(self.answers_correct, self.answers_total)
+        data["model_accuracy"] = _ratio(self.models_correct, self.detected)
+        data["id_accuracy"] = _ratio(self.ids_correct, self.ids_total)
+        data["sheet_ms"] = _percentiles(self.sheet_latencies)
+        data["stages_ms"] = collections.OrderedDict(
+            (name, _percentiles(samples))
+            for name, samples in self.stage_latencies.items()
+        )
+        return data
+
+
+def run_scenario(
+    name,
+    distortion,
+    dimensions,
+    num_sheets,
+    id_num_digits=0,
+    hough_threshold=None,
+    seed=0,
+    rectify_tables=False,
+    frame_size=(640, 480),
+    detection_width=None,
+    crosses_backend="svm",
+):
+    """Detects `num_sheets` synthetic sheets and returns a `ScenarioResult`.
+
+    Sheets are rendered before timing starts. Each sheet is detected
+    the way `eyegrade-batch` does, i.e. sweeping Hough thresholds when
+    needed, and its latency includes all the attempts. Sheets are
+    rendered with `frame_size` (width, height) pixels, and their cells
+    are classified with the classifier of crosses of `crosses_backend`.
+
+    """
+    generator = synthetic.SheetGenerator(
+        dimensions,
+        id_num_digits=id_num_digits,
+        width=frame_size[0],
+        height=frame_size[1],
+        seed=seed,
+    )
+    sheets = [generator.random_sheet(distortion=distortion) for _ in range(num_sheets)]
+    options = detection.ExamDetector.get_default_options()
+    options["rectify-tables"] = rectify_tables
+    options["detection-width"] = detection_width
+    if id_num_digits:
+        options["read-id"] = True
+        options["id-num-digits"] = id_num_digits
+    context = detection.ExamDetectorContext(
+        fixed_hough_threshold=hough_threshold,
+        crosses_backend=crosses_backend,
+        pre_process_cache=True,
+    )
+    context.profiler = _SampleProfiler()
+    result = ScenarioResult(name)
+    for sheet in sheets:
+        start = time.perf_counter()
+        detector = batch.detect_image(context, dimensions, options, sheet.image)
+        result.add(sheet, detector, time.perf_counter() - start)
+    result.stage_latencies = context.profiler.samples
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Returns the list of regressions with respect to a baseline.
+
+    `results` and `baseline` are dictionaries as saved by this tool.
+    Latency regressions are reported when a percentile grows more than
+    `tolerance` (a fraction), and accuracy ones when a rate drops.
+
+    """
+    regressions = []
+    for name, data in results["scenarios"].items():
+        old = baseline["scenarios"].get(name)
+        if old is None:
+            continue
+        for key, value in data["sheet_ms"].items():
+            old_value = old["sheet_ms"].get(key)
+            if old_value and value > old_value * (1 + tolerance):
+                regressions.append(
+                    "{}: latency {} {:.2f} ms -> {:.2f} ms".format(
+                        name, key, old_value, value
+                    )
+                )
+        for key in ("detection_rate", "answer_accuracy", "model_accuracy"):
+            if data[key] < old[key] - 0.01:
+                regressions.append(
+                    "{}: {} {:.3f} -> {:.3f}".format(name, key, old[key], data[key])
+                )
+    return regressions
+
+
+def _ratio(part, total):
+    return part / total if total else 0.0
+
+
+def _percentiles(samples):
+    data = collections.OrderedDict()
+    if samples:
+        values = np.percentile(1000 * np.array(samples), PERCENTILES)
+        for percentile, value in zip(PERCENTILES, values):
+            data["p{}".format(percentile)] = float(value)
+        data["mean"] = float(1000 * np.mean(samples))
+    return data
+
+
+def _print_results(results):
+    print(
+        "{:12} {:>6} {:>9} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+            "scenario",
+            "sheets",
+            "detected",
+            "answers",
+            "model",
+            "id",
+            "p50 ms",
+            "p90 ms",
+            "p99 ms",
+        )
+    )
+    for name, data in results["scenarios"].items():
+        latencies = data["sheet_ms"]
+        print(
+            "{:12} {:>6} {:>9.1%} {:>8.1%} {:>8.1%} {:>8.1%} {:>8.2f} {:>8.2f} "
+            "{:>8.2f}".format(
+                name,
+                data["sheets"],
+                data["detection_rate"],
+                data["answer_accuracy"],
+                data["model_accuracy"],
+                data["id_accuracy"],
+                latencies.get("p50", 0.0),
+                latencies.get("p90", 0.0),
+                latencies.get("p99", 0.0),
+            )
+        )
+
+
+def _cmd_options():
+    parser = argparse.ArgumentParser(
+        description="Benchmark exam detection with synthetic sheets."
+    )
+    parser.add_argument(
+        "dimensions",
+        nargs="?",
+        default="4,10;4,10",
+        help='Answer box dimensions spec. (default "4,10;4,10")',
+    )
+    parser.add_argument(
+        "-n",
+        "--num-sheets",
+        type=int,
+        default=20,
+        help="number of sheets per scenario (default 20)",
+    )
+    parser.add_argument(
+        "-i",
+        "--id-num-digits",
+        type=int,
+        default=0,
+        help="number of digits of the student id (default none)",
+    )
+    parser.add_argument(
+        "-s",
+        "--scenario",
+        dest="scenarios",
+        action="append",
+        choices=list(SCENARIOS.keys()),
+        help="run only this scenario (can be repeated)",
+    )
+    parser.add_argument(
+        "-t",
+        "--hough-threshold",
+        type=int,
+        default=None,
+        help="use a fixed Hough threshold instead of trying several",
+    )
+    parser.add_argument(
+        "--rectify-tables",
+        action="store_true",
+        help="classify cells by rectifying each table at once",
+    )
+    parser.add_argument(
+        "--frame-size",
+        default="640x480",
+        help="size of the synthetic frames (default 640x480)",
+    )
+    parser.add_argument(
+        "-w",
+        "--detection-width",
+        type=int,
+        default=None,
+        help="locate the tables in frames downscaled to this width",
+    )
+    parser.add_argument(
+        "--crosses-backend",
+        choices=classifiers.CROSSES_BACKENDS,
+        default="svm",
+        help="backend of the classifier of crosses (default svm)",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "-o", "--output", default=None, help="save the results to this JSON file"
+    )
+    parser.add_argument(
+        "-b",
+        "--baseline",
+        default=None,
+        help="compare with the results of a previous run (JSON file)",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed latency increase over the baseline (default 0.2)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = _cmd_options()
+    dimensions, _ = utils.parse_dimensions(args.dimensions)
+    frame_size = tuple(int(value) for value in args.frame_size.split("x"))
+    results = collections.OrderedDict()
+    results["dimensions"] = args.dimensions
+    results["id_num_digits"] = args.id_num_digits
+    results["frame_size"] = args.frame_size
+    results["crosses_backend"] = args.crosses_backend
+    results["scenarios"] = collections.OrderedDict()
+    for name in args.scenarios or SCENARIOS.keys():
+        try:
+            result = run_scenario(
+                name,
+                SCENARIOS[name],
+                dimensions,
+                args.num_sheets,
+                id_num_digits=args.id_num_digits,
+                hough_threshold=args.hough_threshold,
+                seed=args.seed,
+                rectify_tables=args.rectify_tables,
+                frame_size=frame_size,
+                detection_width=args.detection_width,
+                crosses_backend=args.crosses_backend,
+            )
+        except utils.EyegradeException as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        results["scenarios"][name] = result.summary()
+    _print_results(results)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions with respect to the baseline:")
+            for regression in regressions:
+                print("    " + regression)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
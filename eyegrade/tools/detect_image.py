@@ -53,6 +53,19 @@ def _cmd_options():
         default=None,
         help="Write the processed image to the given file",
     )
+    parser.add_argument(
+        "-P",
+        "--profile",
+        action="store_true",
+        help="Print the time spent in each detection stage",
+    )
+    parser.add_argument(
+        "-w",
+        "--detection-width",
+        type=int,
+        default=None,
+        help="Locate the tables in the image downscaled to this width",
+    )
     parser.add_argument(
         "-i",
         "--id-num-digits",
@@ -67,9 +80,12 @@ def _cmd_options():
 def main():
     args = _cmd_options()
     context = detection.ExamDetectorContext(fixed_hough_threshold=args.hough_threshold)
+    if args.profile:
+        context.enable_profiling()
     options = detection.ExamDetector.get_default_options()
     options["capture-from-file"] = True
     options["capture-raw-file"] = args.image
+    options["detection-width"] = args.detection_width
     if args.draw_lines_to is not None:
         options["show-lines"] = True
     if args.id_num_digits:
@@ -83,6 +99,9 @@ def main():
     else:
         print("Detection failed :(")
         print(detector.status)
+    if args.profile:
+        for stage, elapsed in detector.timings.items():
+            print("{}: {:.2f} ms".format(stage, 1000 * elapsed))
     if args.draw_lines_to is not None:
         detector.capture.save_image_drawn(args.draw_lines_to)
     if args.image_proc_to:
@@ -0,0 +1,382 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2019 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+"""Micro-benchmarks of individual detection functions.
+
+Each benchmark times the current implementation of a function against
+a straightforward scalar reference, on synthetic input, and checks
+that both return the same results.
+
+"""
+
+import argparse
+import collections
+import math
+import sys
+import timeit
+
+import cv2
+import numpy as np
+
+from .. import detection
+from .. import geometry as g
+from ..ocr import preprocessing
+
+
+def _corner_lines(dimensions, angle=0.02):
+    """Lines of an ideal, slightly rotated, set of answer tables."""
+    num_rows = 1 + max(questions for _, questions in dimensions)
+    num_columns = len(dimensions) + sum(choices for choices, _ in dimensions)
+    hlines = [(40.0 + 6.5 * i, math.pi / 2 + angle) for i in range(num_rows)]
+    vlines = [(30.0 + 21.3 * j, angle) for j in range(num_columns)]
+    return hlines, vlines
+
+
+def _reference_cell_corners(hlines, vlines, iwidth, iheight, dimensions):
+    """Point by point computation and check of the corner matrixes."""
+    corner_matrixes = []
+    vini = 0
+    for width, height in dimensions:
+        corners = [
+            [
+                g.intersection(hlines[i], vlines[j])
+                for j in range(vini, vini + width + 1)
+            ]
+            for i in range(height + 1)
+        ]
+        corner_matrixes.append(corners)
+        vini += 1 + width
+    corners = corner_matrixes[(len(corner_matrixes) - 1) // 2]
+    ypoints = [row[-1][1] for row in corners]
+    difs = [b - a for a, b in zip(ypoints[:-1], ypoints[1:])]
+    difs2 = [b - a for a, b in zip(difs[:-1], difs[1:])]
+    max_difs2 = (
+        1
+        + float(max(difs) - min(difs))
+        / len(difs)
+        * detection.param_check_corners_tolerance_mul
+    )
+    if max(difs2) > max_difs2 or 0.5 * max(difs) > min(difs):
+        return []
+    for corners in corner_matrixes:
+        for row in corners:
+            for x, y in row:
+                if x < 0 or x >= iwidth or y < 0 or y >= iheight:
+                    return []
+    for corners in corner_matrixes:
+        for i in range(len(corners) - 1):
+            for j in range(len(corners[0]) - 1):
+                if (
+                    corners[i][j][1] >= corners[i + 1][j][1]
+                    or corners[i][j + 1][1] >= corners[i + 1][j + 1][1]
+                    or corners[i][j][0] >= corners[i][j + 1][0]
+                    or corners[i + 1][j][0] >= corners[i + 1][j + 1][0]
+                ):
+                    return []
+    return corner_matrixes
+
+
+def bench_corners():
+    """Corner grid of four tables of 55 questions with 5 choices."""
+    dimensions = [(5, 55)] * 4
+    hlines, vlines = _corner_lines(dimensions)
+    args = (hlines, vlines, 640, 480, dimensions)
+    return (
+        lambda: detection.cell_corners(*args),
+        lambda: _reference_cell_corners(*args),
+    )
+
+
+def _id_box_image(num_digits, width=640, height=480, angle=0.01):
+    """Pre-processed image of a slightly rotated id box, and its lines."""
+    image = np.zeros((height, width), dtype=np.uint8)
+    hlines = [(100.0, math.pi / 2 + angle), (130.0, math.pi / 2 + angle)]
+    left, right = 120, 120 + 36 * num_digits
+    for line in hlines:
+        cv2.line(image, g.line_point(line, x=left), g.line_point(line, x=right), 255, 2)
+    for x in range(left, right + 1, 36):
+        cv2.line(
+            image, g.line_point(hlines[0], x=x), g.line_point(hlines[1], x=x), 255, 2
+        )
+    corners_up = [g.line_point(hlines[0], x=x + 3) for x in range(left, right + 1, 36)]
+    corners_down = [
+        g.line_point(hlines[1], x=x - 3) for x in range(left, right + 1, 36)
+    ]
+    return image, hlines, corners_up, corners_down
+
+
+def _reference_id_boxes_adjust_points(
+    image, p_up, p_down, line_up, line_down, x_var, iwidth
+):
+    """Point by point search of the best pair of id box corners."""
+    points_up = []
+    points_down = []
+    for x in range(p_up[0] - x_var, p_up[0] + x_var + 1):
+        p = g.line_point(line_up, x=x)
+        if p[0] >= 0 and p[0] < iwidth and p[1] >= 0:
+            points_up.append(p)
+    for x in range(p_down[0] - x_var, p_down[0] + x_var + 1):
+        p = g.line_point(line_down, x=x)
+        if p[0] >= 0 and p[0] < iwidth and p[1] >= 0:
+            points_down.append(p)
+    energies = []
+    for u in points_up:
+        for v in points_down:
+            points = list(g.walk_line(u, v))
+            active = len([(x, y) for (x, y) in points if image[y, x] > 0])
+            energy = float(active) / len(points)
+            if energy > detection.param_id_boxes_energy_break:
+                return (u, v), energy
+            energies.append((energy, u, v))
+    if not energies:
+        return None, 0.0
+    energies.sort(reverse=True)
+    best = [(e, u, v) for (e, u, v) in energies if e == energies[0][0]]
+    avgx_up = float(sum([u[0] for (e, u, v) in best])) / len(best)
+    avgx_down = float(sum([v[0] for (e, u, v) in best])) / len(best)
+    best = [(abs(avgx_up - u[0]) + abs(avgx_down - v[0]), u, v) for (e, u, v) in best]
+    best.sort()
+    return best[0][1:], energies[0][0]
+
+
+def _reference_id_boxes_adjust_point_vertically(image, point, line, interval, iwidth):
+    """Point by point vertical adjustment of an id box corner."""
+    rho, theta = line
+    lines = [line]
+    for i in range(interval[0], interval[1] + 1):
+        lines.append((rho + i, theta))
+        lines.append((rho - i, theta))
+    values = []
+    for line in lines:
+        match = 0
+        for xx in range(point[0] - 2, point[0] + 3):
+            x, y = g.line_point(line, x=xx)
+            if y >= 0 and x >= 0 and x < iwidth and image[y, x] > 0:
+                match += 1
+        p = g.line_point(line, x=point[0])
+        values.append((match, p[1], p))
+    values.sort(reverse=True)
+    best = [(m, ppp) for (m, yyy, ppp) in values if m == values[0][0]]
+    return best[len(best) // 2][1]
+
+
+def _adjust_id_box(image, hlines, corners_up, corners_down, adjust_points, vertically):
+    results = []
+    width = image.shape[1]
+    for up, down in zip(corners_up, corners_down):
+        selected, energy = adjust_points(
+            image, up, down, hlines[0], hlines[1], 10, width
+        )
+        results.append((selected, energy))
+        if selected is not None:
+            results.append(vertically(image, selected[0], hlines[0], (-5, 5), width))
+            results.append(vertically(image, selected[1], hlines[1], (-5, 5), width))
+    return results
+
+
+def bench_id_box():
+    """Adjustment of the corners of a 9-digit id box."""
+    args = _id_box_image(9)
+    return (
+        lambda: _adjust_id_box(
+            *args,
+            detection.id_boxes_adjust_points,
+            detection.id_boxes_adjust_point_vertically
+        ),
+        lambda: _adjust_id_box(
+            *args,
+            _reference_id_boxes_adjust_points,
+            _reference_id_boxes_adjust_point_vertically
+        ),
+    )
+
+
+def _reference_line_bounds(image, line, iwidth):
+    """Pixel by pixel scan of the bounds of a line."""
+    p0 = g.line_point(line, x=0)
+    if p0[1] < 0:
+        p0 = g.line_point(line, y=0)
+    p1 = g.line_point(line, x=iwidth - 1)
+    if p1[1] < 0:
+        p1 = g.line_point(line, y=0)
+    image_dimensions = (image.shape[1], image.shape[0])
+    if not g.point_is_valid(p0, image_dimensions) or not g.point_is_valid(
+        p1, image_dimensions
+    ):
+        return None, None
+    ini_found = False
+    ini = None
+    end = None
+    last = 0
+    count = 0
+    for x, y in g.walk_line(p0, p1):
+        value = 1 if image[y, x] > 0 else 0
+        if value == last:
+            count += 1
+        else:
+            last = value
+            count = 1
+        if not ini_found:
+            if last == 1:
+                if count == 1:
+                    ini = (x, y)
+                elif count == 3:
+                    ini_found = True
+        else:
+            if last == 1 and count > 2:
+                end = (x, y)
+    if ini is None or end is None:
+        return None, None
+    return ini, end
+
+
+def _reference_line_bounds_one_line(image, line, iwidth, rho_var):
+    rho, theta = line
+    lines = [line]
+    for i in range(1, rho_var + 1):
+        lines.append((rho + i, theta))
+        lines.append((rho - i, theta))
+    points_left = []
+    points_right = []
+    for line in lines:
+        pl, pr = _reference_line_bounds(image, line, iwidth)
+        if pl is not None:
+            points_left.append(pl)
+            points_right.append(pr)
+    return points_left, points_right
+
+
+def bench_line_bounds():
+    """Bounds of the lines of a 9-digit id box, 5 pixels up and down."""
+    image, hlines, _, _ = _id_box_image(9)
+    width = image.shape[1]
+    return (
+        lambda: [
+            detection.line_bounds_one_line(image, line, width, 5) for line in hlines
+        ],
+        lambda: [
+            _reference_line_bounds_one_line(image, line, width, 5) for line in hlines
+        ],
+    )
+
+
+def _reference_clear_boundbox(image):
+    """Row by row and column by column search of the bounding box."""
+    top = 0
+    bot = image.shape[0]
+    right = image.shape[1]
+    left = 0
+    it = 0
+    for index, row in enumerate(image):
+        if not np.all(row == 0) and it == 0:
+            if index == image.shape[0] or not np.all(image[index + 1] == 0):
+                top = index
+                it = 1
+        elif np.all(row == 0) and it == 1:
+            bot = index
+            break
+    it = 0
+    for index, col in enumerate(image.T):
+        if (not np.all(col == 0)) and it == 0:
+            if index + 2 >= image.shape[1] or not np.all(image.T[index + 2] == 0):
+                left = index
+                it = 1
+        elif np.all(col == 0) and it == 1:
+            right = index
+            break
+    return image[top:bot, left:right]
+
+
+def _digit_images(num_digits, dim=28):
+    """Deskewed images of slanted strokes, as the digits of an id."""
+    digit_images = []
+    for i in range(num_digits):
+        image = np.zeros((dim, dim), dtype=np.uint8)
+        cv2.line(image, (8 + i % 5, 4), (16 - i % 3, 23), 255, 3)
+        image[1, 2] = 255
+        digit_images.append(preprocessing.deskew(image, dim))
+    return digit_images
+
+
+def bench_clear_boundbox():
+    """Bounding boxes of the 9 digits of an id."""
+    digit_images = _digit_images(9)
+    return (
+        lambda: [
+            preprocessing.clear_boundbox(image).tolist() for image in digit_images
+        ],
+        lambda: [_reference_clear_boundbox(image).tolist() for image in digit_images],
+    )
+
+
+BENCHMARKS = collections.OrderedDict(
+    [
+        ("corners", bench_corners),
+        ("id_box", bench_id_box),
+        ("line_bounds", bench_line_bounds),
+        ("clear_boundbox", bench_clear_boundbox),
+    ]
+)
+
+
+def run(name, number=200):
+    """Returns the time per call, in ms, of the current and reference code."""
+    current, reference = BENCHMARKS[name]()
+    if current() != reference():
+        raise ValueError("Results of {} differ from the reference".format(name))
+    current_time = min(timeit.repeat(current, number=number, repeat=3)) / number
+    reference_time = min(timeit.repeat(reference, number=number, repeat=3)) / number
+    return 1000 * current_time, 1000 * reference_time
+
+
+def _cmd_options():
+    parser = argparse.ArgumentParser(
+        description="Run micro-benchmarks of detection functions."
+    )
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        help="benchmarks to run, from {} (default all)".format(
+            ", ".join(BENCHMARKS.keys())
+        ),
+    )
+    parser.add_argument(
+        "-n",
+        "--number",
+        type=int,
+        default=200,
+        help="number of calls per measurement (default 200)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = _cmd_options()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            sys.exit("Unknown benchmark: {}".format(name))
+    for name in args.benchmarks or BENCHMARKS.keys():
+        current, reference = run(name, number=args.number)
+        print(
+            "{}: {:.3f} ms (reference {:.3f} ms, {:.1f}x)".format(
+                name, current, reference, reference / current
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
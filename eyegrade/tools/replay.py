@@ -0,0 +1,253 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2019 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+"""Replays a recorded grading session into a session directory.
+
+Frames come from a video file or a sequence of images, and go
+through the same loop as the interactive grading: exams are searched
+in the frames, stored in the session when detected, and the next one
+is searched after the exam is removed. The loop is scheduled with the
+timestamps of the frames instead of the clock, so that a replay gives
+always the same results and runs as fast as detection and storage
+allow.
+
+"""
+
+import argparse
+import sys
+import time
+
+from .. import batch
+from .. import detection
+from .. import sessiondb
+from .. import sources
+from .. import utils
+
+# Same schedule as the interactive grading loop
+SEARCH_PERIOD = 1.0 / 8
+CHANGE_PERIOD = 1.0
+CHANGE_PERIOD_FAILURE = 0.3
+REMOVAL_FAILURES = 4
+
+
+class ReplayStats:
+    def __init__(self):
+        self.frames = 0
+        self.detections = 0
+        self.unchanged = 0
+        self.removal_checks = 0
+        self.exams = 0
+        self.elapsed = 0.0
+
+    def frames_per_second(self):
+        return self.frames / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class SessionReplay:
+    """Grades the exams that appear in a frame source into a session."""
+
+    def __init__(
+        self, session, source, store_captures=True, profile=False, hough_threshold=None
+    ):
+        self.grader = batch.BatchGrader(
+            session, store_captures=store_captures, profile=profile
+        )
+        self.dimensions = self.grader.exam_config.dimensions
+        self.options = self.grader.options
+        self.context = detection.ExamDetectorContext(
+            source=source,
+            fixed_hough_threshold=hough_threshold,
+            tracking=True,
+            threshold_sweep=True,
+        )
+        self.context.profiler = self.grader.profiler
+        self.search_changes = detection.FrameChangeDetector()
+        self.removal_changes = detection.FrameChangeDetector()
+        self.stats = ReplayStats()
+
+    def replay(self):
+        """Returns an iterator of `batch.BatchResult`, one per stored exam.
+
+        The `image_file` of each result names the frame and its
+        timestamp.
+
+        """
+        start = time.time()
+        self.context.open_camera()
+        reviewing = False
+        change_failures = 0
+        next_time = None
+        try:
+            while True:
+                image = self.context.capture_image()
+                if image is None:
+                    break
+                self.stats.frames += 1
+                timestamp = self.context.frame_timestamp
+                if next_time is not None and timestamp < next_time:
+                    continue
+                if reviewing:
+                    if self._exam_still_there(image):
+                        change_failures = 0
+                        next_time = timestamp + CHANGE_PERIOD
+                    else:
+                        change_failures += 1
+                        next_time = timestamp + CHANGE_PERIOD_FAILURE
+                        if change_failures >= REMOVAL_FAILURES:
+                            reviewing = False
+                            self.search_changes.reset()
+                    continue
+                next_time = timestamp + SEARCH_PERIOD
+                result = self._search(image, timestamp)
+                if result is not None:
+                    self.stats.exams += 1
+                    reviewing = True
+                    change_failures = 0
+                    self.removal_changes.set_reference(image)
+                    next_time = timestamp + CHANGE_PERIOD
+                    yield result
+        finally:
+            self.stats.elapsed = time.time() - start
+            self.context.close_camera()
+
+    def _search(self, image, timestamp):
+        if (
+            not self.search_changes.changed(image)
+            and not self.context.notify_unchanged_frame()
+        ):
+            self.stats.unchanged += 1
+            return None
+        self.stats.detections += 1
+        start = time.time()
+        detector = detection.ExamDetector(
+            self.dimensions, self.context, self.options, image_raw=image
+        )
+        detector.detect_safe()
+        if detector.success:
+            detected = batch.DetectedImage(
+                "frame {} ({:.3f}s)".format(self.stats.frames, timestamp),
+                detector=detector,
+                elapsed=time.time() - start,
+            )
+            result = self.grader.store(detected)
+            if result.success:
+                return result
+        elif detector.worth_retrying():
+            self.search_changes.reset()
+            return None
+        # Only frames known to fail are references for skipping others
+        self.search_changes.set_reference(image)
+        return None
+
+    def _exam_still_there(self, image):
+        if not self.removal_changes.changed(image):
+            return True
+        self.stats.removal_checks += 1
+        detector = detection.ExamDetector(
+            self.dimensions, self.context, self.options, image_raw=image
+        )
+        detector.try_to_detect()
+        return detector.exam_detected
+
+
+def _cmd_options():
+    parser = argparse.ArgumentParser(
+        description="Replay recorded frames of a grading station into a session."
+    )
+    parser.add_argument("session", help="session directory")
+    parser.add_argument(
+        "source", help="video file, directory of images or glob pattern of images"
+    )
+    parser.add_argument(
+        "--fps",
+        type=float,
+        default=25.0,
+        help="frame rate of image sequences (default 25)",
+    )
+    parser.add_argument(
+        "-t",
+        "--hough-threshold",
+        type=int,
+        default=None,
+        help="use a fixed Hough threshold instead of trying several",
+    )
+    parser.add_argument(
+        "--preload",
+        action="store_true",
+        help="load every frame into memory before replaying them",
+    )
+    parser.add_argument(
+        "--no-captures",
+        dest="store_captures",
+        action="store_false",
+        help="do not store the raw and annotated images in the session",
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profile_file",
+        default=None,
+        help="save detection stage timings to this file (.json or .csv)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = _cmd_options()
+    try:
+        source = sources.open_source(args.source, fps=args.fps)
+        session = sessiondb.SessionDB(args.session)
+    except utils.EyegradeException as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    if args.preload:
+        source = sources.MemorySource.preload(source)
+    replay = SessionReplay(
+        session,
+        source,
+        store_captures=args.store_captures,
+        profile=args.profile_file is not None,
+        hough_threshold=args.hough_threshold,
+    )
+    try:
+        for result in replay.replay():
+            print("{}: exam {}".format(result.image_file, result.exam_id))
+    finally:
+        session.save_legacy_answers()
+        session.close()
+    stats = replay.stats
+    print(
+        "{} frames in {:.2f}s ({:.1f} frames/s): {} detections, "
+        "{} unchanged frames, {} removal checks, {} exams".format(
+            stats.frames,
+            stats.elapsed,
+            stats.frames_per_second(),
+            stats.detections,
+            stats.unchanged,
+            stats.removal_checks,
+            stats.exams,
+        )
+    )
+    if source.unreadable:
+        print("Unreadable images, skipped:", file=sys.stderr)
+        for filename in source.unreadable:
+            print("    " + filename, file=sys.stderr)
+    if args.profile_file is not None:
+        replay.grader.profiler.save(args.profile_file)
+
+
+if __name__ == "__main__":
+    main()
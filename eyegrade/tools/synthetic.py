@@ -0,0 +1,408 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2019 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+"""Synthetic answer sheets with known ground truth.
+
+Sheets are drawn with the same layout as the LaTeX answer tables:
+the ID box above the tables, the tables side by side and the two
+rows of infobits below them. The rendered paper is then projected
+into a camera-like frame, optionally with some distortions.
+
+"""
+
+import argparse
+import csv
+import math
+import os
+
+import cv2
+import numpy as np
+
+from .. import utils
+
+# Colors (BGR) of the rendered elements
+_PAPER_COLOR = (236, 240, 240)
+_LINE_COLOR = (70, 60, 60)
+_TEXT_COLOR = (40, 40, 40)
+_INK_COLOR = (150, 60, 40)
+
+# Rendering is done at this factor of the final resolution
+_OVERSAMPLING = 2
+
+
+class SheetDistortion:
+    """Distortions applied to a rendered sheet.
+
+    - rotation: maximum rotation, in degrees.
+    - perspective: maximum displacement of each corner of the frame,
+      as a fraction of the image size.
+    - blur: standard deviation of the Gaussian blur, in pixels.
+    - noise: standard deviation of the Gaussian noise, in gray levels.
+    - lighting: maximum darkening of the lighting gradient, from 0
+      to 1.
+
+    Rotation and perspective are maximum values: each sheet draws
+    its own values at random up to them.
+
+    """
+
+    def __init__(
+        self, rotation=0.0, perspective=0.0, blur=0.0, noise=0.0, lighting=0.0
+    ):
+        self.rotation = rotation
+        self.perspective = perspective
+        self.blur = blur
+        self.noise = noise
+        self.lighting = lighting
+
+
+class SyntheticSheet:
+    """A rendered sheet and the data it was rendered from."""
+
+    def __init__(self, image, dimensions, answers, model, infobits, student_id):
+        self.image = image
+        self.dimensions = dimensions
+        self.answers = answers
+        self.model = model
+        self.infobits = infobits
+        self.student_id = student_id
+
+
+class SheetGenerator:
+    """Renders synthetic answer sheets for the given dimensions.
+
+    `dimensions` is a list of (num_choices, num_questions) tuples, as
+    in the exam configuration. If `id_num_digits` is not zero, sheets
+    have an ID box with that number of digits.
+
+    """
+
+    def __init__(self, dimensions, id_num_digits=0, width=640, height=480, seed=None):
+        self.dimensions = dimensions
+        self.id_num_digits = id_num_digits
+        self.width = width
+        self.height = height
+        self.random = np.random.RandomState(seed)
+        self.num_choices = dimensions[0][0]
+        self.num_questions = sum(questions for _, questions in dimensions)
+        self._layout()
+
+    def random_sheet(self, distortion=None, blank_ratio=0.1):
+        """Renders a sheet with random answers, model and student id."""
+        answers = [
+            0
+            if self.random.random_sample() < blank_ratio
+            else int(self.random.randint(1, choices + 1))
+            for choices, questions in self.dimensions
+            for _ in range(questions)
+        ]
+        model = chr(65 + self.random.randint(0, self._num_models()))
+        if self.id_num_digits:
+            student_id = "".join(
+                str(d) for d in self.random.randint(0, 10, self.id_num_digits)
+            )
+        else:
+            student_id = None
+        return self.render(answers, model, student_id, distortion=distortion)
+
+    def render(self, answers, model="A", student_id=None, distortion=None):
+        """Renders a sheet and returns it as a `SyntheticSheet` object.
+
+        `answers` contains, for every question, the marked choice
+        (starting at 1), or 0 for a blank question.
+
+        """
+        if len(answers) != self.num_questions:
+            raise ValueError("Expected {} answers".format(self.num_questions))
+        if student_id is not None and len(student_id) != self.id_num_digits:
+            raise ValueError("Expected {} ID digits".format(self.id_num_digits))
+        infobits = utils.encode_model(model, len(self.dimensions), self.num_choices)
+        paper = np.empty(
+            (_OVERSAMPLING * self.height, _OVERSAMPLING * self.width, 3),
+            dtype=np.uint8,
+        )
+        paper[:] = _PAPER_COLOR
+        self._draw_tables(paper)
+        self._draw_infobits(paper, infobits)
+        self._draw_answers(paper, answers)
+        if self.id_num_digits:
+            self._draw_id_box(paper, student_id)
+        image = self._project(paper, distortion or SheetDistortion())
+        return SyntheticSheet(
+            image, self.dimensions, answers, model, infobits, student_id
+        )
+
+    def _num_models(self):
+        # Models are limited to A-H and by the number of infobits
+        return min(8, 2 ** (len(self.dimensions) * self.num_choices))
+
+    def _layout(self):
+        """Computes the size and position of the tables on the paper."""
+        num_tables = len(self.dimensions)
+        max_questions = max(questions for _, questions in self.dimensions)
+        # Units of the layout, in cell sizes:
+        width_units = num_tables * (self.num_choices + 1)
+        height_units = max_questions + 2
+        if self.id_num_digits:
+            width_units = max(width_units, 0.5 * self.id_num_digits + 1)
+            height_units += 3
+        paper_width = _OVERSAMPLING * self.width
+        paper_height = _OVERSAMPLING * self.height
+        # Cells are wider than tall, as in the LaTeX tables
+        self.cell_width = min(
+            0.8 * paper_width / width_units, 1.6 * paper_height / height_units
+        )
+        self.cell_height = 0.5 * self.cell_width
+        self.left = (
+            paper_width - num_tables * (self.num_choices + 1) * self.cell_width
+        ) / 2
+        self.top = (paper_height - height_units * self.cell_height) / 2
+        if self.id_num_digits:
+            self.id_top = self.top
+            self.id_left = (
+                paper_width - 0.5 * self.id_num_digits * self.cell_width
+            ) / 2
+            # The detector looks for the ID box close above the tables
+            self.top += 3 * self.cell_height
+
+    def _table_left(self, table):
+        return self.left + (table * (self.num_choices + 1) + 1) * self.cell_width
+
+    def _cell_point(self, table, column, row):
+        return (
+            self._table_left(table) + column * self.cell_width,
+            self.top + row * self.cell_height,
+        )
+
+    def _draw_tables(self, paper):
+        thickness = _scaled(2)
+        for table, (choices, questions) in enumerate(self.dimensions):
+            x0, y0 = self._cell_point(table, 0, 0)
+            x1, y1 = self._cell_point(table, choices, questions)
+            for row in range(questions + 1):
+                y = self.top + row * self.cell_height
+                _line(paper, (x0, y), (x1, y), _LINE_COLOR, thickness)
+            for column in range(choices + 1):
+                x = x0 + column * self.cell_width
+                _line(paper, (x, y0), (x, y1), _LINE_COLOR, thickness)
+            for column in range(choices):
+                x, y = self._cell_point(table, column + 0.5, -0.6)
+                _text(paper, chr(65 + column), (x, y), 0.6 * self.cell_height)
+            first = 1 + sum(q for _, q in self.dimensions[:table])
+            for row in range(questions):
+                x, y = self._cell_point(table, -0.4, row + 0.5)
+                _text(paper, str(first + row), (x, y), 0.7 * self.cell_height)
+
+    def _draw_infobits(self, paper, infobits):
+        side = 0.55 * self.cell_height
+        for i, bit in enumerate(infobits):
+            table, column = divmod(i, self.num_choices)
+            questions = self.dimensions[table][1]
+            row = questions + (0.45 if bit else 1.45)
+            x, y = self._cell_point(table, column + 0.5, row)
+            _square(paper, (x, y), side, _TEXT_COLOR)
+
+    def _draw_answers(self, paper, answers):
+        thickness = _scaled(2)
+        num_question = 0
+        for table, (choices, questions) in enumerate(self.dimensions):
+            for row in range(questions):
+                answer = answers[num_question]
+                num_question += 1
+                if answer == 0:
+                    continue
+                jitter = self.random.uniform(-0.06, 0.06, 4)
+                x0, y0 = self._cell_point(
+                    table, answer - 0.85 + jitter[0], row + 0.15 + jitter[1]
+                )
+                x1, y1 = self._cell_point(
+                    table, answer - 0.15 + jitter[2], row + 0.85 + jitter[3]
+                )
+                _line(paper, (x0, y0), (x1, y1), _INK_COLOR, thickness)
+                _line(paper, (x0, y1), (x1, y0), _INK_COLOR, thickness)
+
+    def _draw_id_box(self, paper, student_id):
+        thickness = _scaled(2)
+        cell_width = 0.5 * self.cell_width
+        x0 = self.id_left
+        y0 = self.id_top
+        x1 = x0 + self.id_num_digits * cell_width
+        y1 = y0 + self.cell_height
+        _line(paper, (x0, y0), (x1, y0), _LINE_COLOR, thickness)
+        _line(paper, (x0, y1), (x1, y1), _LINE_COLOR, thickness)
+        for i in range(self.id_num_digits + 1):
+            x = x0 + i * cell_width
+            _line(paper, (x, y0), (x, y1), _LINE_COLOR, thickness)
+        _text(
+            paper,
+            "ID:",
+            (x0 - 0.7 * cell_width, y0 + 0.5 * self.cell_height),
+            0.7 * self.cell_height,
+        )
+        if student_id is not None:
+            for i, digit in enumerate(student_id):
+                center = (x0 + (i + 0.5) * cell_width, y0 + 0.5 * self.cell_height)
+                _text(
+                    paper,
+                    digit,
+                    center,
+                    0.7 * self.cell_height,
+                    color=_INK_COLOR,
+                    font=cv2.FONT_HERSHEY_SCRIPT_SIMPLEX,
+                )
+
+    def _project(self, paper, distortion):
+        """Projects the paper into the final frame and distorts it."""
+        paper_height, paper_width = paper.shape[:2]
+        src = np.float32(
+            [[0, 0], [paper_width, 0], [paper_width, paper_height], [0, paper_height]]
+        )
+        center = np.float32([self.width / 2, self.height / 2])
+        dst = src / _OVERSAMPLING - center
+        angle = math.radians(self.random.uniform(-1, 1) * distortion.rotation)
+        rotation = np.float32(
+            [[math.cos(angle), -math.sin(angle)], [math.sin(angle), math.cos(angle)]]
+        )
+        dst = dst.dot(rotation.T) + center
+        dst += (
+            self.random.uniform(-1, 1, (4, 2))
+            * distortion.perspective
+            * np.float32([self.width, self.height])
+        )
+        transform = cv2.getPerspectiveTransform(src, dst.astype(np.float32))
+        image = cv2.warpPerspective(
+            paper,
+            transform,
+            (self.width, self.height),
+            flags=cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_REPLICATE,
+        )
+        if distortion.blur > 0:
+            image = cv2.GaussianBlur(image, (0, 0), distortion.blur)
+        if distortion.lighting > 0 or distortion.noise > 0:
+            image = image.astype(np.float32)
+            if distortion.lighting > 0:
+                image *= self._lighting_gradient(distortion.lighting)[:, :, np.newaxis]
+            if distortion.noise > 0:
+                image += self.random.normal(0, distortion.noise, image.shape)
+            image = np.clip(image, 0, 255).astype(np.uint8)
+        return image
+
+    def _lighting_gradient(self, strength):
+        """Linear gradient of light in a random direction."""
+        angle = self.random.uniform(0, 2 * math.pi)
+        ys, xs = np.mgrid[0 : self.height, 0 : self.width].astype(np.float32)
+        ramp = xs * math.cos(angle) + ys * math.sin(angle)
+        ramp -= ramp.min()
+        ramp /= ramp.max()
+        return 1.0 - strength * ramp
+
+
+def _scaled(value):
+    return int(round(value * _OVERSAMPLING))
+
+
+def _point(point):
+    return (int(round(point[0])), int(round(point[1])))
+
+
+def _line(image, p0, p1, color, thickness):
+    cv2.line(image, _point(p0), _point(p1), color, thickness, cv2.LINE_AA)
+
+
+def _square(image, center, side, color):
+    p0 = (center[0] - side / 2, center[1] - side / 2)
+    p1 = (center[0] + side / 2, center[1] + side / 2)
+    cv2.rectangle(image, _point(p0), _point(p1), color, -1)
+
+
+def _text(
+    image, text, center, height, color=_TEXT_COLOR, font=cv2.FONT_HERSHEY_SIMPLEX
+):
+    """Draws text centered at a point, with the given height in pixels."""
+    (width, text_height), _ = cv2.getTextSize(text, font, 1.0, 1)
+    scale = height / text_height
+    thickness = max(1, int(round(scale * 1.5)))
+    origin = (center[0] - scale * width / 2, center[1] + height / 2)
+    cv2.putText(image, text, _point(origin), font, scale, color, thickness, cv2.LINE_AA)
+
+
+def _cmd_options():
+    parser = argparse.ArgumentParser(
+        description="Render synthetic answer sheets with known answers."
+    )
+    parser.add_argument(
+        "dimensions", help='Answer box dimensions spec. (e.g. "3,5;3,5")'
+    )
+    parser.add_argument("output_dir", help="directory to write the images to")
+    parser.add_argument(
+        "-n", "--num-sheets", type=int, default=10, help="number of sheets"
+    )
+    parser.add_argument(
+        "-i",
+        "--id-num-digits",
+        type=int,
+        default=0,
+        help="number of digits of the student id (default none)",
+    )
+    parser.add_argument("--seed", type=int, default=None, help="random seed")
+    parser.add_argument("--rotation", type=float, default=0.0, help="in degrees")
+    parser.add_argument(
+        "--perspective", type=float, default=0.0, help="as a fraction of image size"
+    )
+    parser.add_argument("--blur", type=float, default=0.0, help="sigma in pixels")
+    parser.add_argument("--noise", type=float, default=0.0, help="sigma in gray levels")
+    parser.add_argument(
+        "--lighting", type=float, default=0.0, help="darkening from 0 to 1"
+    )
+    return parser.parse_args()
+
+
+def main():
+    """Writes the sheets and a CSV file with their ground truth."""
+    args = _cmd_options()
+    dimensions, _ = utils.parse_dimensions(args.dimensions)
+    generator = SheetGenerator(
+        dimensions, id_num_digits=args.id_num_digits, seed=args.seed
+    )
+    distortion = SheetDistortion(
+        rotation=args.rotation,
+        perspective=args.perspective,
+        blur=args.blur,
+        noise=args.noise,
+        lighting=args.lighting,
+    )
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, "ground-truth.csv"), "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(["image", "model", "student_id", "answers"])
+        for i in range(args.num_sheets):
+            sheet = generator.random_sheet(distortion=distortion)
+            filename = "sheet-{:04d}.png".format(i + 1)
+            cv2.imwrite(os.path.join(args.output_dir, filename), sheet.image)
+            writer.writerow(
+                [
+                    filename,
+                    sheet.model,
+                    sheet.student_id or "",
+                    "/".join(str(a) for a in sheet.answers),
+                ]
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -107,6 +107,7 @@ def _read_config():
         "save-filename-pattern": default_capture_pattern,
         "csv-dialect": "tabs",
         "default-charset": "utf8",  # special value: 'system-default'
+        "detection-width": "640",
     }
     parser = configparser.ConfigParser()
     home = user_home()
@@ -132,6 +133,9 @@ def _read_config():
     else:
         conf["error-logging"] = False
     conf["camera-dev"] = int(conf["camera-dev"])
+    conf["detection-width"] = int(conf["detection-width"])
+    if conf["detection-width"] <= 0:
+        conf["detection-width"] = None
     if conf["default-charset"] == "system-default":
         conf["default-charset"] = locale.getpreferredencoding()
     if "gui-styles" in conf:
@@ -63,6 +63,9 @@ setuptools.setup(
     },
     entry_points={
         "gui_scripts": ["eyegrade = eyegrade.eyegrade:main"],
-        "console_scripts": ["eyegrade-create = eyegrade.create.create:main"],
+        "console_scripts": [
+            "eyegrade-create = eyegrade.create.create:main",
+            "eyegrade-batch = eyegrade.batch:main",
+        ],
     },
 )
@@ -0,0 +1,117 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2019 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+#
+import os
+import unittest
+import tempfile
+
+import eyegrade.batch as batch
+import eyegrade.exams as exams
+import eyegrade.sessiondb as sessiondb
+import eyegrade.students as students
+
+
+class TestBatch(unittest.TestCase):
+    def _get_test_file_path(self, filename):
+        dirname = os.path.dirname(os.path.abspath(__file__))
+        return os.path.join(dirname, filename)
+
+    def _create_session(self, dir_name):
+        exam_config = exams.ExamConfig(filename=self._get_test_file_path("test.eye"))
+        listings = students.StudentListings()
+        listings.create_listing(students.StudentGroup(0, "INSERTED"))
+        session_dir = os.path.join(dir_name, "session")
+        sessiondb.create_session_directory(session_dir, exam_config, listings)
+        return sessiondb.SessionDB(session_dir)
+
+    def test_find_images(self):
+        image_files = batch.find_images(
+            [self._get_test_file_path(""), self._get_test_file_path("*.eye")]
+        )
+        self.assertIn(self._get_test_file_path("capture.png"), image_files)
+        self.assertNotIn(self._get_test_file_path("test.eye"), image_files)
+
+    def test_grade(self):
+        image_files = [
+            self._get_test_file_path("capture.png"),
+            self._get_test_file_path("cross.png"),
+            self._get_test_file_path("capture.png"),
+        ]
+        with tempfile.TemporaryDirectory() as dir_name:
+            session = self._create_session(dir_name)
+            grader = batch.BatchGrader(session)
+            results = list(grader.grade(image_files))
+            self.assertEqual([r.success for r in results], [True, False, True])
+            self.assertEqual([r.exam_id for r in results], [1, None, 2])
+            self.assertEqual(session.next_exam_id(), 3)
+            self.assertEqual(len(session.read_answers(1)), 5)
+            self.assertTrue(
+                os.path.exists(
+                    os.path.join(session.session_dir, "internal", "raw-2.png")
+                )
+            )
+            session.close()
+
+    def test_grade_with_min_margin(self):
+        image_files = [self._get_test_file_path("capture.png")]
+        with tempfile.TemporaryDirectory() as dir_name:
+            session = self._create_session(dir_name)
+            results = list(
+                batch.BatchGrader(session, min_margin=0.0).grade(image_files)
+            )
+            self.assertTrue(results[0].success)
+            self.assertTrue(results[0].confident)
+            decisions = results[0].exam.decisions
+            self.assertEqual(len(decisions.cell_margins), 5)
+            self.assertEqual(len(decisions.id_margins), 9)
+            self.assertGreaterEqual(decisions.confidence, 0.0)
+            # No threshold reaches the margin: the sheet is graded anyway
+            grader = batch.BatchGrader(session, min_margin=1e6)
+            results = list(grader.grade(image_files))
+            self.assertTrue(results[0].success)
+            self.assertFalse(results[0].confident)
+            session.close()
+
+    def test_grade_in_worker_processes(self):
+        image_files = [
+            self._get_test_file_path("cross.png"),
+            self._get_test_file_path("capture.png"),
+            self._get_test_file_path("capture.png"),
+        ]
+        with tempfile.TemporaryDirectory() as dir_name:
+            session = self._create_session(dir_name)
+            grader = batch.BatchGrader(session, jobs=2)
+            results = list(grader.grade(image_files))
+            self.assertEqual([r.image_file for r in results], image_files)
+            self.assertEqual([r.exam_id for r in results], [None, 1, 2])
+            self.assertTrue(all(r.detection_time > 0 for r in results))
+            self.assertEqual(len(session.read_answers(2)), 5)
+            session.close()
+
+    def test_grade_with_profile(self):
+        image_files = [
+            self._get_test_file_path("capture.png"),
+            self._get_test_file_path("cross.png"),
+        ]
+        with tempfile.TemporaryDirectory() as dir_name:
+            session = self._create_session(dir_name)
+            grader = batch.BatchGrader(session, store_captures=False, profile=True)
+            list(grader.grade(image_files))
+            summary = grader.profiler.summary()
+            self.assertEqual(summary["store"]["count"], 2)
+            self.assertGreaterEqual(summary["detect"]["count"], 2)
+            session.close()
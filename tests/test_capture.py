@@ -15,10 +15,22 @@
 # along with this program.  If not, see
 # <http://www.gnu.org/licenses/>.
 #
+import csv
+import json
+import math
 import os
+import tempfile
+import threading
+import time
 import unittest
 
+import cv2
+import numpy as np
+
+import eyegrade.capture as capture
 import eyegrade.detection as detection
+import eyegrade.geometry as g
+import eyegrade.images as images
 
 
 class _MockExamDetector(detection.ExamDetector):
@@ -38,7 +50,7 @@ class _MockExamDetector(detection.ExamDetector):
         self.image_proc = None
 
     def _decide_cells(self, answer_cells):
-        return None
+        return None, None
 
 
 def _mock_read_infobits(image, corner_matrixes):
@@ -48,6 +60,150 @@ def _mock_read_infobits(image, corner_matrixes):
 detection.read_infobits = _mock_read_infobits
 
 
+class _FakeCamera:
+    """Camera whose frames are filled with their sequence number."""
+
+    def __init__(self):
+        self.frames = 0
+        self.release_next = threading.Event()
+
+    def read(self, image=None):
+        self.release_next.wait(1.0)
+        self.release_next.clear()
+        if image is None:
+            image = np.empty((4, 6, 3), dtype=np.uint8)
+        self.frames += 1
+        image[:] = self.frames
+        return True, image
+
+    def release(self):
+        pass
+
+
+class _StuckCamera:
+    """Camera whose reads block until `unblock` is set."""
+
+    def __init__(self):
+        self.unblock = threading.Event()
+        self.released = False
+
+    def read(self, image=None):
+        self.unblock.wait()
+        return False, None
+
+    def release(self):
+        self.released = True
+
+
+class TestFrameGrabber(unittest.TestCase):
+    def _wait_for_frame(self, grabber, number):
+        for _ in range(100):
+            if grabber.frames_read >= number:
+                return
+            time.sleep(0.01)
+
+    def test_latest_frame(self):
+        camera = _FakeCamera()
+        grabber = detection.FrameGrabber(camera)
+        grabber.start()
+        camera.release_next.set()
+        self._wait_for_frame(grabber, 1)
+        first = grabber.latest()
+        self.assertEqual(first[0, 0, 0], 1)
+        for i in range(5):
+            camera.release_next.set()
+            self._wait_for_frame(grabber, 2 + i)
+        frame = grabber.latest()
+        self.assertEqual(frame[0, 0, 0], 6)
+        # Returned frames are copies, not overwritten by the grabber
+        self.assertEqual(first[0, 0, 0], 1)
+        grabber.stop()
+
+    def test_concurrent_consumers(self):
+        camera = _FakeCamera()
+        grabber = detection.FrameGrabber(camera)
+        grabber.start()
+        camera.release_next.set()
+        self._wait_for_frame(grabber, 1)
+        wrong = []
+
+        def consume():
+            previous = 0
+            for _ in range(200):
+                frame = grabber.latest()
+                number = frame[0, 0, 0]
+                if number < previous or not np.all(frame == number):
+                    wrong.append(frame)
+                previous = number
+
+        threads = [threading.Thread(target=consume) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            camera.release_next.set()
+            time.sleep(0.001)
+        grabber.stop()
+        self.assertEqual(wrong, [])
+
+    def test_stuck_camera(self):
+        camera = _StuckCamera()
+        context = detection.ExamDetectorContext(frame_grabber=True)
+        context.camera = camera
+        context._start_grabber()
+        first_frame_timeout = detection.param_grabber_first_frame_timeout
+        stop_timeout = detection.param_grabber_stop_timeout
+        detection.param_grabber_first_frame_timeout = 0.2
+        detection.param_grabber_stop_timeout = 0.2
+        try:
+            self.assertIsNone(context.capture_image())
+            # The failure is remembered: later calls do not wait again
+            start = time.time()
+            self.assertIsNone(context.capture_image())
+            self.assertLess(time.time() - start, 0.1)
+            start = time.time()
+            context.close_camera()
+            self.assertLess(time.time() - start, 1.0)
+            self.assertFalse(camera.released)
+            self.assertIsNone(context.camera)
+        finally:
+            detection.param_grabber_first_frame_timeout = first_frame_timeout
+            detection.param_grabber_stop_timeout = stop_timeout
+            camera.unblock.set()
+
+    def test_context_with_grabber(self):
+        context = detection.ExamDetectorContext(frame_grabber=True)
+        camera = _FakeCamera()
+        context.camera = camera
+        context._start_grabber()
+        camera.release_next.set()
+        image = context.capture()
+        self.assertEqual(image.shape, (4, 6, 3))
+        self.assertEqual(image[0, 0, 0], 1)
+        context.dump_buffer(1.0)
+        self.assertEqual(camera.frames, 1)
+        context.close_camera()
+        self.assertIsNone(context.grabber)
+        self.assertIsNone(context.camera)
+
+
+class TestFrameChangeDetector(unittest.TestCase):
+    def test_changed(self):
+        dirname = os.path.dirname(os.path.abspath(__file__))
+        image = images.load_image(os.path.join(dirname, "capture.png"))
+        changes = detection.FrameChangeDetector()
+        self.assertTrue(changes.changed(image))
+        changes.set_reference(image)
+        self.assertFalse(changes.changed(image))
+        rng = np.random.RandomState(0)
+        noisy = np.clip(image + rng.normal(0, 5, image.shape), 0, 255)
+        self.assertFalse(changes.changed(noisy.astype(np.uint8)))
+        covered = image.copy()
+        covered[300:, 500:] = 0
+        self.assertTrue(changes.changed(covered))
+        changes.reset()
+        self.assertTrue(changes.changed(image))
+
+
 class TestDetection(unittest.TestCase):
     def _get_test_file_path(self, filename):
         dirname = os.path.dirname(os.path.abspath(__file__))
@@ -137,3 +293,327 @@ class TestDetection(unittest.TestCase):
         self.assertTrue(detector.detect_manual(manual_points))
         corner_matrixes_2 = detection.process_box_corners(manual_points, dimensions)
         self.assertEqual(corner_matrixes, corner_matrixes_2)
+
+    def test_detection_profiler(self):
+        image_path = self._get_test_file_path("capture.png")
+        options = detection.ExamDetector.get_default_options()
+        options["capture-from-file"] = True
+        options["capture-raw-file"] = image_path
+        dimensions = ((3, 5),)
+        context = detection.ExamDetectorContext(fixed_hough_threshold=180)
+        context.enable_profiling()
+        for _ in range(2):
+            detector = detection.ExamDetector(dimensions, context, options)
+            detector.detect()
+        self.assertIn("detect_lines", detector.timings)
+        summary = context.profiler.summary()
+        self.assertEqual(summary["pre_process"]["count"], 2)
+        self.assertEqual(summary["detect"]["count"], 2)
+        self.assertEqual(sum(summary["detect"]["histogram"]), 2)
+        with tempfile.TemporaryDirectory() as dir_name:
+            json_file = os.path.join(dir_name, "profile.json")
+            csv_file = os.path.join(dir_name, "profile.csv")
+            context.profiler.save(json_file)
+            context.profiler.save(csv_file)
+            with open(json_file) as f:
+                self.assertEqual(json.load(f)["stages"]["detect"]["count"], 2)
+            with open(csv_file) as f:
+                self.assertEqual(next(csv.reader(f))[0], "stage")
+        context.disable_profiling()
+        detector = detection.ExamDetector(dimensions, context, options)
+        detector.detect()
+        self.assertEqual(detector.timings, {})
+
+    def test_detect_capture_rectifying_tables(self):
+        image_path = self._get_test_file_path("capture.png")
+        options = detection.ExamDetector.get_default_options()
+        options["capture-from-file"] = True
+        options["capture-raw-file"] = image_path
+        dimensions = ((3, 5),)
+        context = detection.ExamDetectorContext(fixed_hough_threshold=180)
+        detector = detection.ExamDetector(dimensions, context, options)
+        self.assertTrue(detector.detect())
+        options["rectify-tables"] = True
+        rectified = detection.ExamDetector(dimensions, context, options)
+        self.assertTrue(rectified.detect())
+        self.assertEqual(rectified.decisions.answers, detector.decisions.answers)
+
+    def test_detect_capture_tracking_tables(self):
+        image_path = self._get_test_file_path("capture.png")
+        options = detection.ExamDetector.get_default_options()
+        options["capture-from-file"] = True
+        options["capture-raw-file"] = image_path
+        options["read-id"] = True
+        options["id-num-digits"] = 9
+        dimensions = ((3, 5),)
+        context = detection.ExamDetectorContext(
+            fixed_hough_threshold=180, tracking=True
+        )
+        context.enable_profiling()
+        detector = detection.ExamDetector(dimensions, context, options)
+        self.assertTrue(detector.detect())
+        self.assertIn("detect_lines", detector.timings)
+        self.assertIsNotNone(context.tracked_axes)
+        tracked = detection.ExamDetector(dimensions, context, options)
+        self.assertTrue(tracked.detect())
+        self.assertIn("track_axes", tracked.timings)
+        self.assertNotIn("detect_lines", tracked.timings)
+        self.assertEqual(tracked.decisions.answers, detector.decisions.answers)
+        self.assertEqual(tracked.decisions.detected_id, detector.decisions.detected_id)
+        # The tables are searched again when they are lost
+        options["capture-raw-file"] = self._get_test_file_path("cross.png")
+        lost = detection.ExamDetector(dimensions, context, options)
+        self.assertFalse(lost.detect())
+        self.assertIn("detect_lines", lost.timings)
+        self.assertIsNone(context.tracked_axes)
+
+    def test_detect_capture_sweeping_thresholds(self):
+        options = detection.ExamDetector.get_default_options()
+        options["capture-from-file"] = True
+        options["capture-raw-file"] = self._get_test_file_path("capture.png")
+        dimensions = ((3, 5),)
+        context = detection.ExamDetectorContext(threshold_sweep=True)
+        context.hough_thresholds = [280, 260, 240, 225]
+        detector = detection.ExamDetector(dimensions, context, options)
+        self.assertTrue(detector.detect())
+        self.assertEqual(context.get_hough_threshold(), 240)
+        # Failed sweeps are not repeated in the next frames
+        context.hough_thresholds_idx = 0
+        options["capture-raw-file"] = self._get_test_file_path("cross.png")
+        detector = detection.ExamDetector(dimensions, context, options)
+        self.assertFalse(detector.detect())
+        self.assertEqual(context.sweep_skip_frames, detection.param_sweep_skip_frames)
+        # Thresholds are not swept while locked
+        context.sweep_skip_frames = 0
+        context.hough_thresholds_idx = 0
+        context.lock_threshold()
+        options["capture-raw-file"] = self._get_test_file_path("capture.png")
+        detector = detection.ExamDetector(dimensions, context, options)
+        self.assertFalse(detector.detect())
+        self.assertEqual(context.get_hough_threshold(), 280)
+        # Closing the camera stops the threads of the sweep
+        executor = context._sweep_executor
+        context.close_camera()
+        self.assertIsNone(context._sweep_executor)
+        with self.assertRaises(RuntimeError):
+            executor.submit(time.sleep, 0)
+
+    def test_still_frame_without_sweep(self):
+        options = detection.ExamDetector.get_default_options()
+        dimensions = ((3, 5),)
+        image = images.load_image(self._get_test_file_path("capture.png"))
+        context = detection.ExamDetectorContext()
+        # Only the last threshold finds the tables of this frame
+        context.hough_thresholds = [280, 260, 240]
+        changes = detection.FrameChangeDetector()
+        detections = 0
+        success = False
+        for _ in range(3 * (detection.param_failures_threshold + 1)):
+            if not changes.changed(image) and not context.notify_unchanged_frame():
+                continue
+            detections += 1
+            detector = detection.ExamDetector(
+                dimensions, context, options, image_raw=image
+            )
+            success = detector.detect()
+            if success:
+                break
+            if detector.worth_retrying():
+                changes.reset()
+            else:
+                changes.set_reference(image)
+        self.assertTrue(success)
+        self.assertEqual(context.get_hough_threshold(), 240)
+        self.assertEqual(detections, 3)
+
+    def test_still_frame_pipelined(self):
+        options = detection.ExamDetector.get_default_options()
+        dimensions = ((3, 5),)
+        image = images.load_image(self._get_test_file_path("capture.png"))
+        context = detection.ExamDetectorContext()
+        # Only the last threshold finds the tables of this frame
+        context.hough_thresholds = [280, 260, 240]
+        context.hough_thresholds_idx = 2
+        changes = detection.FrameChangeDetector()
+        # The reference is a frame that failed, and the same frame is
+        # still being detected with the new threshold when more come
+        changes.set_reference(image)
+        running = detection.ExamDetector(dimensions, context, options, image_raw=image)
+        for _ in range(3 * (detection.param_failures_threshold + 1)):
+            self.assertFalse(changes.changed(image))
+            self.assertFalse(context.notify_unchanged_frame(detections_running=1))
+        self.assertEqual(context.failures_in_a_row, 0)
+        self.assertTrue(running.detect())
+        self.assertEqual(context.get_hough_threshold(), 240)
+        # Without detections running, unchanged frames count as failures
+        context.hough_thresholds_idx = 0
+        changed = [
+            context.notify_unchanged_frame()
+            for _ in range(detection.param_failures_threshold + 1)
+        ]
+        self.assertEqual(changed, [False] * detection.param_failures_threshold + [True])
+        self.assertEqual(context.get_hough_threshold(), 260)
+
+    def test_detect_capture_downscaled(self):
+        options = detection.ExamDetector.get_default_options()
+        options["read-id"] = True
+        options["id-num-digits"] = 9
+        dimensions = ((3, 5),)
+        image = images.load_image(self._get_test_file_path("capture.png"))
+        context = detection.ExamDetectorContext(fixed_hough_threshold=210)
+        detector = detection.ExamDetector(dimensions, context, options, image_raw=image)
+        self.assertTrue(detector.detect())
+        large_image = cv2.resize(image, None, fx=2, fy=2)
+        options["detection-width"] = 640
+        large = detection.ExamDetector(
+            dimensions, context, options, image_raw=large_image
+        )
+        self.assertEqual(large.image_proc.shape, large_image.shape[:2])
+        self.assertEqual(large.image_search.shape, image.shape[:2])
+        self.assertTrue(large.detect())
+        self.assertEqual(large.decisions.answers, detector.decisions.answers)
+        self.assertEqual(large.decisions.detected_id, detector.decisions.detected_id)
+
+    def test_pre_process_cache(self):
+        image = images.load_image(self._get_test_file_path("capture.png"))
+        # Disabled by default
+        context = detection.ExamDetectorContext()
+        self.assertIsNot(
+            context.pre_process(image, 1.0)[0], context.pre_process(image, 1.0)[0]
+        )
+        context = detection.ExamDetectorContext(pre_process_cache=True)
+        image_proc, image_search = context.pre_process(image, 1.0)
+        self.assertIsNone(image_search)
+        self.assertFalse(image_proc.flags.writeable)
+        self.assertIs(context.pre_process(image, 1.0)[0], image_proc)
+        # Keyed by the frame object, not by its contents
+        self.assertIsNot(context.pre_process(image.copy(), 1.0)[0], image_proc)
+        self.assertIsNot(context.pre_process(image, 0.5)[0], image_proc)
+        for i in range(detection.param_pre_process_cache_size):
+            context.pre_process(image.copy(), 1.0)
+        self.assertIsNot(context.pre_process(image, 1.0)[0], image_proc)
+        options = detection.ExamDetector.get_default_options()
+        detector = detection.ExamDetector(((3, 5),), context, options, image_raw=image)
+        self.assertIs(detector.image_proc, context.pre_process(image, 1.0)[0])
+
+    def test_decide_infobits(self):
+        image = np.zeros((100, 200), dtype=np.uint8)
+        image[20:36, 20:36] = 255
+        image[50:66, 80:96] = 255
+        centers = [(28, 28), (88, 28), (195, 95)]
+        dys = [(0, 30), (0, 30), (0, 30)]
+        bits = detection.decide_infobits(image, centers, dys)
+        self.assertEqual(bits, [(True, False), (False, True), (False, False)])
+
+    def test_cell_corners(self):
+        hlines = [(40.0 + 9.5 * i, 1.6 + 0.001 * i) for i in range(6)]
+        vlines = [(30.0 + 21.3 * j, 0.03) for j in range(11)]
+        dimensions = [(4, 5), (5, 4)]
+        corners = detection.cell_corners(hlines, vlines, 640, 480, dimensions)
+        self.assertEqual(len(corners), 2)
+        self.assertEqual(len(corners[0]), 6)
+        self.assertEqual(len(corners[0][0]), 5)
+        self.assertEqual(len(corners[1]), 5)
+        self.assertEqual(len(corners[1][0]), 6)
+        for i in range(6):
+            for j in range(5):
+                self.assertEqual(corners[0][i][j], g.intersection(hlines[i], vlines[j]))
+        for i in range(5):
+            for j in range(6):
+                self.assertEqual(
+                    corners[1][i][j], g.intersection(hlines[i], vlines[5 + j])
+                )
+        self.assertEqual(
+            detection.cell_corners(hlines, vlines, 200, 480, dimensions), []
+        )
+
+    def test_walk_lines(self):
+        ends = [
+            ((10, 10), (40, 17)),
+            ((40, 17), (10, 10)),
+            ((5, 30), (9, 2)),
+            ((9, 2), (5, 30)),
+            ((3, 3), (3, 3)),
+            ((0, 20), (25, 20)),
+            ((12, 0), (0, 12)),
+        ]
+        xs, ys, lengths = g.walk_lines(*zip(*ends))
+        for i, (p0, p1) in enumerate(ends):
+            points = list(zip(xs[i, : lengths[i]], ys[i, : lengths[i]]))
+            self.assertEqual(points, list(g.walk_line(p0, p1)))
+
+    def test_id_boxes_match_levels(self):
+        image = np.zeros((50, 50), dtype=np.uint8)
+        image[10:40, 20] = 255
+        pairs = [((20, 10), (20, 39)), ((20, 10), (29, 39)), ((5, 10), (5, 39))]
+        levels = detection.id_boxes_match_levels(image, pairs)
+        for level, (p0, p1) in zip(levels, pairs):
+            points = list(g.walk_line(p0, p1))
+            active = sum(1 for x, y in points if image[y, x] > 0)
+            self.assertEqual(level, active / len(points))
+        self.assertEqual(levels[0], 1.0)
+        self.assertEqual(levels[2], 0.0)
+
+    def test_lines_bounds(self):
+        image = np.zeros((100, 120), dtype=np.uint8)
+        image[50, 10:12] = 255
+        image[50, 30:60] = 255
+        image[50, 70:91] = 255
+        lines = [(50.5, math.pi / 2), (20.5, math.pi / 2), (-10.0, math.pi / 2)]
+        bounds = detection.lines_bounds(image, lines, 120)
+        self.assertEqual(bounds[0], ((30, 50), (90, 50)))
+        self.assertEqual(bounds[1], (None, None))
+        self.assertEqual(bounds[2], (None, None))
+        self.assertEqual(detection.line_bounds(image, lines[0], 120), bounds[0])
+
+
+class TestCellGrid(unittest.TestCase):
+    def setUp(self):
+        # Two tables: 2 questions with 3 choices and 1 question with 4 choices
+        self.corner_matrixes = [
+            [[(10 * j, 12 * i + 1) for j in range(4)] for i in range(3)],
+            [[(50 + 10 * j, 12 * i) for j in range(5)] for i in range(2)],
+        ]
+        self.cells = capture.CellGrid.from_corner_matrixes(self.corner_matrixes)
+
+    def test_cell_geometry(self):
+        self.assertEqual(len(self.cells), 3)
+        self.assertEqual([len(row) for row in self.cells], [3, 3, 4])
+        for question, table, row in ((0, 0, 0), (1, 0, 1), (2, 1, 0)):
+            corners = self.corner_matrixes[table]
+            for choice, cell in enumerate(self.cells[question]):
+                expected = capture.CellGeometry(
+                    corners[row][choice],
+                    corners[row][choice + 1],
+                    corners[row + 1][choice],
+                    corners[row + 1][choice + 1],
+                    None,
+                    None,
+                )
+                self.assertEqual(cell.corners(), expected.corners())
+                self.assertEqual(cell.center, expected.center)
+                self.assertEqual(cell.diagonal, expected.diagonal)
+        converted = capture.CellGrid.from_cells(list(self.cells))
+        mask = self.cells.mask()
+        self.assertTrue(np.array_equal(converted.mask(), mask))
+        for name in ("corners", "centers", "diagonals"):
+            self.assertTrue(
+                np.array_equal(
+                    getattr(converted, name)[mask], getattr(self.cells, name)[mask]
+                )
+            )
+
+    def test_take(self):
+        cells = self.cells.take([2, 0])
+        self.assertEqual(cells.choices.tolist(), [4, 3])
+        self.assertEqual(cells.center(0, 3), self.cells.center(2, 3))
+
+    def test_get_cell_clicked(self):
+        exam_capture = capture.ExamCapture(None, self.cells, None)
+        self.assertEqual(exam_capture.get_cell_clicked((24, 19)), (1, 3))
+        self.assertEqual(exam_capture.get_cell_clicked((84, 5)), (2, 4))
+        # The padded fourth choice of the first table does not exist
+        self.assertEqual(exam_capture.get_cell_clicked((35, 7)), (None, None))
+        # Lists of CellGeometry objects are still accepted
+        exam_capture = capture.ExamCapture(None, list(self.cells), None)
+        self.assertEqual(exam_capture.get_cell_clicked((24, 19)), (1, 3))
@@ -15,13 +15,22 @@
 # along with this program.  If not, see
 # <http://www.gnu.org/licenses/>.
 #
+import csv
+import functools
 import os
+import shutil
+import tempfile
 import unittest
 
+import cv2
 import numpy as np
 
 import eyegrade.ocr.sample as sample
 import eyegrade.ocr.classifiers as classifiers
+import eyegrade.ocr.compare_backends as compare_backends
+import eyegrade.ocr.decide_params as decide_params
+import eyegrade.ocr.preprocessing as preprocessing
+import eyegrade.utils as utils
 
 
 class TestClassifier(unittest.TestCase):
@@ -44,3 +53,318 @@ class TestClassifier(unittest.TestCase):
         classifier = classifiers.DefaultCrossesClassifier()
         label = classifier.classify(samp)
         self.assertTrue(label == 0 or label == 1)
+
+    def test_classify_many(self):
+        image_path = self._get_test_file_path("cross.png")
+        corners = np.array([[0, 0], [27, 0], [1, 32], [29, 32]])
+        samp = sample.Sample(corners, image_filename=image_path)
+        classifier = classifiers.DefaultCrossesClassifier()
+        label = classifier.classify(samp)
+        self.assertEqual(classifier.classify_many([samp, samp]), [label, label])
+        self.assertEqual(classifier.are_crosses([samp]), [label == 1])
+        self.assertEqual(classifier.classify_many([]), [])
+
+    def test_predict_matches_opencv(self):
+        random = np.random.RandomState(0)
+        density = random.random_sample((500, 1)) * 0.3
+        features = (random.random_sample((500, 784)) < density).astype(np.float32)
+        classifier = classifiers.DefaultCrossesClassifier()
+        _, expected = classifier.svm.predict(features)
+        self.assertEqual(
+            list(classifier.predict(features)), list(expected[:, 0].astype(int))
+        )
+
+    def test_predict_margins(self):
+        random = np.random.RandomState(0)
+        density = random.random_sample((200, 1)) * 0.3
+        features = (random.random_sample((200, 784)) < density).astype(np.float32)
+        classifier = classifiers.DefaultCrossesClassifier()
+        labels, margins = classifier.predict_margins(features)
+        self.assertEqual(list(labels), list(classifier.predict(features)))
+        _, expected = classifier.svm.predict(
+            features, flags=cv2.ml.STAT_MODEL_RAW_OUTPUT
+        )
+        self.assertTrue(np.allclose(margins, np.abs(expected[:, 0]), atol=1e-4))
+
+    def test_clear_boundbox(self):
+        image = np.zeros((20, 20), dtype=np.uint8)
+        image[5:12, 6:10] = 255
+        # Stray rows and columns of noise are not part of the box
+        image[1, 1] = 255
+        image[17, 1] = 255
+        cleared = preprocessing.clear_boundbox(image)
+        self.assertTrue(np.array_equal(cleared, image[5:12, 6:10]))
+        blank = np.zeros((5, 5), dtype=np.uint8)
+        self.assertEqual(preprocessing.clear_boundbox(blank).shape, (5, 5))
+
+    def test_extract_many(self):
+        image_path = self._get_test_file_path("digit.png")
+        samples = [
+            sample.Sample(corners, image_filename=image_path)
+            for corners in (
+                np.array([[0, 1], [19, 0], [0, 7], [21, 17]]),
+                np.array([[0, 0], [21, 0], [0, 17], [21, 17]]),
+                np.array([[2, 1], [15, 2], [1, 16], [17, 15]]),
+            )
+        ]
+        extractor = preprocessing.FeatureExtractor()
+        features = extractor.extract_many(samples)
+        self.assertEqual(features.shape, (3, extractor.features_len))
+        for samp, row in zip(samples, features):
+            self.assertTrue(np.array_equal(extractor.extract(samp), row))
+        self.assertEqual(extractor.extract_many([]).shape, (0, extractor.features_len))
+
+    def test_feature_cache(self):
+        corners = ["0\t1\t19\t0\t0\t7\t21\t17", "0\t0\t21\t0\t0\t17\t21\t17"]
+        with tempfile.TemporaryDirectory() as dir_name:
+            shutil.copy(self._get_test_file_path("digit.png"), dir_name)
+            filename = os.path.join(dir_name, "samples.txt")
+            with open(filename, "w") as f:
+                for i, line in enumerate(corners):
+                    f.write("digit.png\t{}\t{}\n".format(i, line))
+            classifier = classifiers.DefaultDigitClassifier()
+            extractor = classifier.features_extractor
+            loader = sample.SampleLoader(filename)
+            samples = loader.samples_with_features(extractor)
+            expected = extractor.extract_many(loader.samples())
+            self.assertTrue(
+                np.array_equal(classifier.features_matrix(samples), expected)
+            )
+            key = preprocessing.extractor_key(extractor)
+            self.assertTrue(os.path.exists(loader.features_filename(key)))
+            # The second time, features are read from the file
+            sample_set = sample.SampleSet()
+            sample_set.load_from_loader(loader, extractor=extractor)
+            samples = sample_set.samples()
+            self.assertTrue(all(samp._image is None for samp in samples))
+            self.assertEqual(
+                classifier.classify_many(samples),
+                classifier.classify_many(loader.samples()),
+            )
+            self.assertNotEqual(
+                key,
+                preprocessing.extractor_key(preprocessing.FeatureExtractor(dim=20)),
+            )
+            # A changed samples file invalidates the cache, even when the
+            # cache is newer, e.g. after restoring the file from a backup
+            with open(filename, "w") as f:
+                for i, line in enumerate(reversed(corners)):
+                    f.write("digit.png\t{}\t{}\n".format(i, line))
+            stat = os.stat(loader.features_filename(key))
+            os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns - 10 ** 9))
+            samples = loader.samples_with_features(extractor)
+            self.assertTrue(
+                np.array_equal(
+                    classifier.features_matrix(samples),
+                    extractor.extract_many(loader.samples()),
+                )
+            )
+
+    def test_packed_samples(self):
+        corners = ["0\t1\t19\t0\t0\t7\t21\t17", "0\t0\t17\t2\t1\t12\t16\t14"]
+        with tempfile.TemporaryDirectory() as dir_name:
+            shutil.copy(self._get_test_file_path("digit.png"), dir_name)
+            filename = os.path.join(dir_name, "samples.txt")
+            with open(filename, "w") as f:
+                for i, line in enumerate(corners):
+                    f.write("digit.png\t{}\t{}\n".format(i + 3, line))
+            samples = sample.SampleLoader(filename).samples()
+            expected = preprocessing.FeatureExtractor().extract_many(samples)
+            packed_filename = os.path.join(dir_name, "samples.samples.npy")
+            sample.pack_samples(samples, packed_filename)
+            packed = sample.open_loader(packed_filename).samples()
+            # Feature caches are not taken for packed samples
+            cache_filename = sample.SampleLoader(filename).features_filename("key")
+            self.assertNotIsInstance(
+                sample.open_loader(cache_filename), sample.PackedSampleLoader
+            )
+            self.assertEqual([samp.label for samp in packed], [3, 4])
+            extractor = preprocessing.FeatureExtractor()
+            self.assertTrue(np.array_equal(extractor.extract_many(packed), expected))
+            unpacked_filename = os.path.join(dir_name, "unpacked", "samples.txt")
+            os.mkdir(os.path.dirname(unpacked_filename))
+            sample.unpack_samples(packed_filename, unpacked_filename)
+            unpacked = sample.open_loader(unpacked_filename).samples()
+            self.assertEqual([samp.label for samp in unpacked], [3, 4])
+            self.assertTrue(np.array_equal(extractor.extract_many(unpacked), expected))
+
+    def test_extract_table(self):
+        image = np.zeros((100, 120), dtype=np.uint8)
+        image[25:45, 35:80] = 255
+        # Cell sizes are chosen so that CrossSampleFromCam rounds nothing
+        corners = np.array(
+            [[[20 + 30 * j, 10 + 20 * i] for j in range(4)] for i in range(4)]
+        )
+        extractor = preprocessing.CrossesFeatureExtractor()
+        features = extractor.extract_table(image, corners)
+        self.assertEqual(features.shape, (9, extractor.features_len))
+        for i in range(3):
+            for j in range(3):
+                cell = np.array(
+                    [
+                        corners[i, j],
+                        corners[i, j + 1],
+                        corners[i + 1, j],
+                        corners[i + 1, j + 1],
+                    ]
+                )
+                samp = sample.CrossSampleFromCam(cell, image)
+                self.assertTrue(
+                    np.array_equal(extractor.extract(samp), features[3 * i + j])
+                )
+
+
+class TestDecideParams(unittest.TestCase):
+    def _sample_set(self, num_samples=40):
+        random = np.random.RandomState(0)
+        corners = np.array([[0, 0], [27, 0], [0, 27], [27, 27]])
+        samples = []
+        for i in range(num_samples):
+            image = (random.random_sample((28, 28)) < 0.05).astype(np.uint8) * 255
+            if i % 2:
+                cv2.line(image, (4, 4), (23, 23), 255, 3)
+                cv2.line(image, (4, 23), (23, 4), 255, 3)
+            samples.append(sample.Sample(corners, image=image, label=i % 2))
+        sample_set = sample.SampleSet()
+        sample_set.load_from_samples(samples)
+        return sample_set
+
+    def test_decide_params(self):
+        factory = functools.partial(
+            classifiers.DefaultCrossesClassifier, load_from_file=None
+        )
+        sample_set = self._sample_set()
+        with tempfile.TemporaryDirectory() as dir_name:
+            log_file = os.path.join(dir_name, "log.csv")
+            results, rmat = decide_params.decide_params(
+                factory, sample_set, [1.0, 10.0], [0.01], k=4, log_file=log_file
+            )
+            self.assertEqual([r[2:] for r in results], [(1.0, 0.01), (10.0, 0.01)])
+            self.assertEqual(rmat.shape, (2, 1))
+            self.assertTrue(all(0.0 <= r[0] <= 1.0 for r in results))
+            # Resuming evaluates only the new grid point, in worker processes
+            resumed, _ = decide_params.decide_params(
+                factory,
+                sample_set,
+                [1.0, 10.0, 100.0],
+                [0.01],
+                k=4,
+                jobs=2,
+                log_file=log_file,
+            )
+            self.assertEqual(resumed[:2], results)
+            with open(log_file, newline="") as f:
+                rows = list(csv.DictReader(f))
+            self.assertEqual([float(row["C"]) for row in rows], [1.0, 10.0, 100.0])
+            self.assertEqual(rows[0]["folds"], "4")
+            # The same folds give the same results, sequentially or not
+            parallel, _ = decide_params.decide_params(
+                factory, sample_set, [1.0, 10.0, 100.0], [0.01], k=4, jobs=2
+            )
+            self.assertEqual(parallel, resumed)
+
+    def test_decide_params_incompatible_log(self):
+        factory = functools.partial(
+            classifiers.DefaultCrossesClassifier, load_from_file=None
+        )
+        rff_factory = functools.partial(
+            classifiers.DefaultRFFCrossesClassifier, load_from_file=None
+        )
+        sample_set = self._sample_set()
+        with tempfile.TemporaryDirectory() as dir_name:
+            log_file = os.path.join(dir_name, "log.csv")
+            decide_params.decide_params(
+                factory, sample_set, [1.0], [0.01], k=4, log_file=log_file
+            )
+            for kwargs in (
+                dict(k=5),
+                dict(k=4, seed=1),
+                dict(k=4, sample_set=self._sample_set(num_samples=42)),
+                dict(k=4, classifier_factory=rff_factory),
+            ):
+                args = dict(
+                    classifier_factory=factory,
+                    sample_set=sample_set,
+                    c_values=[1.0],
+                    gamma_values=[0.01],
+                    log_file=log_file,
+                )
+                args.update(kwargs)
+                with self.assertRaises(utils.EyegradeException):
+                    decide_params.decide_params(**args)
+            with open(log_file, newline="") as f:
+                self.assertEqual(len(list(csv.DictReader(f))), 1)
+
+    def test_decide_params_threshold(self):
+        factory = functools.partial(
+            classifiers.DefaultCrossesClassifier, load_from_file=None
+        )
+        sample_set = self._sample_set()
+        c_values = [0.001, 1.0, 10.0]
+        sequential, _ = decide_params.decide_params(
+            factory, sample_set, c_values, [0.01], threshold=0.9, k=4
+        )
+        parallel, _ = decide_params.decide_params(
+            factory, sample_set, c_values, [0.01], threshold=0.9, k=4, jobs=2
+        )
+        self.assertEqual(parallel, sequential)
+
+    def test_decide_params_classifier(self):
+        # Older callers pass a classifier instead of a factory
+        factory = functools.partial(
+            classifiers.DefaultCrossesClassifier, load_from_file=None
+        )
+        sample_set = self._sample_set()
+        expected, _ = decide_params.decide_params(
+            factory, sample_set, [1.0], [0.01], k=4
+        )
+        classifier = factory()
+        results, _ = decide_params.decide_params(
+            classifier, sample_set, [1.0], [0.01], k=4
+        )
+        self.assertEqual(results, expected)
+        with self.assertRaises(ValueError):
+            decide_params.decide_params(
+                classifier, sample_set, [1.0], [0.01], k=4, jobs=2
+            )
+
+    def test_incomplete_classifier(self):
+        class Incomplete(classifiers.Classifier):
+            def train_features(self, features, labels, params=None):
+                pass
+
+        with self.assertRaises(TypeError):
+            Incomplete(2, preprocessing.CrossesFeatureExtractor())
+
+    def test_rff_classifier(self):
+        samples = self._sample_set().samples()
+        labels = [samp.label for samp in samples]
+        classifier = classifiers.DefaultRFFCrossesClassifier(load_from_file=None)
+        classifier.train(samples)
+        crosses, margins = classifier.are_crosses_with_margins(samples)
+        self.assertEqual(crosses, [label == 1 for label in labels])
+        self.assertTrue(np.all(margins > 0))
+        # Margins are normalized by the median one of the training samples
+        self.assertAlmostEqual(np.median(margins), 1.0, places=5)
+        with tempfile.TemporaryDirectory() as dir_name:
+            filename = os.path.join(dir_name, "classifier.npz")
+            classifier.save(filename)
+            loaded = classifiers.DefaultRFFCrossesClassifier(load_from_file=filename)
+        features = classifier.features_matrix(samples)
+        self.assertTrue(
+            np.array_equal(loaded.scores(features), classifier.scores(features))
+        )
+        self.assertEqual(loaded.margin_scale, classifier.margin_scale)
+        with self.assertRaises(utils.EyegradeException):
+            classifiers.DefaultRFFCrossesClassifier(
+                load_from_file=os.path.join(dir_name, "missing.npz")
+            )
+
+    def test_compare_backends(self):
+        results = compare_backends.compare_backends(
+            self._sample_set(), k=4, batch_size=10
+        )
+        self.assertEqual(list(results.keys()), ["svm", "rff"])
+        for data in results.values():
+            self.assertTrue(0.0 <= data["success_rate"] <= 1.0)
+            self.assertGreater(data["predict_ms"], 0.0)
@@ -20,6 +20,9 @@ import unittest
 import os.path
 import tempfile
 
+import numpy as np
+
+import eyegrade.capture as capture
 import eyegrade.sessiondb as sessiondb
 import eyegrade.exams as exams
 import eyegrade.students as students
@@ -104,3 +107,32 @@ class TestSessionDB(unittest.TestCase):
             ):
                 self.assertEqual(student_1.name, student_2.name)
                 self.assertEqual(student_1.student_id, student_2.student_id)
+
+    def test_answer_cells(self):
+        exam_config = exams.ExamConfig(filename=self._get_test_file_path("test.eye"))
+        corner_matrixes = [
+            [[(10 * j, 12 * i) for j in range(4)] for i in range(3)],
+            [[(50 + 10 * j, 12 * i) for j in range(5)] for i in range(2)],
+        ]
+        cells = capture.CellGrid.from_corner_matrixes(corner_matrixes)
+        with tempfile.TemporaryDirectory() as dir_name:
+            session_dir = os.path.join(dir_name, "test_session")
+            sessiondb.create_session_directory(
+                session_dir, exam_config, students.StudentListings()
+            )
+            session = sessiondb.SessionDB(session_dir)
+            session.conn.execute(
+                "INSERT INTO Exams VALUES (1, NULL, NULL, 0, 0, 0, 0.0)"
+            )
+            session._store_answer_cells(1, cells)
+            read_cells = session._read_answer_cells(1)
+            session.close()
+        self.assertEqual(read_cells.choices.tolist(), [3, 3, 4])
+        mask = cells.mask()
+        self.assertTrue(np.array_equal(read_cells.mask(), mask))
+        for name in ("corners", "centers", "diagonals"):
+            self.assertTrue(
+                np.array_equal(
+                    getattr(read_cells, name)[mask], getattr(cells, name)[mask]
+                )
+            )
@@ -0,0 +1,136 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2019 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+#
+import os
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+import eyegrade.detection as detection
+import eyegrade.exams as exams
+import eyegrade.images as images
+import eyegrade.sessiondb as sessiondb
+import eyegrade.sources as sources
+import eyegrade.students as students
+import eyegrade.tools.replay as replay
+
+
+def _get_test_file_path(filename):
+    dirname = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(dirname, filename)
+
+
+def _frames(num_frames, width=64, height=48):
+    return [np.full((height, width, 3), i, dtype=np.uint8) for i in range(num_frames)]
+
+
+class TestSources(unittest.TestCase):
+    def _read_all(self, source):
+        frames = []
+        while True:
+            success, frame = source.read()
+            if not success:
+                break
+            frames.append((int(frame[0, 0, 0]), source.timestamp))
+        return frames
+
+    def test_memory_source(self):
+        source = sources.MemorySource(_frames(3), fps=10)
+        self.assertEqual(self._read_all(source), [(0, 0.0), (1, 0.1), (2, 0.2)])
+        source.rewind()
+        self.assertEqual(len(self._read_all(source)), 3)
+
+    def test_image_sequence_source(self):
+        with tempfile.TemporaryDirectory() as dir_name:
+            for i, frame in enumerate(_frames(3)):
+                cv2.imwrite(os.path.join(dir_name, "{}.png".format(i)), frame)
+            source = sources.open_source(dir_name, fps=5)
+            self.assertIsInstance(source, sources.ImageSequenceSource)
+            self.assertEqual(self._read_all(source), [(0, 0.0), (1, 0.2), (2, 0.4)])
+            source = sources.open_source(os.path.join(dir_name, "*.png"), fps=5)
+            self.assertEqual(len(self._read_all(source)), 3)
+            # Unreadable files are skipped, but not silently
+            broken = os.path.join(dir_name, "1.png")
+            with open(broken, "w") as f:
+                f.write("not an image")
+            source = sources.open_source(dir_name, fps=5)
+            self.assertEqual(self._read_all(source), [(0, 0.0), (2, 0.4)])
+            self.assertEqual(source.unreadable, [broken])
+            source = sources.MemorySource.preload(sources.open_source(dir_name))
+            self.assertEqual(source.unreadable, [broken])
+
+    def test_video_file_source(self):
+        with tempfile.TemporaryDirectory() as dir_name:
+            filename = os.path.join(dir_name, "video.avi")
+            writer = cv2.VideoWriter(
+                filename, cv2.VideoWriter_fourcc(*"MJPG"), 10, (64, 48)
+            )
+            if not writer.isOpened():
+                self.skipTest("no video encoder available")
+            for frame in _frames(5):
+                writer.write(frame)
+            writer.release()
+            source = sources.open_source(filename)
+            self.assertIsInstance(source, sources.VideoFileSource)
+            memory = sources.MemorySource.preload(source)
+            timestamps = [timestamp for _, timestamp in self._read_all(memory)]
+            self.assertEqual(len(timestamps), 5)
+            self.assertEqual(timestamps, sorted(timestamps))
+
+    def test_context_with_source(self):
+        context = detection.ExamDetectorContext(
+            source=sources.MemorySource(_frames(2), fps=10)
+        )
+        self.assertTrue(context.open_camera())
+        image = context.capture()
+        self.assertEqual(image.shape, (48, 64, 3))
+        self.assertEqual(context.frame_timestamp, 0.0)
+        context.capture()
+        self.assertEqual(context.frame_timestamp, 0.1)
+        self.assertFalse(context.next_camera())
+        context.close_camera()
+
+
+class TestReplay(unittest.TestCase):
+    def _create_session(self, dir_name):
+        exam_config = exams.ExamConfig(filename=_get_test_file_path("test.eye"))
+        listings = students.StudentListings()
+        listings.create_listing(students.StudentGroup(0, "INSERTED"))
+        session_dir = os.path.join(dir_name, "session")
+        sessiondb.create_session_directory(session_dir, exam_config, listings)
+        return sessiondb.SessionDB(session_dir)
+
+    def test_replay(self):
+        exam = images.load_image(_get_test_file_path("capture.png"))
+        empty = np.zeros_like(exam)
+        # Two exams, removed from the camera for long enough between them
+        frames = [empty] * 3 + [exam] * 12 + [empty] * 60 + [exam] * 12
+        with tempfile.TemporaryDirectory() as dir_name:
+            session = self._create_session(dir_name)
+            source = sources.MemorySource(frames, fps=25)
+            session_replay = replay.SessionReplay(
+                session, source, store_captures=False, hough_threshold=225
+            )
+            results = list(session_replay.replay())
+            self.assertEqual([r.exam_id for r in results], [1, 2])
+            stats = session_replay.stats
+            self.assertEqual(stats.frames, len(frames))
+            self.assertEqual(stats.exams, 2)
+            self.assertLess(stats.detections, 10)
+            session.close()
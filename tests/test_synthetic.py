@@ -0,0 +1,42 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2019 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+#
+import unittest
+
+import eyegrade.tools.benchmark as benchmark
+import eyegrade.tools.synthetic as synthetic
+
+
+class TestSynthetic(unittest.TestCase):
+    def test_render(self):
+        generator = synthetic.SheetGenerator([(3, 5), (3, 4)], seed=1)
+        sheet = generator.render([1, 2, 3, 0, 1, 2, 3, 0, 1], model="B")
+        self.assertEqual(sheet.image.shape, (480, 640, 3))
+        self.assertEqual(len(sheet.infobits), 6)
+        with self.assertRaises(ValueError):
+            generator.render([1, 2, 3])
+
+    def test_benchmark_scenario(self):
+        result = benchmark.run_scenario(
+            "clean", benchmark.SCENARIOS["clean"], [(3, 5)], 3, seed=1
+        )
+        summary = result.summary()
+        self.assertEqual(summary["sheets"], 3)
+        self.assertEqual(summary["detection_rate"], 1.0)
+        self.assertEqual(summary["answer_accuracy"], 1.0)
+        self.assertIn("p90", summary["sheet_ms"])
+        self.assertIn("detect", summary["stages_ms"])